@@ -0,0 +1,87 @@
+import functools
+import itertools
+
+from pop_lab.one_locus_two_alleles_simulator import OneLocusTwoAlleleSimulation, INF
+
+from measure import run_benchmark
+
+SUITE = "fwd_in_time"
+
+GRIDS = {
+    "quick": {
+        "pop_size": [100, INF],
+        "num_generations": [100],
+        "num_replicates": [1],
+        "num_pops": [1, 4],
+    },
+    "full": {
+        "pop_size": [100, 1000, 10000, INF],
+        "num_generations": [100, 1000],
+        "num_replicates": [1, 10],
+        "num_pops": [1, 4, 16],
+    },
+}
+
+
+def create_sim_definition(pop_size, num_generations, num_pops):
+    pops = {}
+    for idx in range(num_pops):
+        pops[f"pop{idx + 1}"] = {
+            "genotypic_freqs": (0.25, 0.5, 0.25),
+            "size": pop_size,
+            "fitness": (1, 1, 0.9),
+            "mut_rates": (1e-4, 1e-4),
+        }
+    events = {}
+    if num_pops > 1:
+        events["migration_pop1_to_pop2"] = {
+            "type": "migration_start",
+            "from_pop": "pop1",
+            "to_pop": "pop2",
+            "inmigrant_rate": 0.01,
+            "num_generation": 1,
+        }
+    return {
+        "pops": pops,
+        "num_generations": num_generations,
+        "demographic_events": events,
+        "loggers": [
+            "allelic_freqs_logger",
+            "pop_size_logger",
+            "genotypic_freqs_logger",
+            "exp_het_logger",
+        ],
+    }
+
+
+def simulate_replicates(sim_definition, num_replicates):
+    for _ in range(num_replicates):
+        OneLocusTwoAlleleSimulation(sim_definition)
+
+
+def run_benchmarks(grid="quick", num_repeats=3):
+    grid = GRIDS[grid]
+    results = []
+    for pop_size, num_generations, num_replicates, num_pops in itertools.product(
+        grid["pop_size"],
+        grid["num_generations"],
+        grid["num_replicates"],
+        grid["num_pops"],
+    ):
+        sim_definition = create_sim_definition(pop_size, num_generations, num_pops)
+        params = {
+            "pop_size": "inf" if pop_size == INF else pop_size,
+            "num_generations": num_generations,
+            "num_replicates": num_replicates,
+            "num_pops": num_pops,
+        }
+        results.append(
+            run_benchmark(
+                SUITE,
+                "OneLocusTwoAlleleSimulation",
+                params,
+                functools.partial(simulate_replicates, sim_definition, num_replicates),
+                num_repeats=num_repeats,
+            )
+        )
+    return results
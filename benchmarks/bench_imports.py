@@ -0,0 +1,81 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+SUITE = "imports"
+APPS_DIR = Path(__file__).parent.parent / "src" / "apps"
+APP_KINDS = ["fwd", "msprime"]
+HEAVY_MODULES = [
+    "pandas",
+    "matplotlib",
+    "matplotlib.pyplot",
+    "msprime",
+    "tskit",
+    "demesdraw",
+    "pynei",
+    "scipy",
+    "statsmodels",
+]
+
+GRIDS = {
+    "quick": {"apps": ["fwd/simple_drift_app", "msprime/bottleneck_app"]},
+    "full": {
+        "apps": sorted(
+            f"{kind}/{app_dir.name}"
+            for kind in APP_KINDS
+            for app_dir in (APPS_DIR / kind).iterdir()
+            if (app_dir / "app.py").exists()
+        )
+    },
+}
+
+# Every import runs in a new interpreter, otherwise the modules imported by a
+# previous run would be cached
+IMPORT_APP_CODE = f"""
+import json, resource, sys, time
+start = time.perf_counter()
+import app
+wall_time = time.perf_counter() - start
+print(json.dumps({{
+    "wall_time_s": wall_time,
+    "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    "loaded_modules": [mod for mod in {HEAVY_MODULES!r} if mod in sys.modules],
+}}))
+"""
+
+
+def import_app(app_dir):
+    process = subprocess.run(
+        [sys.executable, "-c", IMPORT_APP_CODE],
+        cwd=app_dir,
+        capture_output=True,
+        text=True,
+    )
+    if process.returncode:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def run_benchmarks(grid="quick", num_repeats=3):
+    results = []
+    for app in GRIDS[grid]["apps"]:
+        result = {"suite": SUITE, "name": "import app", "params": {"app": app}}
+        try:
+            runs = [import_app(APPS_DIR / app) for _ in range(num_repeats)]
+        except RuntimeError as error:
+            result["error"] = str(error)
+        else:
+            wall_times = [run["wall_time_s"] for run in runs]
+            result.update(
+                {
+                    "wall_time_s": min(wall_times),
+                    "wall_times_s": wall_times,
+                    # the whole interpreter max resident memory, not only the
+                    # python allocations like in the other suites
+                    "peak_memory_bytes": max(run["max_rss_bytes"] for run in runs),
+                    "loaded_modules": runs[0]["loaded_modules"],
+                }
+            )
+        results.append(result)
+    return results
@@ -0,0 +1,96 @@
+import functools
+import itertools
+
+import msprime
+
+from pop_lab.msprime_sim_utils import (
+    SimulationResult,
+    create_msprime_sample_set,
+    simulate,
+)
+
+from measure import run_benchmark
+
+SUITE = "msprime"
+POP_SIZE = 10000
+SPLIT_TIME = 2000
+PLOIDY = 2
+RANDOM_SEED = 42
+
+GRIDS = {
+    "quick": {"seq_length_in_bp": [1e5, 1e6], "num_samples": [20]},
+    "full": {"seq_length_in_bp": [1e5, 1e6, 1e7], "num_samples": [20, 100]},
+}
+
+CALC_METHODS = sorted(
+    name for name in dir(SimulationResult) if name.startswith("calc_")
+)
+
+
+def create_demography_and_samples(num_samples):
+    demography = msprime.Demography()
+    for pop_name in ["pop1", "pop2", "ancestral"]:
+        demography.add_population(name=pop_name, initial_size=POP_SIZE)
+    demography.add_population_split(
+        time=SPLIT_TIME, derived=["pop1", "pop2"], ancestral="ancestral"
+    )
+    sample_sets = [
+        create_msprime_sample_set(
+            num_samples=num_samples, ploidy=PLOIDY, pop_name=pop_name, time=0
+        )
+        for pop_name in ["pop1", "pop2"]
+    ]
+    return demography, sample_sets
+
+
+def do_simulation(sample_sets, demography, seq_length_in_bp):
+    return simulate(
+        sample_sets,
+        demography=demography,
+        model=None,
+        seq_length_in_bp=seq_length_in_bp,
+        random_seed=RANDOM_SEED,
+        ploidy=PLOIDY,
+    )
+
+
+def calc_stat(tree_seqs, sample_sets, demography, method_name):
+    # a new result every time, so the cached stats and intermediates are not
+    # reused and every run includes the genotype decoding
+    sim_res = SimulationResult(tree_seqs, sample_sets, demography, PLOIDY)
+    getattr(sim_res, method_name)()
+
+
+def run_benchmarks(grid="quick", num_repeats=3):
+    grid = GRIDS[grid]
+    results = []
+    for seq_length_in_bp, num_samples in itertools.product(
+        grid["seq_length_in_bp"], grid["num_samples"]
+    ):
+        demography, sample_sets = create_demography_and_samples(num_samples)
+        params = {"seq_length_in_bp": seq_length_in_bp, "num_samples": num_samples}
+
+        simulate_func = functools.partial(
+            do_simulation, sample_sets, demography, seq_length_in_bp
+        )
+        results.append(
+            run_benchmark(
+                SUITE, "simulate", params, simulate_func, num_repeats=num_repeats
+            )
+        )
+
+        tree_seqs = simulate_func().tree_seqs
+        params = {**params, "num_sites": tree_seqs.num_sites}
+        for method_name in CALC_METHODS:
+            results.append(
+                run_benchmark(
+                    SUITE,
+                    f"SimulationResult.{method_name}",
+                    params,
+                    functools.partial(
+                        calc_stat, tree_seqs, sample_sets, demography, method_name
+                    ),
+                    num_repeats=num_repeats,
+                )
+            )
+    return results
@@ -0,0 +1,34 @@
+import time
+import tracemalloc
+
+
+def measure(func, num_repeats=3):
+    # The time is the best of several runs without tracing, the peak memory is
+    # taken in an extra run with tracemalloc, it also tracks numpy allocations
+    wall_times = []
+    for _ in range(num_repeats):
+        start = time.perf_counter()
+        func()
+        wall_times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "wall_time_s": min(wall_times),
+        "wall_times_s": wall_times,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def run_benchmark(suite, name, params, func, num_repeats=3):
+    result = {"suite": suite, "name": name, "params": params}
+    try:
+        result.update(measure(func, num_repeats=num_repeats))
+    except Exception as error:
+        result["error"] = f"{error.__class__.__name__}: {error}"
+    return result
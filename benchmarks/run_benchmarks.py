@@ -0,0 +1,131 @@
+"""Performance benchmarks for the forward in time simulator and the msprime pipeline.
+
+Usage, from the repository root:
+
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --grid full --baseline bench.json
+    python benchmarks/run_benchmarks.py --suite imports
+
+With a baseline the run fails if any benchmark is slower than the baseline by
+more than the allowed factor.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy
+import msprime
+import tskit
+
+import bench_fwd_in_time
+import bench_imports
+import bench_msprime
+
+SUITES = {
+    bench_fwd_in_time.SUITE: bench_fwd_in_time.run_benchmarks,
+    bench_msprime.SUITE: bench_msprime.run_benchmarks,
+    bench_imports.SUITE: bench_imports.run_benchmarks,
+}
+DEF_MAX_SLOWDOWN = 1.25
+
+
+def _get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _create_metadata(grid, num_repeats):
+    return {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "git_commit": _get_git_commit(),
+        "grid": grid,
+        "num_repeats": num_repeats,
+        "python": sys.version,
+        "platform": platform.platform(),
+        "numpy": numpy.__version__,
+        "msprime": msprime.__version__,
+        "tskit": tskit.__version__,
+    }
+
+
+def _get_benchmark_key(result):
+    return (result["suite"], result["name"], json.dumps(result["params"]))
+
+
+def find_regressions(results, baseline_results, max_slowdown=DEF_MAX_SLOWDOWN):
+    baseline_by_key = {
+        _get_benchmark_key(result): result
+        for result in baseline_results
+        if "wall_time_s" in result
+    }
+    regressions = []
+    for result in results:
+        baseline = baseline_by_key.get(_get_benchmark_key(result))
+        if baseline is None or "wall_time_s" not in result:
+            continue
+        slowdown = result["wall_time_s"] / baseline["wall_time_s"]
+        if slowdown > max_slowdown:
+            regressions.append({**result, "slowdown": slowdown})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--grid", choices=["quick", "full"], default="quick")
+    parser.add_argument("--suite", choices=list(SUITES), action="append")
+    parser.add_argument("--num-repeats", type=int, default=3)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--max-slowdown", type=float, default=DEF_MAX_SLOWDOWN)
+    args = parser.parse_args()
+
+    suites = args.suite if args.suite else list(SUITES)
+    results = []
+    for suite in suites:
+        for result in SUITES[suite](grid=args.grid, num_repeats=args.num_repeats):
+            if "error" in result:
+                print(f"{result['name']} {result['params']}: {result['error']}")
+            else:
+                print(
+                    f"{result['name']} {result['params']}: "
+                    f"{result['wall_time_s']:.4f} s, "
+                    f"{result['peak_memory_bytes'] / 1e6:.1f} MB"
+                )
+            results.append(result)
+
+    report = {
+        "metadata": _create_metadata(args.grid, args.num_repeats),
+        "benchmarks": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        regressions = find_regressions(
+            results, baseline["benchmarks"], max_slowdown=args.max_slowdown
+        )
+        for regression in regressions:
+            print(
+                f"Regression: {regression['name']} {regression['params']} "
+                f"is {regression['slowdown']:.2f} times slower"
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
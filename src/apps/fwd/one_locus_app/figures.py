@@ -0,0 +1 @@
+../../../pop_lab/figures.py
\ No newline at end of file
@@ -90,67 +90,92 @@ def demography_input_accordions():
 open_accordion_panels = [POP_SIZE_ACCORDION_ID, NUM_SPLIT_GENERATION_AGO_ID]
 
 
+def create_demography(
+    ancestral_split_generation, admix_generation, pop_sizes, pop_a_proportion
+):
+    proportions = [pop_a_proportion, 1 - pop_a_proportion]
+    assert ancestral_split_generation > admix_generation
+
+    demography = msprime.Demography()
+    demography.add_population(name="pop_a", initial_size=pop_sizes)
+    demography.add_population(name="pop_b", initial_size=pop_sizes)
+    demography.add_population(name="admix", initial_size=pop_sizes)
+    demography.add_population(name="ancestral", initial_size=pop_sizes)
+    demography.add_admixture(
+        time=admix_generation,
+        derived="admix",
+        ancestral=["pop_a", "pop_b"],
+        proportions=proportions,
+    )
+    demography.add_population_split(
+        time=ancestral_split_generation,
+        derived=["pop_a", "pop_b"],
+        ancestral="ancestral",
+    )
+    params = {
+        "Split from ancestral population (generations ago)": ancestral_split_generation,
+        "Admixture (generations ago)": admix_generation,
+        "Pop. sizes": pop_sizes,
+        "Pop. a to pop. b proportion": pop_a_proportion,
+    }
+    return {"demography": demography, "params_for_table": params}
+
+
+def create_sample_sets(admix_generation, num_indis_to_sample):
+    sampling_times = [
+        admix_generation - 1,
+        0,
+    ]
+
+    sample_sets = []
+    for pop in ["pop_a", "pop_b"]:
+        sample_set = msprime_sim_utils.create_msprime_sample_set(
+            num_samples=num_indis_to_sample,
+            ploidy=2,
+            pop_name=pop,
+            time=admix_generation - 1,
+        )
+        sample_sets.append(sample_set)
+    for time in sampling_times:
+        sample_set = msprime_sim_utils.create_msprime_sample_set(
+            num_samples=num_indis_to_sample,
+            ploidy=2,
+            pop_name="admix",
+            time=time,
+        )
+        sample_sets.append(sample_set)
+    return sample_sets
+
+
+def get_default_sim_config(msprime_params):
+    # the simulation with the default inputs, it is precomputed when the site is built
+    res = create_demography(
+        ancestral_split_generation=DEF_ANCESTRAL_SPLIT_GENERATION,
+        admix_generation=DEF_ADMIX_GENERATION,
+        pop_sizes=DEF_POP_SIZE,
+        pop_a_proportion=DEF_POP_A_PROPORTION,
+    )
+    res["sample_sets"] = create_sample_sets(
+        DEF_ADMIX_GENERATION, msprime_params["sample_size"]
+    )
+    return res
+
+
 @module.server
 def demography_server(input, output, session, get_msprime_params):
     @reactive.calc
     def get_demography():
-        ancestral_split_generation = input.ancestral_split_generation_slider()
-        admix_generation = input.admix_generation_slider()
-        pop_sizes = input.pop_size_slider()
-        pop_a_proportion = input.pop_a_proportion_slider()
-        proportions = [pop_a_proportion, 1 - pop_a_proportion]
-        assert ancestral_split_generation > admix_generation
-
-        demography = msprime.Demography()
-        demography.add_population(name="pop_a", initial_size=pop_sizes)
-        demography.add_population(name="pop_b", initial_size=pop_sizes)
-        demography.add_population(name="admix", initial_size=pop_sizes)
-        demography.add_population(name="ancestral", initial_size=pop_sizes)
-        demography.add_admixture(
-            time=admix_generation,
-            derived="admix",
-            ancestral=["pop_a", "pop_b"],
-            proportions=proportions,
-        )
-        demography.add_population_split(
-            time=ancestral_split_generation,
-            derived=["pop_a", "pop_b"],
-            ancestral="ancestral",
+        return create_demography(
+            ancestral_split_generation=input.ancestral_split_generation_slider(),
+            admix_generation=input.admix_generation_slider(),
+            pop_sizes=input.pop_size_slider(),
+            pop_a_proportion=input.pop_a_proportion_slider(),
         )
-        params = {
-            "Split from ancestral population (generations ago)": ancestral_split_generation,
-            "Admixture (generations ago)": admix_generation,
-            "Pop. sizes": pop_sizes,
-            "Pop. a to pop. b proportion": pop_a_proportion,
-        }
-        return {"demography": demography, "params_for_table": params}
 
     @reactive.calc
     def get_sample_sets():
-        admix_generation = input.admix_generation_slider()
-        sampling_times = [
-            admix_generation - 1,
-            0,
-        ]
-
-        num_indis_to_sample = get_msprime_params()["sample_size"]
-        sample_sets = []
-        for pop in ["pop_a", "pop_b"]:
-            sample_set = msprime_sim_utils.create_msprime_sample_set(
-                num_samples=num_indis_to_sample,
-                ploidy=2,
-                pop_name=pop,
-                time=admix_generation - 1,
-            )
-            sample_sets.append(sample_set)
-        for time in sampling_times:
-            sample_set = msprime_sim_utils.create_msprime_sample_set(
-                num_samples=num_indis_to_sample,
-                ploidy=2,
-                pop_name="admix",
-                time=time,
-            )
-            sample_sets.append(sample_set)
-        return sample_sets
+        return create_sample_sets(
+            input.admix_generation_slider(), get_msprime_params()["sample_size"]
+        )
 
     return get_demography, get_sample_sets
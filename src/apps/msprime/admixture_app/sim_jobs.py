@@ -0,0 +1 @@
+../../../pop_lab/sim_jobs.py
\ No newline at end of file
@@ -80,11 +80,69 @@ def demography_input_accordions():
 open_accordion_panels = [BOTTLENECK_ACCORDION_ID, POP_SIZE_ACCORDION_ID]
 
 
+def create_demography(
+    pop_size_before, pop_size_during, pop_size_after, bottleneck_start, bottleneck_end
+):
+    demography = msprime.Demography()
+    demography.add_population(
+        name=POP_NAME, initial_size=pop_size_after, initially_active=True
+    )
+    demography.add_population_parameters_change(
+        time=bottleneck_start, initial_size=pop_size_during
+    )
+    demography.add_population_parameters_change(
+        time=bottleneck_end, initial_size=pop_size_before
+    )
+    params = {
+        "Pop. size before bottleneck": pop_size_before,
+        "Pop. size during bottleneck": pop_size_during,
+        "Pop. size after bottleneck": pop_size_after,
+        "Bottleneck start (generations ago)": bottleneck_end,
+        "Bottleneck end (generations ago)": bottleneck_start,
+    }
+
+    return {"demography": demography, "params_for_table": params}
+
+
+def create_sample_sets(bottleneck_start, bottleneck_end, num_indis_to_sample):
+    sampling_times = [
+        bottleneck_start - 10,
+        bottleneck_start + 1,
+        bottleneck_start - 1,
+        int((bottleneck_end + bottleneck_start) / 2),
+        bottleneck_end + 1,
+        bottleneck_end - 1,
+        0,
+    ]
+
+    sample_sets = []
+    for time in sampling_times:
+        sample_set = msprime_sim_utils.create_msprime_sample_set(
+            num_samples=num_indis_to_sample, ploidy=2, pop_name=POP_NAME, time=time
+        )
+        sample_sets.append(sample_set)
+    return sample_sets
+
+
+def get_default_sim_config(msprime_params):
+    # the simulation with the default inputs, it is precomputed when the site is built
+    bottleneck_start = -DEF_NUM_GENERATIONS_AGO[1]
+    bottleneck_end = -DEF_NUM_GENERATIONS_AGO[0]
+    res = create_demography(
+        pop_size_before=DEF_POP_SIZE,
+        pop_size_during=DEF_BOTTLENECK_SIZE,
+        pop_size_after=DEF_POP_SIZE,
+        bottleneck_start=bottleneck_start,
+        bottleneck_end=bottleneck_end,
+    )
+    res["sample_sets"] = create_sample_sets(
+        bottleneck_start, bottleneck_end, msprime_params["sample_size"]
+    )
+    return res
+
+
 @module.server
 def demography_server(input, output, session, get_msprime_params):
-    def get_pop_name():
-        return POP_NAME
-
     @reactive.calc
     def get_pop_size_before():
         return input.pop_size_before_slider()
@@ -107,52 +165,20 @@ def demography_server(input, output, session, get_msprime_params):
 
     @reactive.calc
     def get_demography():
-        demography = msprime.Demography()
-        pop_name = get_pop_name()
-        start_time = get_bottleneck_start()
-        end_time = get_bottleneck_end()
-        demography.add_population(
-            name=pop_name, initial_size=get_pop_size_after(), initially_active=True
-        )
-        demography.add_population_parameters_change(
-            time=start_time, initial_size=get_pop_size_during()
+        return create_demography(
+            pop_size_before=get_pop_size_before(),
+            pop_size_during=get_pop_size_during(),
+            pop_size_after=get_pop_size_after(),
+            bottleneck_start=get_bottleneck_start(),
+            bottleneck_end=get_bottleneck_end(),
         )
-        demography.add_population_parameters_change(
-            time=end_time, initial_size=get_pop_size_before()
-        )
-        params = {
-            "Pop. size before bottleneck": get_pop_size_before(),
-            "Pop. size during bottleneck": get_pop_size_during(),
-            "Pop. size after bottleneck": get_pop_size_after(),
-            "Bottleneck start (generations ago)": get_bottleneck_end(),
-            "Bottleneck end (generations ago)": get_bottleneck_start(),
-        }
-
-        return {"demography": demography, "params_for_table": params}
 
     @reactive.calc
     def get_sample_sets():
-        pop_name = get_pop_name()
-        start_time = get_bottleneck_start()
-        end_time = get_bottleneck_end()
-
-        sampling_times = [
-            start_time - 10,
-            start_time + 1,
-            start_time - 1,
-            int((end_time + start_time) / 2),
-            end_time + 1,
-            end_time - 1,
-            0,
-        ]
-
-        num_indis_to_sample = get_msprime_params()["sample_size"]
-        sample_sets = []
-        for time in sampling_times:
-            sample_set = msprime_sim_utils.create_msprime_sample_set(
-                num_samples=num_indis_to_sample, ploidy=2, pop_name=pop_name, time=time
-            )
-            sample_sets.append(sample_set)
-        return sample_sets
+        return create_sample_sets(
+            get_bottleneck_start(),
+            get_bottleneck_end(),
+            get_msprime_params()["sample_size"],
+        )
 
     return get_demography, get_sample_sets
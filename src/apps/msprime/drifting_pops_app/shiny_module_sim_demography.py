@@ -81,6 +81,74 @@ open_accordion_panels = [POP_SIZE_ACCORDION_ID, NUM_SPLIT_GENERATION_AGO_ID]
 ANCESTRAL_POP_NAME = "ancestral"
 
 
+def create_demography(pop_sizes, split_generation):
+    demography = msprime.Demography()
+    demography.add_population(
+        name=ANCESTRAL_POP_NAME, initial_size=pop_sizes[ANCESTRAL_POP_NAME]
+    )
+
+    drifting_pops_sizes = {
+        pop: size for pop, size in pop_sizes.items() if pop != ANCESTRAL_POP_NAME
+    }
+
+    derived_pops = []
+    for pop_name, size in drifting_pops_sizes.items():
+        demography.add_population(name=pop_name, initial_size=size)
+        derived_pops.append(pop_name)
+
+    demography.add_population_split(
+        split_generation,
+        derived=derived_pops,
+        ancestral=ANCESTRAL_POP_NAME,
+    )
+
+    params = {f"{ANCESTRAL_POP_NAME} pop. size": pop_sizes[ANCESTRAL_POP_NAME]}
+    params.update(
+        {f"{pop} pop. size": size for pop, size in drifting_pops_sizes.items()}
+    )
+    params[f"Split from {ANCESTRAL_POP_NAME} pop. (num. generations ago)"] = (
+        split_generation
+    )
+
+    return {"demography": demography, "params_for_table": params}
+
+
+def create_sample_sets(split_generation, demography, num_indis_to_sample):
+    sampling_times = [
+        split_generation - 1,
+        split_generation // 2,
+        0,
+    ]
+
+    pops_info = msprime_sim_utils.get_info_from_demography(demography)["pops"]
+    pop_names = sorted(
+        pop_name for pop_name in pops_info.keys() if pop_name != ANCESTRAL_POP_NAME
+    )
+
+    sample_sets = []
+    for time in sampling_times:
+        for pop_name in pop_names:
+            sample_set = msprime_sim_utils.create_msprime_sample_set(
+                num_samples=num_indis_to_sample,
+                ploidy=2,
+                pop_name=pop_name,
+                time=time,
+            )
+            sample_sets.append(sample_set)
+    return sample_sets
+
+
+def get_default_sim_config(msprime_params):
+    # the simulation with the default inputs, it is precomputed when the site is built
+    pop_sizes = {pop_name: DEF_POP_SIZE for pop_name in POP_NAMES}
+    pop_sizes[ANCESTRAL_POP_NAME] = DEF_POP_SIZE
+    res = create_demography(pop_sizes, DEF_GENERATION_POP_SPLIT)
+    res["sample_sets"] = create_sample_sets(
+        DEF_GENERATION_POP_SPLIT, res["demography"], msprime_params["sample_size"]
+    )
+    return res
+
+
 @module.server
 def demography_server(input, output, session, get_msprime_params):
     @reactive.calc
@@ -107,64 +175,14 @@ def demography_server(input, output, session, get_msprime_params):
 
     @reactive.calc
     def get_demography():
-        pop_sizes = get_pop_sizes()
-        demography = msprime.Demography()
-        demography.add_population(
-            name=ANCESTRAL_POP_NAME, initial_size=pop_sizes[ANCESTRAL_POP_NAME]
-        )
-
-        drifting_pops_sizes = {
-            pop: size for pop, size in pop_sizes.items() if pop != ANCESTRAL_POP_NAME
-        }
-
-        derived_pops = []
-        for pop_name, size in drifting_pops_sizes.items():
-            demography.add_population(name=pop_name, initial_size=size)
-            derived_pops.append(pop_name)
-
-        demography.add_population_split(
-            input.num_generations_ago_split(),
-            derived=derived_pops,
-            ancestral=ANCESTRAL_POP_NAME,
-        )
-
-        params = {f"{ANCESTRAL_POP_NAME} pop. size": pop_sizes[ANCESTRAL_POP_NAME]}
-        params.update(
-            {f"{pop} pop. size": size for pop, size in drifting_pops_sizes.items()}
-        )
-        params[f"Split from {ANCESTRAL_POP_NAME} pop. (num. generations ago)"] = (
-            input.num_generations_ago_split()
-        )
-
-        return {"demography": demography, "params_for_table": params}
+        return create_demography(get_pop_sizes(), input.num_generations_ago_split())
 
     @reactive.calc
     def get_sample_sets():
-        split_time = input.num_generations_ago_split()
-        sampling_times = [
-            split_time - 1,
-            split_time // 2,
-            0,
-        ]
-
-        pops_info = msprime_sim_utils.get_info_from_demography(
-            get_demography()["demography"]
-        )["pops"]
-        pop_names = sorted(
-            pop_name for pop_name in pops_info.keys() if pop_name != ANCESTRAL_POP_NAME
+        return create_sample_sets(
+            input.num_generations_ago_split(),
+            get_demography()["demography"],
+            get_msprime_params()["sample_size"],
         )
 
-        num_indis_to_sample = get_msprime_params()["sample_size"]
-        sample_sets = []
-        for time in sampling_times:
-            for pop_name in pop_names:
-                sample_set = msprime_sim_utils.create_msprime_sample_set(
-                    num_samples=num_indis_to_sample,
-                    ploidy=2,
-                    pop_name=pop_name,
-                    time=time,
-                )
-                sample_sets.append(sample_set)
-        return sample_sets
-
     return get_demography, get_sample_sets
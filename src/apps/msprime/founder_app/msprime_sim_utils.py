@@ -0,0 +1 @@
+../../../pop_lab/msprime_sim_utils.py
\ No newline at end of file
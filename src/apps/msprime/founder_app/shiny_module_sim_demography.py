@@ -104,68 +104,96 @@ def demography_input_accordions():
 open_accordion_panels = [POP_SIZE_ACCORDION_ID, NUM_SPLIT_GENERATION_AGO_ID]
 
 
+def create_demography(
+    orig_pop_size, num_founders, split_pop_size, founding_time, bottleneck_time
+):
+    demography = msprime.Demography()
+    demography.add_population(
+        name="orig_pop", initial_size=orig_pop_size, initially_active=True
+    )
+    demography.add_population(
+        name="split_pop", initial_size=split_pop_size, initially_active=True
+    )
+
+    time_full_size = founding_time - bottleneck_time
+    demography.add_population_parameters_change(
+        time=time_full_size,
+        initial_size=num_founders,
+        population="split_pop",
+    )
+    demography.add_population_split(
+        founding_time,
+        derived=["split_pop"],
+        ancestral="orig_pop",
+    )
+    params = {
+        "Original pop. size": orig_pop_size,
+        "Num. founder individuals": num_founders,
+        "Split pop. size": split_pop_size,
+        "Founding time (generation ago)": founding_time,
+        "Bottleneck duration (num. generations)": bottleneck_time,
+    }
+
+    return {"demography": demography, "params_for_table": params}
+
+
+def create_sample_sets(founding_time, bottleneck_duration, num_indis_to_sample):
+    time_full_size = founding_time - bottleneck_duration
+    sampling_times = [
+        founding_time - 1,
+        time_full_size + 1,
+        time_full_size - 1,
+        0,
+    ]
+
+    sample_sets = []
+    for time in sampling_times:
+        for pop in ["orig_pop", "split_pop"]:
+            sample_set = msprime_sim_utils.create_msprime_sample_set(
+                num_samples=num_indis_to_sample,
+                ploidy=2,
+                pop_name=pop,
+                time=time,
+            )
+            sample_sets.append(sample_set)
+    return sample_sets
+
+
+def get_default_sim_config(msprime_params):
+    # the simulation with the default inputs, it is precomputed when the site is built
+    res = create_demography(
+        orig_pop_size=DEF_POP_SIZE,
+        num_founders=DEF_NUM_FOUNDER_INDIS,
+        split_pop_size=DEF_POP_SIZE,
+        founding_time=DEF_GENERATION_POP_SPLIT,
+        bottleneck_time=DEF_BOTTLENECK_DURATION,
+    )
+    res["sample_sets"] = create_sample_sets(
+        DEF_GENERATION_POP_SPLIT,
+        DEF_BOTTLENECK_DURATION,
+        msprime_params["sample_size"],
+    )
+    return res
+
+
 @module.server
 def demography_server(input, output, session, get_msprime_params):
     @reactive.calc
     def get_demography():
-        orig_pop_size = input.original_pop_size_slider()
-        num_founders = input.num_founder_indis_slider()
-        split_pop_size = input.split_pop_size_slider()
-        founding_time = input.num_generations_ago_split()
-        bottleneck_time = input.bottleneck_duration_slider()
-
-        demography = msprime.Demography()
-        demography.add_population(
-            name="orig_pop", initial_size=orig_pop_size, initially_active=True
-        )
-        demography.add_population(
-            name="split_pop", initial_size=split_pop_size, initially_active=True
-        )
-
-        time_full_size = founding_time - bottleneck_time
-        demography.add_population_parameters_change(
-            time=time_full_size,
-            initial_size=num_founders,
-            population="split_pop",
-        )
-        demography.add_population_split(
-            founding_time,
-            derived=["split_pop"],
-            ancestral="orig_pop",
+        return create_demography(
+            orig_pop_size=input.original_pop_size_slider(),
+            num_founders=input.num_founder_indis_slider(),
+            split_pop_size=input.split_pop_size_slider(),
+            founding_time=input.num_generations_ago_split(),
+            bottleneck_time=input.bottleneck_duration_slider(),
         )
-        params = {
-            "Original pop. size": orig_pop_size,
-            "Num. founder individuals": num_founders,
-            "Split pop. size": split_pop_size,
-            "Founding time (generation ago)": founding_time,
-            "Bottleneck duration (num. generations)": bottleneck_time,
-        }
-
-        return {"demography": demography, "params_for_table": params}
 
     @reactive.calc
     def get_sample_sets():
-        bottleneck_duration = input.bottleneck_duration_slider()
-        founding_time = input.num_generations_ago_split()
-        time_full_size = founding_time - bottleneck_duration
-        sampling_times = [
-            founding_time - 1,
-            time_full_size + 1,
-            time_full_size - 1,
-            0,
-        ]
-
-        num_indis_to_sample = get_msprime_params()["sample_size"]
-        sample_sets = []
-        for time in sampling_times:
-            for pop in ["orig_pop", "split_pop"]:
-                sample_set = msprime_sim_utils.create_msprime_sample_set(
-                    num_samples=num_indis_to_sample,
-                    ploidy=2,
-                    pop_name=pop,
-                    time=time,
-                )
-                sample_sets.append(sample_set)
-        return sample_sets
+        return create_sample_sets(
+            input.num_generations_ago_split(),
+            input.bottleneck_duration_slider(),
+            get_msprime_params()["sample_size"],
+        )
 
     return get_demography, get_sample_sets
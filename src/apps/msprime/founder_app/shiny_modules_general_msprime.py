@@ -0,0 +1 @@
+../../../pop_lab/shiny_modules_general_msprime.py
\ No newline at end of file
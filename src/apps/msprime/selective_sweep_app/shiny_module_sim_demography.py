@@ -11,6 +11,8 @@ MIN_POP_A_PROPORTION = 0
 MAX_POP_A_PROPORTION = 1
 DEF_POP_A_PROPORTION = 0.5
 
+DEF_SELECTION_COEF = 1
+
 MIN_SEQ_LENGTH = 5e5
 MAX_SEQ_LENGTH = 10e6
 DEF_SEQ_LENGTH = 4e6
@@ -44,7 +46,7 @@ def demography_input_accordions():
         label="selection coeff. of the beneficial mutation",
         min=0,
         max=1,
-        value=1,
+        value=DEF_SELECTION_COEF,
         width="100%",
     )
 
@@ -61,71 +63,91 @@ def demography_input_accordions():
 open_accordion_panels = [POP_SIZE_ACCORDION_ID, NUM_SPLIT_GENERATION_AGO_ID]
 
 
+def create_demography(pop_size, selection_coef, seq_length):
+    sweep_mod_time = 100
+
+    demography = msprime.Demography()
+    demography.add_population(name="pop", initial_size=pop_size)
+
+    start_frequency = 1.0 / (2 * pop_size)
+    end_frequency = 1.0 - (1.0 / (2 * pop_size))
+    start_frequency = 0.0001
+    end_frequency = 0.9
+    s = selection_coef
+    s = 0.9
+    # dt is the small increment of time for stepping through the sweep phase of the model.
+    # a good rule of thumb is for this to be approximately or smaller
+    dt = 1e-6
+
+    # The strength of selection during the sweep is determined by the parameter s
+    # Here we define s such that the fitness of the three genotypes at our beneficial locus are
+    # wBB = 1, wBb = 1 + s/2, wbb = 1+s
+    if s > 0:
+        mod = msprime.SweepGenicSelection(
+            position=int(seq_length * 0.5),
+            start_frequency=start_frequency,
+            end_frequency=end_frequency,
+            s=s,
+            dt=dt,
+        )
+        mod_list = [
+            msprime.StandardCoalescent(duration=80),
+            mod,
+            msprime.StandardCoalescent(),
+        ]
+    else:
+        mod_list = ["hudson"]
+    print(mod_list)
+    # append final model
+    # mod_list.append("hudson")
+
+    params = {
+        "Pop. size": pop_size,
+        "selection coef.": selection_coef,
+    }
+
+    return {"demography": demography, "model": mod_list, "params_for_table": params}
+
+
+def create_sample_sets(num_indis_to_sample):
+    sampling_times = [200, 0]
+
+    sample_sets = []
+    for time in sampling_times:
+        for pop in ["pop"]:
+            sample_set = msprime_sim_utils.create_msprime_sample_set(
+                num_samples=num_indis_to_sample,
+                ploidy=2,
+                pop_name=pop,
+                time=time,
+            )
+            sample_sets.append(sample_set)
+    return sample_sets
+
+
+def get_default_sim_config(msprime_params):
+    # the simulation with the default inputs, it is precomputed when the site is built
+    res = create_demography(
+        pop_size=DEF_POP_SIZE,
+        selection_coef=DEF_SELECTION_COEF,
+        seq_length=msprime_params["seq_length_in_bp"],
+    )
+    res["sample_sets"] = create_sample_sets(msprime_params["sample_size"])
+    return res
+
+
 @module.server
 def demography_server(input, output, session, get_msprime_params):
     @reactive.calc
     def get_demography():
-        pop_size = input.pop_size_slider()
-        sweep_mod_time = 100
-        seq_length = get_msprime_params()["seq_length_in_bp"]
-
-        demography = msprime.Demography()
-        demography.add_population(name="pop", initial_size=pop_size)
-
-        start_frequency = 1.0 / (2 * pop_size)
-        end_frequency = 1.0 - (1.0 / (2 * pop_size))
-        start_frequency = 0.0001
-        end_frequency = 0.9
-        s = input.selection_coef_slider()
-        s = 0.9
-        # dt is the small increment of time for stepping through the sweep phase of the model.
-        # a good rule of thumb is for this to be approximately or smaller
-        dt = 1e-6
-
-        # The strength of selection during the sweep is determined by the parameter s
-        # Here we define s such that the fitness of the three genotypes at our beneficial locus are
-        # wBB = 1, wBb = 1 + s/2, wbb = 1+s
-        if s > 0:
-            mod = msprime.SweepGenicSelection(
-                position=int(seq_length * 0.5),
-                start_frequency=start_frequency,
-                end_frequency=end_frequency,
-                s=s,
-                dt=dt,
-            )
-            mod_list = [
-                msprime.StandardCoalescent(duration=80),
-                mod,
-                msprime.StandardCoalescent(),
-            ]
-        else:
-            mod_list = ["hudson"]
-        print(mod_list)
-        # append final model
-        # mod_list.append("hudson")
-
-        params = {
-            "Pop. size": pop_size,
-            "selection coef.": input.selection_coef_slider(),
-        }
-
-        return {"demography": demography, "model": mod_list, "params_for_table": params}
+        return create_demography(
+            pop_size=input.pop_size_slider(),
+            selection_coef=input.selection_coef_slider(),
+            seq_length=get_msprime_params()["seq_length_in_bp"],
+        )
 
     @reactive.calc
     def get_sample_sets():
-        sampling_times = [200, 0]
-
-        num_indis_to_sample = get_msprime_params()["sample_size"]
-        sample_sets = []
-        for time in sampling_times:
-            for pop in ["pop"]:
-                sample_set = msprime_sim_utils.create_msprime_sample_set(
-                    num_samples=num_indis_to_sample,
-                    ploidy=2,
-                    pop_name=pop,
-                    time=time,
-                )
-                sample_sets.append(sample_set)
-        return sample_sets
+        return create_sample_sets(get_msprime_params()["sample_size"])
 
     return get_demography, get_sample_sets
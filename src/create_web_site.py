@@ -1,5 +1,14 @@
 from pathlib import Path
+import argparse
+import ast
+import base64
+import hashlib
+import json
+import os
 import shutil
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from subprocess import run
 
 PROJECT_DIR = Path(__file__).parent.parent
@@ -7,6 +16,25 @@ OUTPUT_SITE_SPHINX_DIR = PROJECT_DIR / "built_site"
 OUTPUT_HTML_DIR = OUTPUT_SITE_SPHINX_DIR / "html"
 POPLAB_SPHINX_SRC_DIR = PROJECT_DIR / "pop_lab_site"
 APPS_SRC_DIR = PROJECT_DIR / "src" / "apps"
+SHARED_MODULES_DIR = PROJECT_DIR / "src" / "pop_lab"
+STAGED_APPS_DIR = OUTPUT_SITE_SPHINX_DIR / "staged_apps"
+BUILD_MANIFEST_PATH = OUTPUT_SITE_SPHINX_DIR / "apps_manifest.json"
+# the default results are only simulated again if the app has changed
+RESULT_BUNDLES_CACHE_DIR = OUTPUT_SITE_SPHINX_DIR / "result_bundles"
+# the apps that use this module show the msprime results
+RESULTS_MODULE = "shiny_modules_general_msprime"
+RESULT_BUNDLE_FNAME = "default_result_bundle.pickle"
+# the locked shinylive and pyodide versions also change the exported apps
+UV_LOCK_PATH = PROJECT_DIR / "uv.lock"
+WHEELS_DIR_NAME = "wheels"
+WHEELS_OUTPUT_DIR = OUTPUT_HTML_DIR / WHEELS_DIR_NAME
+# the dates of the files in the wheel are fixed, so the same modules always
+# create the same wheel, byte by byte
+WHEEL_FILES_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+SHARED_WHEEL_DIST_NAME = "pop_lab_shared"
+SHARED_WHEEL_VERSION = "0.1.0"
+# provided by shinylive itself
+SHINYLIVE_PROVIDED_MODULES = {"shiny", "htmltools"}
 FWD_APPS_SRC_DIR = APPS_SRC_DIR / "fwd"
 FWD_APP_NAMES = [
     "balancing_selection",
@@ -38,26 +66,355 @@ def create_sphinx_site():
     run(cmd, check=True)
 
 
-def create_apps(app_names, apps_src_base_dir, output_base_dir):
-    for app_name in app_names:
-        app_dir = apps_src_base_dir / f"{app_name}_app"
-        output_dir = output_base_dir / app_name
-        if output_dir.exists():
-            shutil.rmtree(output_dir)
-        cmd = ["uv", "run", "shinylive", "export", str(app_dir), str(output_dir)]
-        run(cmd, check=True)
+def get_imported_modules(path):
+    # the lazy imports done inside the functions are also included
+    imported = set()
+    for node in ast.walk(ast.parse(path.read_text(), filename=str(path))):
+        if isinstance(node, ast.Import):
+            imported.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and not node.level:
+            imported.add(node.module.split(".")[0])
+    return imported
 
 
-if OUTPUT_SITE_SPHINX_DIR.exists():
-    shutil.rmtree(OUTPUT_SITE_SPHINX_DIR)
+def get_app_dependencies(app_dir):
+    # The app files that are not links to the shared modules stay in the app,
+    # the shared modules are those imported, directly or by another shared
+    # module, that are found in the pop_lab dir
+    local_modules = set()
+    for path in app_dir.glob("*.py"):
+        if path.name == "app.py" or path.resolve().parent != SHARED_MODULES_DIR:
+            local_modules.add(path.stem)
 
-OUTPUT_HTML_DIR.mkdir(parents=True)
-create_apps(FWD_APP_NAMES, FWD_APPS_SRC_DIR, OUTPUT_HTML_DIR)
-create_apps(MSPRIME_APPS, MSPRIME_APPS_SRC_DIR, OUTPUT_HTML_DIR)
-create_sphinx_site()
+    shared_modules = set()
+    external_modules = set()
+    paths_to_visit = [app_dir / f"{module}.py" for module in local_modules]
+    while paths_to_visit:
+        path = paths_to_visit.pop()
+        is_shared = path.parent == SHARED_MODULES_DIR
+        for module in get_imported_modules(path):
+            if module in local_modules or module in shared_modules:
+                continue
+            if (SHARED_MODULES_DIR / f"{module}.py").exists():
+                shared_modules.add(module)
+                paths_to_visit.append(SHARED_MODULES_DIR / f"{module}.py")
+            elif is_shared and module not in sys.stdlib_module_names:
+                # the imports of the local modules are found by shinylive, but
+                # not those of the modules moved to the wheel
+                external_modules.add(module)
+    return {
+        "local_modules": sorted(local_modules),
+        "shared_modules": sorted(shared_modules),
+        "external_modules": sorted(external_modules - SHINYLIVE_PROVIDED_MODULES),
+    }
 
-SERVE_CMD = (
-    f"uv run python -m http.server --directory {OUTPUT_HTML_DIR} --bind localhost 8008"
-)
-print("You can serve the web site with the command:")
-print(SERVE_CMD)
+
+def _create_wheel_record_line(path_in_wheel, content):
+    digest = hashlib.sha256(content).digest()
+    digest = base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+    return f"{path_in_wheel},sha256={digest},{len(content)}"
+
+
+def create_shared_modules_wheel(modules, requirements, output_dir):
+    # A pure python wheel with the shared modules at the top level, so the
+    # apps keep importing them by their module name.
+    # The content hash is in the version, so the browsers do not use a cached
+    # wheel with an old version of the modules
+    contents = {
+        f"{module}.py": (SHARED_MODULES_DIR / f"{module}.py").read_bytes()
+        for module in modules
+    }
+    content_hash = hashlib.sha256()
+    for path_in_wheel, content in contents.items():
+        content_hash.update(path_in_wheel.encode())
+        content_hash.update(content)
+    version = f"{SHARED_WHEEL_VERSION}+{content_hash.hexdigest()[:12]}"
+
+    dist_info_dir = f"{SHARED_WHEEL_DIST_NAME}-{version}.dist-info"
+    metadata = [
+        "Metadata-Version: 2.1",
+        f"Name: {SHARED_WHEEL_DIST_NAME}",
+        f"Version: {version}",
+    ]
+    metadata.extend(f"Requires-Dist: {requirement}" for requirement in requirements)
+    contents[f"{dist_info_dir}/METADATA"] = ("\n".join(metadata) + "\n").encode()
+    contents[f"{dist_info_dir}/WHEEL"] = (
+        "Wheel-Version: 1.0\n"
+        "Generator: create_web_site\n"
+        "Root-Is-Purelib: true\n"
+        "Tag: py3-none-any\n"
+    ).encode()
+    contents[f"{dist_info_dir}/top_level.txt"] = ("\n".join(modules) + "\n").encode()
+
+    record_path = f"{dist_info_dir}/RECORD"
+    record = [
+        _create_wheel_record_line(path_in_wheel, content)
+        for path_in_wheel, content in contents.items()
+    ]
+    record.append(f"{record_path},,")
+
+    wheel_path = output_dir / f"{SHARED_WHEEL_DIST_NAME}-{version}-py3-none-any.whl"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    contents[record_path] = ("\n".join(record) + "\n").encode()
+    with zipfile.ZipFile(wheel_path, "w") as wheel:
+        for path_in_wheel, content in contents.items():
+            file_info = zipfile.ZipInfo(path_in_wheel, date_time=WHEEL_FILES_DATE_TIME)
+            file_info.compress_type = zipfile.ZIP_DEFLATED
+            file_info.external_attr = 0o644 << 16
+            wheel.writestr(file_info, content)
+    return wheel_path
+
+
+def _read_requirements(app_dir):
+    path = app_dir / "requirements.txt"
+    if not path.exists():
+        return []
+    lines = (line.strip() for line in path.read_text().splitlines())
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def stage_app(app_dir, staged_app_dir, dependencies, wheel_url):
+    # the staged app has the app own files, the shared modules are installed
+    # from the wheel
+    shared_files = {f"{module}.py" for module in dependencies["shared_modules"]}
+    staged_app_dir.mkdir(parents=True)
+    for path in app_dir.iterdir():
+        if path.is_file() and path.name not in shared_files:
+            shutil.copyfile(path, staged_app_dir / path.name)
+
+    requirements = _read_requirements(app_dir)
+    for module in dependencies["external_modules"]:
+        if module not in requirements:
+            requirements.append(module)
+    requirements.append(wheel_url)
+    (staged_app_dir / "requirements.txt").write_text("\n".join(requirements) + "\n")
+
+
+def stage_apps(app_dirs, site_url):
+    # The apps that use the same set of shared modules share one wheel, the
+    # browser downloads and compiles it once for all of them.
+    # micropip installs the wheels from the site url, the url in which the html
+    # dir is served, for instance /pop_lab/ in a GitHub Pages project site.
+    # All the current wheels are created again, so the old ones are removed
+    for path in (STAGED_APPS_DIR, WHEELS_OUTPUT_DIR):
+        if path.exists():
+            shutil.rmtree(path)
+
+    dependencies_per_app = {
+        app_dir: get_app_dependencies(app_dir) for app_dir in app_dirs
+    }
+    wheel_urls = {}
+    staged_apps = {}
+    for app_dir, dependencies in dependencies_per_app.items():
+        modules = tuple(dependencies["shared_modules"])
+        if modules not in wheel_urls:
+            wheel_path = create_shared_modules_wheel(
+                modules, dependencies["external_modules"], WHEELS_OUTPUT_DIR
+            )
+            wheel_urls[modules] = (
+                f"{site_url.rstrip('/')}/{WHEELS_DIR_NAME}/{wheel_path.name}"
+            )
+        staged_app_dir = STAGED_APPS_DIR / app_dir.parent.name / app_dir.name
+        stage_app(app_dir, staged_app_dir, dependencies, wheel_urls[modules])
+        staged_apps[app_dir] = {
+            "staged_app_dir": staged_app_dir,
+            "wheel_url": wheel_urls[modules],
+            "has_results": RESULTS_MODULE in dependencies["shared_modules"],
+        }
+    return staged_apps
+
+
+def calc_app_hash(staged_app_dir):
+    # The staged app requirements include the wheel url, and its version is the
+    # hash of the shared modules, so a change in them changes the app hash too
+    content_hash = hashlib.sha256()
+    for path in sorted(staged_app_dir.rglob("*")):
+        if path.is_file():
+            content_hash.update(str(path.relative_to(staged_app_dir)).encode())
+            content_hash.update(path.read_bytes())
+    if UV_LOCK_PATH.exists():
+        content_hash.update(UV_LOCK_PATH.read_bytes())
+    return content_hash.hexdigest()
+
+
+def create_default_result_bundle(staged_app_dir, bundle_path):
+    # The default simulation runs natively with the shared modules from the
+    # source dir, the bundle is written in the staged app and then copied
+    env = os.environ.copy()
+    python_path = [str(staged_app_dir), str(SHARED_MODULES_DIR)]
+    if env.get("PYTHONPATH"):
+        python_path.append(env["PYTHONPATH"])
+    env["PYTHONPATH"] = os.pathsep.join(python_path)
+    code = f"import {RESULTS_MODULE}; {RESULTS_MODULE}.save_default_result_bundle()"
+    run([sys.executable, "-c", code], cwd=staged_app_dir, env=env, check=True)
+    shutil.copyfile(staged_app_dir / RESULT_BUNDLE_FNAME, bundle_path)
+    return bundle_path
+
+
+def add_default_result_bundles(apps, staged_apps, num_processes=None):
+    # Every app that shows msprime results gets the result of its default
+    # parameters, so the browser does not have to simulate them
+    RESULT_BUNDLES_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    bundles_to_create = {}
+    bundle_paths = {}
+    for app_name, app_dir in apps.items():
+        staged_app = staged_apps[app_dir]
+        if not staged_app["has_results"]:
+            continue
+        app_hash = calc_app_hash(staged_app["staged_app_dir"])
+        bundle_path = RESULT_BUNDLES_CACHE_DIR / f"{app_name}-{app_hash}.pickle"
+        bundle_paths[app_name] = bundle_path
+        if not bundle_path.exists():
+            bundles_to_create[app_name] = bundle_path
+
+    if bundles_to_create:
+        with ProcessPoolExecutor(max_workers=num_processes) as executor:
+            futures = [
+                executor.submit(
+                    create_default_result_bundle,
+                    staged_apps[apps[app_name]]["staged_app_dir"],
+                    bundle_path,
+                )
+                for app_name, bundle_path in bundles_to_create.items()
+            ]
+            for future in as_completed(futures):
+                future.result()
+
+    for app_name, bundle_path in bundle_paths.items():
+        staged_app_dir = staged_apps[apps[app_name]]["staged_app_dir"]
+        shutil.copyfile(bundle_path, staged_app_dir / RESULT_BUNDLE_FNAME)
+
+    # the bundles of previous versions of the apps are not needed anymore
+    for path in RESULT_BUNDLES_CACHE_DIR.glob("*.pickle"):
+        if path not in bundle_paths.values():
+            path.unlink()
+
+
+def _read_build_manifest():
+    if not BUILD_MANIFEST_PATH.exists():
+        return {}
+    return json.loads(BUILD_MANIFEST_PATH.read_text())
+
+
+def export_app(staged_app_dir, app_name, output_base_dir):
+    # All the apps are exported to the same dir, so they share the shinylive
+    # assets and the pyodide packages
+    output_dir = output_base_dir / app_name
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    cmd = [
+        "uv",
+        "run",
+        "shinylive",
+        "export",
+        str(staged_app_dir),
+        str(output_base_dir),
+        "--subdir",
+        app_name,
+    ]
+    run(cmd, check=True)
+    return app_name
+
+
+def create_apps(apps, staged_apps, output_base_dir, num_processes=None, clean=False):
+    # Only the apps whose source has changed since the last build are
+    # exported.
+    # The first export of every wheel group is done before the rest because
+    # it copies the shinylive assets and the packages that the group needs,
+    # the rest of the exports run in parallel and find them already copied
+    manifest = {} if clean else _read_build_manifest()
+    app_hashes = {}
+    apps_to_export = []
+    for app_name, app_dir in apps.items():
+        staged_app = staged_apps[app_dir]
+        app_hash = calc_app_hash(staged_app["staged_app_dir"])
+        app_hashes[app_name] = app_hash
+        if manifest.get(app_name) == app_hash and (output_base_dir / app_name).exists():
+            print(f"{app_name} is up to date")
+            continue
+        apps_to_export.append(app_name)
+
+    def export_done(app_name):
+        manifest[app_name] = app_hashes[app_name]
+        BUILD_MANIFEST_PATH.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+
+    first_exports = {}
+    for app_name in apps_to_export:
+        first_exports.setdefault(staged_apps[apps[app_name]]["wheel_url"], app_name)
+    for app_name in first_exports.values():
+        export_app(
+            staged_apps[apps[app_name]]["staged_app_dir"], app_name, output_base_dir
+        )
+        export_done(app_name)
+
+    remaining_apps = [
+        app_name
+        for app_name in apps_to_export
+        if app_name not in first_exports.values()
+    ]
+    if not remaining_apps:
+        return
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        futures = [
+            executor.submit(
+                export_app,
+                staged_apps[apps[app_name]]["staged_app_dir"],
+                app_name,
+                output_base_dir,
+            )
+            for app_name in remaining_apps
+        ]
+        for future in as_completed(futures):
+            export_done(future.result())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the pop_lab web site")
+    parser.add_argument(
+        "--site-url",
+        required=True,
+        help="url or path in which the site is served, like / or /pop_lab/",
+    )
+    parser.add_argument(
+        "--clean", action="store_true", help="remove the previous build first"
+    )
+    parser.add_argument(
+        "--num-processes", type=int, help="number of parallel app exports"
+    )
+    args = parser.parse_args()
+
+    if args.clean and OUTPUT_SITE_SPHINX_DIR.exists():
+        shutil.rmtree(OUTPUT_SITE_SPHINX_DIR)
+    OUTPUT_HTML_DIR.mkdir(parents=True, exist_ok=True)
+
+    apps = {
+        app_name: FWD_APPS_SRC_DIR / f"{app_name}_app" for app_name in FWD_APP_NAMES
+    }
+    apps.update(
+        {
+            app_name: MSPRIME_APPS_SRC_DIR / f"{app_name}_app"
+            for app_name in MSPRIME_APPS
+        }
+    )
+    staged_apps = stage_apps(list(apps.values()), args.site_url)
+    add_default_result_bundles(apps, staged_apps, num_processes=args.num_processes)
+    create_apps(
+        apps,
+        staged_apps,
+        OUTPUT_HTML_DIR,
+        num_processes=args.num_processes,
+        clean=args.clean,
+    )
+    # sphinx only rebuilds the pages that have changed
+    create_sphinx_site()
+
+    serve_cmd = f"uv run python -m http.server --directory {OUTPUT_HTML_DIR} --bind localhost 8008"
+    print("You can serve the web site with the command:")
+    print(serve_cmd)
+    if args.site_url != "/":
+        print(f"The apps install their wheels from {args.site_url}, build it with")
+        print("--site-url / to serve it locally")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import numpy
+
+
+class PersistentFigure:
+    # A figure kept for all the renders of an output. The lines are updated in
+    # place, so a render does not create a new figure with new artists.
+    # The figure is not created with pyplot, so it is not kept alive by pyplot
+    # and it is released once closed.
+    # The title and axis labels do not change between renders, they are only
+    # set when the axes are created
+    def __init__(self, title=None, xlabel=None, ylabel=None):
+        # matplotlib is slow to import, specially in pyodide, so it is only
+        # imported when the first plot is rendered
+        from matplotlib.figure import Figure
+
+        self.fig = Figure()
+        self._axes_labels = {"title": title, "xlabel": xlabel, "ylabel": ylabel}
+        self._create_axes()
+
+    def _create_axes(self):
+        labels = {
+            label: text for label, text in self._axes_labels.items() if text is not None
+        }
+        self.axes = self.fig.add_subplot(**labels)
+        self._lines = {}
+        self._line_collections = {}
+        self._legend_styles = None
+
+    def clear(self):
+        # For the plots that are not lines, like scatters, images or colorbars,
+        # they are drawn again in the same figure
+        self.fig.clear()
+        self._create_axes()
+        return self.axes
+
+    def update_lines(self, lines=None, line_collections=None, legend=False):
+        # lines: {key: {"xs": xs, "ys": ys, "style": style}}
+        # line_collections: {key: {"segments": segments, "style": style}},
+        # one collection for many lines with the same style, like the replicates
+        # The artists of the keys already plotted are updated, the ones of the
+        # missing keys removed.
+        # The legend is only created again when the styles of the lines change,
+        # its handles are copies of the lines made when it is created
+        from matplotlib.collections import LineCollection
+
+        if lines is None:
+            lines = {}
+        if line_collections is None:
+            line_collections = {}
+        axes = self.axes
+
+        for key in set(self._lines).difference(lines):
+            self._lines.pop(key).remove()
+        for key, line in lines.items():
+            if key in self._lines:
+                artist = self._lines[key]
+                artist.set_data(line["xs"], line["ys"])
+                artist.set(**line["style"])
+            else:
+                (artist,) = axes.plot(line["xs"], line["ys"], **line["style"])
+                self._lines[key] = artist
+
+        for key in set(self._line_collections).difference(line_collections):
+            self._line_collections.pop(key).remove()
+        for key, collection in line_collections.items():
+            if key in self._line_collections:
+                artist = self._line_collections[key]
+                artist.set_segments(collection["segments"])
+                artist.set(**collection["style"])
+            else:
+                artist = LineCollection(collection["segments"], **collection["style"])
+                axes.add_collection(artist)
+                self._line_collections[key] = artist
+
+        # the limits set in the previous render are not kept, and relim does not
+        # look at the collections
+        axes.relim()
+        for artist in self._line_collections.values():
+            segments = artist.get_segments()
+            if segments:
+                axes.update_datalim(numpy.concatenate(segments))
+        axes.set_autoscale_on(True)
+        axes.autoscale_view()
+
+        legend_styles = None
+        if legend:
+            legend_styles = [(key, line["style"]) for key, line in lines.items()] + [
+                (key, collection["style"])
+                for key, collection in line_collections.items()
+            ]
+        current_legend = axes.get_legend()
+        keep_legend = (
+            legend
+            and current_legend is not None
+            and legend_styles == self._legend_styles
+        )
+        if not keep_legend:
+            if current_legend is not None:
+                current_legend.remove()
+            if legend:
+                axes.legend()
+        self._legend_styles = legend_styles
+        return axes
+
+    def close(self):
+        self.fig.clear()
+        self._lines = {}
+        self._line_collections = {}
+        self._legend_styles = None
+
+
+class SessionFigures:
+    # The figures of the outputs of a session, one per output, created when the
+    # output is rendered for the first time and closed when the session ends
+    def __init__(self, session=None):
+        self._figures = {}
+        if session is not None:
+            session.on_ended(self.close)
+
+    def __getitem__(self, output_id):
+        return self.get(output_id)
+
+    def get(self, output_id, title=None, xlabel=None, ylabel=None):
+        if output_id not in self._figures:
+            self._figures[output_id] = PersistentFigure(
+                title=title, xlabel=xlabel, ylabel=ylabel
+            )
+        return self._figures[output_id]
+
+    def close(self):
+        for figure in self._figures.values():
+            figure.close()
+        self._figures = {}
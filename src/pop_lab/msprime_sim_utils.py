@@ -1,18 +1,212 @@
+import os
+import asyncio
+import collections
+import contextlib
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+from statistics import NormalDist
+
 import numpy
 import pandas
 import msprime
+import tskit
+import demes
+
+# the apps import the modules by name, not from the pop_lab package
+try:
+    from . import sim_jobs
+except ImportError:
+    import sim_jobs
+
+
+PCA_MAX_MAF = 0.95
+PCA_NUM_COMPONENTS = 2
+PCA_RANDOM_SEED = 42
+MIN_LD_R2 = 0.1
+LD_MAX_MAF = 0.90
+LD_NUM_DIST_BINS = 50
+LD_MAX_PAIRS_PER_DIST_BIN = 2000
+LD_SUBSAMPLING_SEED = 42
+LD_PAIRS_CHUNK_SIZE = 10000
+# fraction of the pairs used for every local fit, around five dist bins
+LD_LOWESS_FRAC = 0.1
+DISTS_MAX_MAF = 0.95
+POLY_MAX_MAF = 0.95
+AFS_NUM_BINS = 20
+ALLELE_COUNTS_CHUNK_SIZE = 5000
+
+
+# Opt-in profiling of the pipeline stages, enabled with POP_LAB_PROFILE=1
+PROFILE_ENV_VAR = "POP_LAB_PROFILE"
+MAX_PROFILE_RECORDS = 1000
+
+_PROFILE_LOGGER = logging.getLogger("pop_lab.profile")
+
+
+class StageProfiler:
+    def __init__(self, enabled=False, max_records=MAX_PROFILE_RECORDS):
+        self.enabled = enabled
+        self.records = collections.deque(maxlen=max_records)
+        # total number of records, it only grows, unlike len(records)
+        self.num_records = 0
+        # peak allocations of the stages in progress, the inner ones included
+        self._peaks_stack = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        start_memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self._peaks_stack.append(start_memory)
+        start_wall_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start_wall_time
+            cpu_time = time.process_time() - start_cpu_time
+            _, peak_memory = tracemalloc.get_traced_memory()
+            peak_memory = max(peak_memory, self._peaks_stack.pop())
+            if self._peaks_stack:
+                self._peaks_stack[-1] = max(self._peaks_stack[-1], peak_memory)
+            if started_tracing:
+                tracemalloc.stop()
+            self.add_record(
+                {
+                    "stage": name,
+                    "wall_time_s": wall_time,
+                    "cpu_time_s": cpu_time,
+                    "peak_alloc_bytes": peak_memory - start_memory,
+                    "pid": os.getpid(),
+                }
+            )
+
+    def add_record(self, record, log=True):
+        self.records.append(record)
+        self.num_records += 1
+        if log:
+            _PROFILE_LOGGER.info(json.dumps(record))
+
+
+PROFILER = StageProfiler(enabled=os.environ.get(PROFILE_ENV_VAR) == "1")
+if PROFILER.enabled and not _PROFILE_LOGGER.handlers:
+    # one JSON record per line in stderr
+    _PROFILE_LOGGER.addHandler(logging.StreamHandler())
+    _PROFILE_LOGGER.setLevel(logging.INFO)
+
+
+def profile_stage(name=None):
+    def decorator(func):
+        stage_name = func.__qualname__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with PROFILER.stage(stage_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
 
-import pynei
+def _cache_result(cache_attr):
+    def decorator(method):
+        signature = inspect.signature(method)
+        default_args = tuple(
+            (name, param.default)
+            for name, param in list(signature.parameters.items())[1:]
+        )
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            cache = getattr(self, cache_attr)
+            # the same call has the same key, however the arguments are passed,
+            # and the calls with the default arguments are kept by method name
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            call_args = tuple(bound.arguments.items())[1:]
+            if call_args == default_args:
+                key = method.__name__
+            else:
+                key = (method.__name__, *call_args)
+            if key not in cache:
+                cache[key] = method(self, *args, **kwargs)
+            return cache[key]
+
+        return wrapper
+
+    return decorator
+
+
+# the stats are small and can be sent between processes, the intermediate results,
+# like the genotypes, are only kept by the object that calculated them
+_cache_stat = _cache_result("stats")
+_cache_intermediate = _cache_result("_intermediates")
+# the small intermediates required to plot the stats
+BUNDLED_INTERMEDIATES = ("_get_pop_samples_info", "_get_indis_per_pop_sample")
 
 
 class SimulationResult:
     def __init__(
-        self, tree_seqs, sample_sets: list[msprime.SampleSet], demography, ploidy
+        self,
+        tree_seqs,
+        sample_sets: list[msprime.SampleSet],
+        demography,
+        ploidy,
+        stats: dict | None = None,
     ):
         self.tree_seqs = tree_seqs
         self._sample_sets = sample_sets
         self.demography = demography
         self.ploidy = ploidy
+        # stats already calculated, by calc method name
+        self.stats = {} if stats is None else stats
+        self._intermediates = {}
+
+    def to_bundle(self):
+        # Only the stats and the per sample info required to plot them, not the
+        # tree sequences or the genotypes, the stats not yet calculated could
+        # not be calculated from the bundle
+        intermediates = {
+            key: self._intermediates[key]
+            for key in BUNDLED_INTERMEDIATES
+            if key in self._intermediates
+        }
+        return {
+            "sample_sets": self._sample_sets,
+            "demography": self.demography,
+            "ploidy": self.ploidy,
+            "stats": dict(self.stats),
+            "intermediates": intermediates,
+        }
+
+    @classmethod
+    def from_bundle(cls, bundle):
+        sim_res = cls(
+            tree_seqs=None,
+            sample_sets=bundle["sample_sets"],
+            demography=bundle["demography"],
+            ploidy=bundle["ploidy"],
+            stats=dict(bundle["stats"]),
+        )
+        sim_res._intermediates.update(bundle["intermediates"])
+        return sim_res
 
     def _get_pop_ids_and_names(self):
         tree_seqs = self.tree_seqs
@@ -33,6 +227,16 @@ class SimulationResult:
                 for node_id in sample_info["sample_node_ids"]
             ]
 
+    @property
+    def pop_samples_info(self):
+        return self._get_pop_samples_info()
+
+    @property
+    def indis_per_pop_sample(self):
+        return self._get_indis_per_pop_sample()
+
+    @_cache_intermediate
+    @profile_stage()
     def _get_pop_samples_info(self):
         samples = {}
         tree_seqs = self.tree_seqs
@@ -54,7 +258,17 @@ class SimulationResult:
             samples[sample_name] = sample
         return samples
 
-    def get_vars_and_pop_samples(self):
+    @_cache_intermediate
+    @profile_stage()
+    def _get_gt_array(self):
+        # (num_vars, num_indis, ploidy), the indis ordered as tree_seqs.samples()
+        haplotype_array = self.tree_seqs.genotype_matrix()
+        new_shape = (haplotype_array.shape[0], -1, self.ploidy)
+        return haplotype_array.reshape(new_shape)
+
+    @_cache_intermediate
+    @profile_stage()
+    def _get_indis_per_pop_sample(self):
         pop_samples_info = self._get_pop_samples_info()
 
         pop_sample_by_node_id = {}
@@ -62,22 +276,9 @@ class SimulationResult:
             for node_id in sample_info["sample_node_ids"]:
                 pop_sample_by_node_id[node_id] = pop_sample_name
 
-        tree_seqs = self.tree_seqs
-        haplotype_array = tree_seqs.genotype_matrix()
-        node_ids = tree_seqs.samples()
-        new_shape = (haplotype_array.shape[0], -1, self.ploidy)
-        gt_array = haplotype_array.reshape(new_shape)
+        node_ids = self.tree_seqs.samples()
         one_node_id_per_indi = node_ids[:: self.ploidy]
 
-        poss = tree_seqs.tables.sites.position
-
-        vars_info = pandas.DataFrame(
-            {
-                pynei.VAR_TABLE_POS_COL: poss,
-                pynei.VAR_TABLE_CHROM_COL: numpy.full((poss.size,), 1),
-            }
-        )
-
         indi_names = []
         indis_by_pop_sample = {
             pop_sample: [] for pop_sample in set(pop_sample_by_node_id.values())
@@ -87,15 +288,62 @@ class SimulationResult:
             indi_name = f"{node_id}-{pop_sample_name}"
             indi_names.append(indi_name)
             indis_by_pop_sample[pop_sample_name].append(indi_name)
-        vars = pynei.Variants.from_gt_array(
-            gt_array, samples=indi_names, vars_info=vars_info
-        )
+
+        pop_sample_names = list(pop_samples_info.keys())
+        pop_sample_idx_per_indi = self._get_pop_sample_idx_per_node(pop_samples_info)[
+            one_node_id_per_indi
+        ]
+        indi_idxs_by_pop_sample = {
+            pop_sample_name: numpy.flatnonzero(pop_sample_idx_per_indi == idx)
+            for idx, pop_sample_name in enumerate(pop_sample_names)
+        }
         return {
-            "vars": vars,
+            "indi_names": indi_names,
             "indis_by_pop_sample": indis_by_pop_sample,
             "pop_samples_info": pop_samples_info,
+            "pop_sample_names": pop_sample_names,
+            "pop_sample_idx_per_indi": pop_sample_idx_per_indi,
+            "indi_idxs_by_pop_sample": indi_idxs_by_pop_sample,
         }
 
+    @_cache_intermediate
+    @profile_stage()
+    def get_vars_and_pop_samples(self):
+        # the pynei variants are only required by the pynei filters, the rest of
+        # the stats only need the individuals of every pop sample, so pynei is
+        # only imported once a filtered stat is requested
+        import pynei
+
+        res = self._get_indis_per_pop_sample()
+        return {"vars": self._create_vars(), **res}
+
+    def _create_vars(self, var_idxs=None):
+        import pynei
+
+        gt_array = self._get_gt_array()
+        poss = self.tree_seqs.tables.sites.position
+        if var_idxs is not None:
+            gt_array = gt_array[var_idxs]
+            poss = poss[var_idxs]
+        vars_info = pandas.DataFrame(
+            {
+                pynei.VAR_TABLE_POS_COL: poss,
+                pynei.VAR_TABLE_CHROM_COL: numpy.full((poss.size,), 1),
+            }
+        )
+        return pynei.Variants.from_gt_array(
+            gt_array,
+            samples=self._get_indis_per_pop_sample()["indi_names"],
+            vars_info=vars_info,
+        )
+
+    def _get_pop_sample_idx_per_node(self, pop_samples_info):
+        # -1 for the nodes that do not belong to any pop sample
+        pop_sample_idx_per_node = numpy.full(self.tree_seqs.num_nodes, -1)
+        for idx, sample_info in enumerate(pop_samples_info.values()):
+            pop_sample_idx_per_node[sample_info["sample_node_ids"]] = idx
+        return pop_sample_idx_per_node
+
     @staticmethod
     def _sort_series_by_sampling_time(series, pop_samples_info):
         return series.sort_index(
@@ -140,25 +388,82 @@ class SimulationResult:
 
         return {f"{param}_by_pop": series_for_pops, f"{param}_dframe": dframe}
 
+    @_cache_intermediate
+    @profile_stage()
+    def get_allele_counts(self):
+        # (num_vars, num_pop_samples, num_alleles), computed in one pass over the
+        # genotypes, all the population stats are calculated from these counts
+        res = self._get_indis_per_pop_sample()
+        num_pop_samples = len(res["pop_sample_names"])
+        pop_sample_idx_per_hap = numpy.repeat(
+            res["pop_sample_idx_per_indi"], self.ploidy
+        )
+        haps_in_pop_samples = pop_sample_idx_per_hap >= 0
+        pop_sample_idx_per_hap = pop_sample_idx_per_hap[haps_in_pop_samples]
+
+        gt_array = self._get_gt_array()
+        num_vars = gt_array.shape[0]
+        num_alleles = max(int(gt_array.max()) + 1, 2) if num_vars else 2
+        haplotypes = gt_array.reshape(num_vars, -1)[:, haps_in_pop_samples]
+
+        counts = numpy.empty((num_vars, num_pop_samples, num_alleles), dtype=int)
+        num_bins_per_var = num_pop_samples * num_alleles
+        for start in range(0, num_vars, ALLELE_COUNTS_CHUNK_SIZE):
+            chunk = haplotypes[start : start + ALLELE_COUNTS_CHUNK_SIZE]
+            chunk_size = chunk.shape[0]
+            bin_idxs = (
+                numpy.arange(chunk_size)[:, None] * num_bins_per_var
+                + pop_sample_idx_per_hap[None, :] * num_alleles
+                + chunk
+            )
+            counts[start : start + chunk_size] = numpy.bincount(
+                bin_idxs.ravel(), minlength=chunk_size * num_bins_per_var
+            ).reshape(chunk_size, num_pop_samples, num_alleles)
+        return counts
+
+    def _calc_unbiased_exp_het_per_var(self, var_idxs=None):
+        counts = self.get_allele_counts()
+        if var_idxs is not None:
+            counts = counts[var_idxs]
+        num_haps = counts.sum(axis=2)
+        freqs = counts / num_haps[:, :, None]
+        exp_het = 1 - numpy.sum(freqs**2, axis=2)
+        return exp_het * num_haps / (num_haps - 1)
+
+    @_cache_stat
+    @profile_stage()
     def calc_unbiased_exp_het(self):
-        res = self.get_vars_and_pop_samples()
+        res = self._get_indis_per_pop_sample()
         pop_samples_info = res["pop_samples_info"]
-        res = pynei.calc_exp_het_stats_per_var(
-            res["vars"], pops=res["indis_by_pop_sample"], unbiased=True
+        series_indexed_by_pop_sample = pandas.Series(
+            self._calc_unbiased_exp_het_per_var().mean(axis=0),
+            index=res["pop_sample_names"],
         )
-        exp_het = res["mean"]
-        series_indexed_by_pop_sample = exp_het
         param = "exp_het"
         return self._create_series_per_pop_and_dframe(
             series_indexed_by_pop_sample, param, pop_samples_info
         )
 
+    @_cache_stat
+    @profile_stage()
     def calc_num_variants(self):
-        res = self.get_vars_and_pop_samples()
+        res = self._get_indis_per_pop_sample()
         pop_samples_info = res["pop_samples_info"]
-        res = pynei.calc_poly_vars_ratio_per_var(
-            res["vars"], pops=res["indis_by_pop_sample"]
-        )
+        pop_sample_names = res["pop_sample_names"]
+
+        counts = self.get_allele_counts()
+        major_allele_freqs = counts.max(axis=2) / counts.sum(axis=2)
+        num_variable = numpy.sum(major_allele_freqs < 1, axis=0)
+        num_poly = numpy.sum(major_allele_freqs <= POLY_MAX_MAF, axis=0)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            poly_ratio = num_poly / num_variable
+        res = {
+            "num_poly": pandas.Series(num_poly, index=pop_sample_names),
+            "num_variable": pandas.Series(num_variable, index=pop_sample_names),
+            "poly_ratio_over_variables": pandas.Series(
+                poly_ratio, index=pop_sample_names
+            ),
+        }
 
         sorted_res = {}
         for param in ["num_poly", "num_variable", "poly_ratio_over_variables"]:
@@ -169,38 +474,417 @@ class SimulationResult:
 
         return sorted_res
 
-    def calc_allele_freq_spectrum(self):
-        res = self.get_vars_and_pop_samples()
-        res = pynei.calc_major_allele_stats_per_var(
-            res["vars"], pops=res["indis_by_pop_sample"], hist_kwargs={"num_bins": 20}
+    @property
+    def ancestry_tree_seqs(self):
+        # the results created from a bundle have no tree sequences
+        if self.tree_seqs is None:
+            return None
+        if self.tree_seqs.num_sites == 0:
+            return self.tree_seqs
+        return remove_mutations(self.tree_seqs)
+
+    @_cache_stat
+    @profile_stage()
+    def calc_branch_diversity(self):
+        # mean pairwise branch length, in generations, it requires no mutations
+        pop_samples_info = self._get_pop_samples_info()
+        diversities = self.tree_seqs.diversity(
+            [
+                sample_info["sample_node_ids"]
+                for sample_info in pop_samples_info.values()
+            ],
+            mode="branch",
+        )
+        series_indexed_by_pop_sample = pandas.Series(
+            diversities, index=list(pop_samples_info.keys())
         )
-        return {"counts": res["hist_counts"], "bin_edges": res["hist_bin_edges"]}
+        return self._create_series_per_pop_and_dframe(
+            series_indexed_by_pop_sample, "branch_diversity", pop_samples_info
+        )
+
+    @_cache_stat
+    @profile_stage()
+    def calc_allele_freq_spectrum(self):
+        pop_sample_names = self._get_indis_per_pop_sample()["pop_sample_names"]
+        counts = self.get_allele_counts()
+        major_allele_freqs = counts.max(axis=2) / counts.sum(axis=2)
+        bin_edges = numpy.linspace(0, 1, AFS_NUM_BINS + 1)
+        hist_counts = {
+            pop_sample_name: numpy.histogram(
+                major_allele_freqs[:, idx], bins=bin_edges
+            )[0]
+            for idx, pop_sample_name in enumerate(pop_sample_names)
+        }
+        return {"counts": pandas.DataFrame(hist_counts), "bin_edges": bin_edges}
 
+    @_cache_stat
+    @profile_stage()
+    def calc_site_freq_spectrum(self, polarised=False, mode="site"):
+        # exact SFS per pop sample, indexed by the number of copies of the
+        # derived allele, or of the minor one when it is not polarised (folded)
+        sfss = {}
+        for pop_sample_name, sample_info in self._get_pop_samples_info().items():
+            sfs = self.tree_seqs.allele_frequency_spectrum(
+                [sample_info["sample_node_ids"]],
+                mode=mode,
+                polarised=polarised,
+                span_normalise=False,
+            )
+            if not polarised:
+                sfs = sfs[: sfs.size // 2 + 1]
+            sfss[pop_sample_name] = pandas.Series(sfs, index=numpy.arange(sfs.size))
+        return {
+            "sfs": sfss,
+            "num_samples": {
+                pop_sample_name: sample_info["sample_node_ids"].size
+                for pop_sample_name, sample_info in self._get_pop_samples_info().items()
+            },
+        }
+
+    @_cache_stat
+    @profile_stage()
     def calc_exp_het_along_genome(self):
         n_bins = 60
-        res = self.get_vars_and_pop_samples()
-        vars = res["vars"]
-        chunk = next(vars.iter_vars_chunks())
-        samples = vars.samples
-        pops = res["indis_by_pop_sample"]
-        pops = {
-            pop: numpy.isin(samples, pop_samples) for pop, pop_samples in pops.items()
-        }
-        exp_het_per_var = pynei.diversity._calc_unbiased_exp_het_per_var(
-            chunk, pops=pops
-        )["exp_het"]
-        poss = chunk.vars_info[pynei.VAR_TABLE_POS_COL]
+        res = self._get_indis_per_pop_sample()
+        poss = self.tree_seqs.tables.sites.position
         bin_edges = numpy.linspace(0, poss.max(), n_bins + 1)
+        exp_hets = _calc_windowed_means(
+            self._calc_unbiased_exp_het_per_var(), poss, bin_edges
+        )
+        bin_centers = ((bin_edges[:-1] + bin_edges[1:]) / 2).astype(int)
+        return pandas.DataFrame(
+            exp_hets.T, index=res["pop_sample_names"], columns=bin_centers
+        )
+
+    @_cache_intermediate
+    @profile_stage()
+    def get_filtered_vars(self, max_allowed_maf, min_allowed_r2=None):
+        # Cached by filter parameters, first by MAF and then by LD. The LD
+        # pruning, the costly filter, is done only with the variants kept by the
+        # cached MAF filter, so the PCA and the distances share the MAF filtering
+        import pynei
+
+        if min_allowed_r2 is None:
+            vars = pynei.filter_by_maf(
+                self.get_vars_and_pop_samples()["vars"],
+                max_allowed_maf=max_allowed_maf,
+            )
+            filter_stats = {}
+        else:
+            maf_filtered = self.get_filtered_vars(max_allowed_maf)
+            vars = pynei.filter_by_ld_and_maf(
+                self._create_vars(maf_filtered["var_idxs"]),
+                min_allowed_r2=min_allowed_r2,
+                max_allowed_maf=max_allowed_maf,
+            )
+            filter_stats = maf_filtered["filter_stats"]
+        kept_poss = numpy.concatenate(
+            [
+                chunk.vars_info[pynei.VAR_TABLE_POS_COL].to_numpy()
+                for chunk in vars.iter_vars_chunks()
+            ]
+        )
+        var_idxs = numpy.searchsorted(self.tree_seqs.tables.sites.position, kept_poss)
+        return {
+            "vars": vars,
+            "var_idxs": var_idxs,
+            "filter_stats": {**filter_stats, **pynei.gather_filtering_stats(vars)},
+        }
+
+    @_cache_stat
+    @profile_stage()
+    def calc_pca(self):
+        res = self._get_indis_per_pop_sample()
+        filtered = self.get_filtered_vars(PCA_MAX_MAF, MIN_LD_R2)
+
+        # the PCA is done with the dosages of the ancestral allele
+        dosages = (self._get_gt_array()[filtered["var_idxs"]] == 0).sum(axis=2)
+
+        pca_res = _do_pca(dosages.T, num_components=PCA_NUM_COMPONENTS)
+        pc_names = [f"PC{idx + 1}" for idx in range(pca_res["projections"].shape[1])]
+        return {
+            "projections": pandas.DataFrame(
+                pca_res["projections"], index=res["indi_names"], columns=pc_names
+            ),
+            "explained_variance (%)": pandas.Series(
+                pca_res["explained_variance (%)"], index=pc_names
+            ),
+            "filter_stats": filtered["filter_stats"],
+        }
+
+    @_cache_stat
+    @profile_stage()
+    def calc_ld_curves(self, smoothing="binned"):
+        if smoothing not in ("binned", "lowess"):
+            raise ValueError(f"Unknown LD smoothing: {smoothing}")
+
+        res = self._get_indis_per_pop_sample()
+        pop_samples_info = res["pop_samples_info"]
+        indi_idxs_by_pop_sample = res["indi_idxs_by_pop_sample"]
+        gt_array = self._get_gt_array()
+        poss = self.tree_seqs.tables.sites.position
+        rng = numpy.random.default_rng(LD_SUBSAMPLING_SEED)
+
+        ld_curves = {}
+        for pop_sample_name, indi_idxs in indi_idxs_by_pop_sample.items():
+            dosages = (gt_array[:, indi_idxs, :] == 0).sum(axis=2)
+            std_dosages, var_idxs = _standardize_dosages_for_ld(
+                dosages, max_allowed_maf=LD_MAX_MAF, ploidy=self.ploidy
+            )
+            if var_idxs.size < 2:
+                continue
+            pop_poss = poss[var_idxs]
+
+            bin_edges = numpy.linspace(
+                0, pop_poss[-1] - pop_poss[0], LD_NUM_DIST_BINS + 1
+            )
+            idxs1, idxs2 = _sample_marker_pairs_per_dist_bin(
+                pop_poss, bin_edges, LD_MAX_PAIRS_PER_DIST_BIN, rng
+            )
+            r2s = _calc_rogers_huff_r2s(std_dosages, idxs1, idxs2)
+            dists = pop_poss[idxs2] - pop_poss[idxs1]
+
+            if smoothing == "lowess":
+                curve = _calc_lowess_ld_decay(r2s, dists)
+            else:
+                curve = _calc_binned_ld_decay(r2s, dists, bin_edges)
+
+            pop_sample_info = pop_samples_info[pop_sample_name]
+            time = pop_sample_info["sample_time"]
+            pop = pop_sample_info["pop_name"]
+            ld_curves[pop_sample_name] = {
+                "dists": curve["dists"],
+                "r2s": curve["r2s"],
+                "time": time,
+                "pop": pop,
+            }
+        return ld_curves
+
+    @_cache_stat
+    @profile_stage()
+    def calc_jost_dest_dists(self):
+        pop_sample_names = self._get_indis_per_pop_sample()["pop_sample_names"]
+        filtered = self.get_filtered_vars(DISTS_MAX_MAF)
+        counts = self.get_allele_counts()[filtered["var_idxs"]]
+        square_dists = _calc_jost_dest_square_dists(counts)
+        return {
+            "square_dists": pandas.DataFrame(
+                square_dists, index=pop_sample_names, columns=pop_sample_names
+            ),
+            "pop_names": pop_sample_names,
+            "filter_stats": filtered["filter_stats"],
+        }
+
+
+def _standardize_dosages_for_ld(dosages, max_allowed_maf, ploidy):
+    num_indis = dosages.shape[1]
+    freqs = dosages.sum(axis=1) / (num_indis * ploidy)
+    major_allele_freqs = numpy.maximum(freqs, 1 - freqs)
+    means = dosages.mean(axis=1)
+    stds = dosages.std(axis=1)
+    var_idxs = numpy.flatnonzero((major_allele_freqs <= max_allowed_maf) & (stds > 0))
+    std_dosages = (dosages[var_idxs] - means[var_idxs, None]) / stds[var_idxs, None]
+    return std_dosages, var_idxs
 
-        exp_hets = {}
-        for pos_start, pos_end in zip(bin_edges[:-1], bin_edges[1:]):
-            pos_mask = numpy.logical_and(poss > pos_start, poss <= pos_end)
-            exp_hets_in_genome_segment = exp_het_per_var.loc[pos_mask, :]
-            exp_het_in_genome_segment = exp_hets_in_genome_segment.mean(axis=0)
-            pos = int((pos_start + pos_end) / 2.0)
-            exp_hets[pos] = exp_het_in_genome_segment
-        exp_hets = pandas.DataFrame(exp_hets)
-        return exp_hets
+
+def _sample_marker_pairs_per_dist_bin(poss, bin_edges, max_pairs_per_bin, rng):
+    # For every dist bin, all marker pairs (i < j) with a distance in the bin are
+    # numbered, marker by marker, and at most max_pairs_per_bin of them are chosen
+    # without building the full pair list
+    marker_idxs = numpy.arange(poss.size)
+    idxs1 = []
+    idxs2 = []
+    num_bins = bin_edges.size - 1
+    for bin_idx in range(num_bins):
+        side = "right" if bin_idx == num_bins - 1 else "left"
+        starts = numpy.searchsorted(poss, poss + bin_edges[bin_idx], side="left")
+        starts = numpy.maximum(starts, marker_idxs + 1)
+        ends = numpy.searchsorted(poss, poss + bin_edges[bin_idx + 1], side=side)
+        num_pairs_per_marker = numpy.maximum(ends - starts, 0)
+        num_pairs = num_pairs_per_marker.sum()
+        if not num_pairs:
+            continue
+        if num_pairs > max_pairs_per_bin:
+            pair_ranks = numpy.sort(
+                rng.choice(num_pairs, size=max_pairs_per_bin, replace=False)
+            )
+        else:
+            pair_ranks = numpy.arange(num_pairs)
+        last_ranks = numpy.cumsum(num_pairs_per_marker)
+        first_ranks = last_ranks - num_pairs_per_marker
+        pair_idxs1 = numpy.searchsorted(last_ranks, pair_ranks, side="right")
+        idxs1.append(pair_idxs1)
+        idxs2.append(starts[pair_idxs1] + pair_ranks - first_ranks[pair_idxs1])
+    if not idxs1:
+        empty = numpy.array([], dtype=int)
+        return empty, empty
+    return numpy.concatenate(idxs1), numpy.concatenate(idxs2)
+
+
+def _calc_rogers_huff_r2s(std_dosages, idxs1, idxs2, chunk_size=LD_PAIRS_CHUNK_SIZE):
+    num_indis = std_dosages.shape[1]
+    r2s = numpy.empty(idxs1.size)
+    for start in range(0, idxs1.size, chunk_size):
+        end = start + chunk_size
+        rs = numpy.einsum(
+            "ij,ij->i",
+            std_dosages[idxs1[start:end]],
+            std_dosages[idxs2[start:end]],
+        )
+        r2s[start:end] = (rs / num_indis) ** 2
+    return r2s
+
+
+def _calc_binned_ld_decay(r2s, dists, bin_edges):
+    num_bins = bin_edges.size - 1
+    bin_idxs = numpy.clip(numpy.digitize(dists, bin_edges) - 1, 0, num_bins - 1)
+
+    num_pairs = numpy.bincount(bin_idxs, minlength=num_bins)
+    r2_sums = numpy.bincount(bin_idxs, weights=r2s, minlength=num_bins)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        mean_r2s = r2_sums / num_pairs
+
+    bin_centers = (bin_edges[1:] + bin_edges[:-1]) / 2
+    has_pairs = num_pairs > 0
+    return {
+        "dists": bin_centers[has_pairs],
+        "r2s": mean_r2s[has_pairs],
+        "num_pairs": num_pairs[has_pairs],
+    }
+
+
+def _standardize_matrix(matrix):
+    # columns are the variables, the constant ones are removed
+    stds = matrix.std(axis=0)
+    matrix = matrix[:, stds > 0]
+    return (matrix - matrix.mean(axis=0)) / stds[stds > 0]
+
+
+def _calc_randomized_svd(
+    matrix, num_components, random_seed, num_oversamples=10, num_power_iters=4
+):
+    # Halko, Martinsson and Tropp (2011), Algorithm 4.4
+    rng = numpy.random.default_rng(random_seed)
+    num_cols = min(num_components + num_oversamples, min(matrix.shape))
+    basis = matrix @ rng.standard_normal((matrix.shape[1], num_cols))
+    basis, _ = numpy.linalg.qr(basis)
+    for _ in range(num_power_iters):
+        basis, _ = numpy.linalg.qr(matrix.T @ basis)
+        basis, _ = numpy.linalg.qr(matrix @ basis)
+    u_small, singular_values, _ = numpy.linalg.svd(
+        basis.T @ matrix, full_matrices=False
+    )
+    return (basis @ u_small)[:, :num_components], singular_values[:num_components]
+
+
+def _calc_exact_svd(matrix, num_components):
+    # the eigen decomposition of the small symmetric matrix is robust even when
+    # the LAPACK SVD drivers fail
+    eigenvalues, eigenvectors = numpy.linalg.eigh(matrix @ matrix.T)
+    order = numpy.argsort(eigenvalues)[::-1][:num_components]
+    singular_values = numpy.sqrt(numpy.clip(eigenvalues[order], 0, None))
+    return eigenvectors[:, order], singular_values
+
+
+@profile_stage("pca")
+def _do_pca(matrix, num_components, random_seed=PCA_RANDOM_SEED):
+    # matrix rows are the individuals and columns the variables
+    matrix = _standardize_matrix(numpy.asarray(matrix, dtype=float))
+    num_components = min(num_components, *matrix.shape)
+
+    try:
+        u, singular_values = _calc_randomized_svd(
+            matrix, num_components, random_seed=random_seed
+        )
+        if not numpy.all(numpy.isfinite(singular_values)):
+            raise numpy.linalg.LinAlgError("Non finite singular values")
+    except (numpy.linalg.LinAlgError, ValueError):
+        u, singular_values = _calc_exact_svd(matrix, num_components)
+
+    # deterministic signs, the largest projection of every PC is positive
+    max_abs_idxs = numpy.argmax(numpy.abs(u), axis=0)
+    u = u * numpy.sign(u[max_abs_idxs, numpy.arange(u.shape[1])])
+
+    total_variance = numpy.sum(matrix**2)
+    return {
+        "projections": u * singular_values,
+        "explained_variance (%)": singular_values**2 / total_variance * 100,
+    }
+
+
+def _calc_windowed_means(values_per_site, poss, bin_edges):
+    # the windows include their end, (start, end], NaN for the empty ones
+    num_bins = bin_edges.size - 1
+    bin_idxs = numpy.clip(
+        numpy.searchsorted(bin_edges, poss, side="left") - 1, 0, num_bins - 1
+    )
+    num_sites = numpy.bincount(bin_idxs, minlength=num_bins)
+    sums = numpy.stack(
+        [
+            numpy.bincount(bin_idxs, weights=values, minlength=num_bins)
+            for values in values_per_site.T
+        ],
+        axis=1,
+    )
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return sums / num_sites[:, None]
+
+
+def _calc_jost_dest_square_dists(allele_counts):
+    # Jost (2008) D estimator for every pair of pop samples, with the
+    # heterozygosities averaged over the loci before calculating D
+    num_haps = allele_counts.sum(axis=2)
+    freqs = allele_counts / num_haps[:, :, None]
+    homozygosities = numpy.sum(freqs**2, axis=2)
+
+    # pairwise arrays: (num_vars, num_pop_samples, num_pop_samples)
+    hs = 1 - (homozygosities[:, :, None] + homozygosities[:, None, :]) / 2
+    # the homozygosity of the mean freqs of the pair of pop samples
+    freqs_products = numpy.einsum("vpa,vqa->vpq", freqs, freqs)
+    ht = (
+        1
+        - (homozygosities[:, :, None] + 2 * freqs_products + homozygosities[:, None, :])
+        / 4
+    )
+    harmonic_num_haps = 2 / (1 / num_haps[:, :, None] + 1 / num_haps[:, None, :])
+
+    hs_est = hs * harmonic_num_haps / (harmonic_num_haps - 1)
+    ht_est = ht + hs_est / (2 * harmonic_num_haps)
+
+    mean_hs_est = hs_est.mean(axis=0)
+    mean_ht_est = ht_est.mean(axis=0)
+    num_pops = 2
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        dest = (
+            (mean_ht_est - mean_hs_est)
+            / (1 - mean_hs_est)
+            * (num_pops / (num_pops - 1))
+        )
+    numpy.fill_diagonal(dest, 0)
+    return dest
+
+
+@profile_stage("lowess")
+def _calc_lowess_ld_decay(r2s, dists, num_points=LD_NUM_DIST_BINS, frac=LD_LOWESS_FRAC):
+    # It is fitted on the pairs sampled per dist bin. Within a bin the pairs are
+    # sampled uniformly, so the mean r2 for a distance is not biased, only the
+    # number of pairs along the distances is evened out.
+    # The fit is not robust (it=0). The r2s are very skewed and the robust
+    # iterations take the high ones as outliers, so the curve would move from the
+    # mean r2, like the binned one, towards the median
+    import statsmodels.api as sm
+
+    dist_delta = 0.01 * (dists.max() - dists.min())
+
+    lowess_dists_lds = sm.nonparametric.lowess(
+        r2s, dists, frac=frac, it=0, delta=dist_delta
+    )
+    lowess_dists = lowess_dists_lds[:, 0]
+    lowess_lds = lowess_dists_lds[:, 1]
+
+    xs = numpy.linspace(0, dists.max(), num_points)
+    interpolated_r2 = numpy.interp(xs, lowess_dists, lowess_lds)
+    return {"dists": xs, "r2s": interpolated_r2}
 
 
 def get_info_from_demography(demography: msprime.Demography):
@@ -221,6 +905,192 @@ def create_msprime_sample_set(num_samples: int, ploidy: int, pop_name: str, time
     return sample_set
 
 
+def _create_sim_ancestry_kwargs(
+    sample_sets, demography, model, seq_length_in_bp, recomb_rate, random_seed
+):
+    kwargs = {
+        "samples": sample_sets,
+        "demography": demography,
+        "recombination_rate": recomb_rate,
+        "sequence_length": seq_length_in_bp,
+        "random_seed": random_seed,
+    }
+    if model is not None:
+        kwargs["model"] = model
+    return kwargs
+
+
+DEF_CACHE_MAX_SIZE_IN_BYTES = 500 * 1024**2
+
+
+class TreeSeqsCache:
+    def __init__(self, cache_dir, max_size_in_bytes=DEF_CACHE_MAX_SIZE_IN_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_in_bytes = max_size_in_bytes
+
+    def _get_path(self, key):
+        return self.cache_dir / f"{key}.trees"
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            tree_seqs = tskit.load(path)
+        except (FileNotFoundError, tskit.FileFormatError):
+            return None
+        # the modification time is used to know which are the least recently used
+        path.touch()
+        return tree_seqs
+
+    def put(self, key, tree_seqs):
+        path = self._get_path(key)
+        # the file is renamed once written, so it is never read half written
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        tree_seqs.dump(tmp_path)
+        os.replace(tmp_path, path)
+        self._remove_least_recently_used(path_to_keep=path)
+
+    def _remove_least_recently_used(self, path_to_keep):
+        files = []
+        for path in self.cache_dir.glob("*.trees"):
+            if path == path_to_keep:
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        total_size = path_to_keep.stat().st_size
+        total_size += sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total_size <= self.max_size_in_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+
+
+TREE_SEQS_CACHE_DIR_ENV_VAR = "POP_LAB_TREE_SEQS_CACHE_DIR"
+DEF_TREE_SEQS_CACHE_DIR_NAME = "pop_lab_tree_seqs"
+
+
+@functools.cache
+def get_default_tree_seqs_cache():
+    # Shared by all the sessions and apps of the server. In pyodide the files
+    # would be kept in the memory of the page, so nothing is cached
+    if sys.platform == "emscripten":
+        return None
+    cache_dir = os.environ.get(TREE_SEQS_CACHE_DIR_ENV_VAR)
+    if cache_dir is None:
+        cache_dir = Path(tempfile.gettempdir()) / DEF_TREE_SEQS_CACHE_DIR_NAME
+    try:
+        return TreeSeqsCache(cache_dir)
+    except OSError:
+        logging.getLogger(__name__).warning(
+            "Could not create the tree sequences cache in %s", cache_dir
+        )
+        return None
+
+
+def create_ancestry_key(
+    sample_sets: list[msprime.SampleSet],
+    demography: msprime.Demography,
+    model,
+    seq_length_in_bp,
+    recomb_rate,
+    random_seed,
+):
+    params = {
+        "demography": demes.dumps(
+            demography.to_demes(), format="json", simplified=False
+        ),
+        "sample_sets": [repr(sample_set) for sample_set in sample_sets],
+        "model": repr(model),
+        "seq_length_in_bp": float(seq_length_in_bp),
+        "recomb_rate": float(recomb_rate),
+        "random_seed": random_seed,
+        "msprime_version": msprime.__version__,
+    }
+    params = json.dumps(params, sort_keys=True)
+    return hashlib.sha256(params.encode()).hexdigest()
+
+
+RESULT_BUNDLE_FORMAT_VERSION = 2
+
+
+def create_result_key(
+    sample_sets: list[msprime.SampleSet],
+    demography: msprime.Demography,
+    model,
+    seq_length_in_bp,
+    recomb_rate,
+    mutation_rate,
+    ploidy=2,
+):
+    # Identifies the simulation parameters, not a particular simulation, so the
+    # random seed is not included
+    ancestry_key = create_ancestry_key(
+        sample_sets,
+        demography=demography,
+        model=model,
+        seq_length_in_bp=seq_length_in_bp,
+        recomb_rate=recomb_rate,
+        random_seed=None,
+    )
+    params = {
+        "ancestry_key": ancestry_key,
+        "mutation_rate": float(mutation_rate),
+        "ploidy": ploidy,
+        "bundle_format_version": RESULT_BUNDLE_FORMAT_VERSION,
+    }
+    params = json.dumps(params, sort_keys=True)
+    return hashlib.sha256(params.encode()).hexdigest()
+
+
+def simulate_ancestry(
+    sample_sets: list[msprime.SampleSet],
+    demography: msprime.Demography,
+    model: None,
+    seq_length_in_bp: int,
+    recomb_rate=1e-8,
+    random_seed=None,
+    cache: TreeSeqsCache | None = None,
+):
+    # Simulations without a random seed should be different every time,
+    # so they are not cached
+    if cache is not None and random_seed is not None:
+        cache_key = create_ancestry_key(
+            sample_sets,
+            demography=demography,
+            model=model,
+            seq_length_in_bp=seq_length_in_bp,
+            recomb_rate=recomb_rate,
+            random_seed=random_seed,
+        )
+        tree_seqs = cache.get(cache_key)
+        if tree_seqs is not None:
+            return tree_seqs
+    else:
+        cache_key = None
+
+    kwargs = _create_sim_ancestry_kwargs(
+        sample_sets, demography, model, seq_length_in_bp, recomb_rate, random_seed
+    )
+    with PROFILER.stage("msprime.sim_ancestry"):
+        tree_seqs = msprime.sim_ancestry(**kwargs)
+    if cache_key is not None:
+        cache.put(cache_key, tree_seqs)
+    return tree_seqs
+
+
+def remove_mutations(tree_seqs):
+    tables = tree_seqs.dump_tables()
+    tables.sites.clear()
+    tables.mutations.clear()
+    return tables.tree_sequence()
+
+
 def simulate(
     sample_sets: list[msprime.SampleSet],
     demography: msprime.Demography,
@@ -231,25 +1101,545 @@ def simulate(
     random_seed=None,
     mutation_rate=1e-8,
     ploidy=2,
+    cache: TreeSeqsCache | None = None,
+    mutation_random_seed=None,
+    ancestry_tree_seqs=None,
 ):
-    kwargs = {
-        "samples": sample_sets,
+    # The ancestry is the costly step, a previous one can be reused when only the
+    # mutation parameters change
+    if ancestry_tree_seqs is None:
+        ancestry_tree_seqs = simulate_ancestry(
+            sample_sets,
+            demography=demography,
+            model=model,
+            seq_length_in_bp=seq_length_in_bp,
+            recomb_rate=recomb_rate,
+            random_seed=random_seed,
+            cache=cache,
+        )
+
+    if mutation_random_seed is None:
+        mutation_random_seed = random_seed
+    if add_mutations:
+        with PROFILER.stage("msprime.sim_mutations"):
+            tree_seqs = msprime.sim_mutations(
+                ancestry_tree_seqs,
+                rate=mutation_rate,
+                random_seed=mutation_random_seed,
+            )
+    else:
+        tree_seqs = ancestry_tree_seqs
+
+    return SimulationResult(
+        tree_seqs=tree_seqs,
+        sample_sets=sample_sets,
+        demography=demography,
+        ploidy=ploidy,
+    )
+
+
+def create_result_bundle(
+    sample_sets: list[msprime.SampleSet],
+    demography: msprime.Demography,
+    model,
+    seq_length_in_bp,
+    recomb_rate,
+    mutation_rate,
+    stats_to_calc,
+    ploidy=2,
+    random_seed=None,
+):
+    sim_res = simulate(
+        sample_sets,
+        demography=demography,
+        model=model,
+        seq_length_in_bp=seq_length_in_bp,
+        recomb_rate=recomb_rate,
+        mutation_rate=mutation_rate,
+        random_seed=random_seed,
+        ploidy=ploidy,
+    )
+    for method in (*stats_to_calc, *BUNDLED_INTERMEDIATES):
+        getattr(sim_res, method)()
+
+    key = create_result_key(
+        sample_sets,
+        demography=demography,
+        model=model,
+        seq_length_in_bp=seq_length_in_bp,
+        recomb_rate=recomb_rate,
+        mutation_rate=mutation_rate,
+        ploidy=ploidy,
+    )
+    return {
+        "key": key,
+        "format_version": RESULT_BUNDLE_FORMAT_VERSION,
+        **sim_res.to_bundle(),
+    }
+
+
+def save_result_bundle(bundle, path):
+    path = Path(path)
+    # the file is renamed once written, so it is never read half written
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    with tmp_path.open("wb") as fhand:
+        pickle.dump(bundle, fhand, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_result_bundle(path):
+    # A missing or unreadable bundle, for instance one pickled by other library
+    # versions, is ignored and the simulation is done instead
+    try:
+        with Path(path).open("rb") as fhand:
+            bundle = pickle.load(fhand)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logging.getLogger(__name__).warning("Could not load result bundle %s", path)
+        return None
+    if bundle.get("format_version") != RESULT_BUNDLE_FORMAT_VERSION:
+        return None
+    return bundle
+
+
+# The replicates are always split in the same number of jobs, so the result for a
+# given random seed does not depend on the number of available CPUs
+NUM_REPLICATE_JOBS = 8
+
+
+def _get_process_pool():
+    return sim_jobs.get_process_pool()
+
+
+def _iter_simulation_stages(sim_kwargs, stats_to_calc):
+    # It yields before every stage, the ancestry, the mutations and every stat,
+    # with the fraction done and a message, and, at the end, the result.
+    # msprime can not be interrupted, so these are the points in which a
+    # simulation can be cancelled or let others run
+    num_stages = 2 + len(stats_to_calc)
+    sim_kwargs = sim_kwargs.copy()
+    if sim_kwargs["ancestry_tree_seqs"] is None:
+        yield {"fraction": 0, "message": "Simulating ancestry"}
+        sim_kwargs["ancestry_tree_seqs"] = simulate_ancestry(
+            sim_kwargs["sample_sets"],
+            demography=sim_kwargs["demography"],
+            model=sim_kwargs["model"],
+            seq_length_in_bp=sim_kwargs["seq_length_in_bp"],
+            recomb_rate=sim_kwargs["recomb_rate"],
+            random_seed=sim_kwargs["random_seed"],
+            cache=sim_kwargs["cache"],
+        )
+    yield {"fraction": 1 / num_stages, "message": "Simulating mutations"}
+    sim_res = simulate(**sim_kwargs)
+
+    for idx, stat in enumerate(stats_to_calc):
+        yield {"fraction": (2 + idx) / num_stages, "message": "Calculating statistics"}
+        getattr(sim_res, stat)()
+    yield {"fraction": 1, "message": "Done", "sim_res": sim_res}
+
+
+def _simulate_and_calc_stats(sim_kwargs, stats_to_calc, cancel_token=None):
+    # The check method of the cancel token raises if the run has been cancelled
+    num_previous_records = len(PROFILER.records)
+    with PROFILER.stage("simulate_and_calc_stats"):
+        for stage in _iter_simulation_stages(sim_kwargs, stats_to_calc):
+            if cancel_token is not None:
+                cancel_token.check()
+        sim_res = stage["sim_res"]
+    # tree sequences are pickled by tskit in its compact binary format
+    return {
+        "tree_seqs": sim_res.tree_seqs,
+        "stats": sim_res.stats,
+        "profile_records": list(PROFILER.records)[num_previous_records:],
+    }
+
+
+async def _simulate_and_calc_stats_in_stages(
+    sim_kwargs, stats_to_calc, progress_callback, cancel_token
+):
+    # between the stages the control is given back to the event loop, so the app
+    # keeps responding and a cancelled task stops there
+    for stage in _iter_simulation_stages(sim_kwargs, stats_to_calc):
+        if progress_callback is not None:
+            progress_callback(stage["fraction"], stage["message"])
+        if cancel_token is not None:
+            cancel_token.check()
+        await asyncio.sleep(0)
+    return stage["sim_res"]
+
+
+async def simulate_async(
+    sample_sets: list[msprime.SampleSet],
+    demography: msprime.Demography,
+    model: None,
+    seq_length_in_bp: int,
+    recomb_rate=1e-8,
+    add_mutations=True,
+    random_seed=None,
+    mutation_rate=1e-8,
+    ploidy=2,
+    stats_to_calc=(),
+    cache: TreeSeqsCache | None = None,
+    mutation_random_seed=None,
+    ancestry_tree_seqs=None,
+    progress_callback=None,
+    cancel_token=None,
+):
+    # It runs in a worker process, if available, if not, in stages that let the
+    # app attend the user between them.
+    # The progress callback is called with the fraction done and a message, the
+    # run stops at the next stage once the cancel token has been cancelled
+    sim_kwargs = {
+        "sample_sets": sample_sets,
         "demography": demography,
-        "recombination_rate": recomb_rate,
-        "sequence_length": seq_length_in_bp,
+        "model": model,
+        "seq_length_in_bp": seq_length_in_bp,
+        "recomb_rate": recomb_rate,
+        "add_mutations": add_mutations,
         "random_seed": random_seed,
+        "mutation_rate": mutation_rate,
+        "ploidy": ploidy,
+        "cache": cache,
+        "mutation_random_seed": mutation_random_seed,
+        "ancestry_tree_seqs": ancestry_tree_seqs,
     }
-    if model is not None:
-        kwargs["model"] = model
-    tree_seqs = msprime.sim_ancestry(**kwargs)
-    if add_mutations:
-        tree_seqs = msprime.sim_mutations(
-            tree_seqs, rate=mutation_rate, random_seed=random_seed
+    pool = _get_process_pool()
+    if pool is None:
+        return await _simulate_and_calc_stats_in_stages(
+            sim_kwargs, stats_to_calc, progress_callback, cancel_token
         )
 
+    if progress_callback is not None:
+        progress_callback(0, "Simulating")
+    loop = asyncio.get_running_loop()
+    res = await loop.run_in_executor(
+        pool, _simulate_and_calc_stats, sim_kwargs, stats_to_calc, cancel_token
+    )
+    # the stages profiled in the worker process, already logged by it
+    for record in res["profile_records"]:
+        PROFILER.add_record(record, log=False)
+    if progress_callback is not None:
+        progress_callback(1, "Done")
     return SimulationResult(
+        tree_seqs=res["tree_seqs"],
+        sample_sets=sample_sets,
+        demography=demography,
+        ploidy=ploidy,
+        stats=res["stats"],
+    )
+
+
+def worker_processes_available():
+    return _get_process_pool() is not None
+
+
+def _calc_stats(
+    tree_seqs, sample_sets, demography, ploidy, stats_to_calc, cancel_token
+):
+    num_previous_records = len(PROFILER.records)
+    sim_res = SimulationResult(
         tree_seqs=tree_seqs,
         sample_sets=sample_sets,
         demography=demography,
         ploidy=ploidy,
     )
+    errors = _calc_stats_in_sim_res(sim_res, stats_to_calc, cancel_token)
+    return {
+        "stats": sim_res.stats,
+        "errors": errors,
+        "profile_records": list(PROFILER.records)[num_previous_records:],
+    }
+
+
+def _calc_stats_in_sim_res(sim_res, stats_to_calc, cancel_token):
+    # A stat that fails does not prevent the others from being calculated
+    errors = []
+    for stat in stats_to_calc:
+        if cancel_token is not None:
+            cancel_token.check()
+        try:
+            getattr(sim_res, stat)()
+        except Exception as error:
+            logging.getLogger(__name__).exception("Could not calculate %s", stat)
+            errors.append(error)
+    return errors
+
+
+async def calc_stats_async(sim_res: SimulationResult, stats_to_calc, cancel_token=None):
+    # The stats are calculated in one worker process, if available, so they share
+    # the intermediates, like the genotypes, that stay in the worker. They are
+    # added to the stats of the result, also when some of them fail, then the
+    # error of the first one that failed is raised
+    pool = _get_process_pool()
+    if pool is None:
+        errors = []
+        for stat in stats_to_calc:
+            errors.extend(_calc_stats_in_sim_res(sim_res, (stat,), cancel_token))
+            await asyncio.sleep(0)
+    else:
+        loop = asyncio.get_running_loop()
+        res = await loop.run_in_executor(
+            pool,
+            _calc_stats,
+            sim_res.tree_seqs,
+            sim_res._sample_sets,
+            sim_res.demography,
+            sim_res.ploidy,
+            stats_to_calc,
+            cancel_token,
+        )
+        for record in res["profile_records"]:
+            PROFILER.add_record(record, log=False)
+        sim_res.stats.update(res["stats"])
+        errors = res["errors"]
+    if errors:
+        raise errors[0]
+    return sim_res.stats
+
+
+def _create_msprime_seed(seed_seq):
+    # msprime seeds should be in the [1, 2**32 - 1] range
+    return int(seed_seq.generate_state(1)[0]) % (2**32 - 1) + 1
+
+
+def _calc_replicate_stats(sim_res: SimulationResult):
+    stats = {}
+    res = sim_res.calc_unbiased_exp_het()
+    stats["exp_het"] = res["exp_het_dframe"].set_index(["pop", "generation"])["exp_het"]
+    res = sim_res.calc_num_variants()
+    for param in ["num_poly", "num_variable", "poly_ratio_over_variables"]:
+        stats[param] = res[param][f"{param}_dframe"].set_index(["pop", "generation"])[
+            param
+        ]
+    return stats
+
+
+def _iter_replicates_stats(
+    sim_ancestry_kwargs,
+    num_replicates,
+    seed_seq,
+    add_mutations,
+    mutation_rate,
+    ploidy,
+):
+    ancestry_seed_seq, mutations_seed_seq = seed_seq.spawn(2)
+    sim_ancestry_kwargs = sim_ancestry_kwargs.copy()
+    sim_ancestry_kwargs["random_seed"] = _create_msprime_seed(ancestry_seed_seq)
+    replicates = msprime.sim_ancestry(
+        **sim_ancestry_kwargs, num_replicates=num_replicates
+    )
+
+    # Only the stats are kept, every tree sequence is discarded once analyzed
+    for tree_seqs, replicate_seed_seq in zip(
+        replicates, mutations_seed_seq.spawn(num_replicates)
+    ):
+        if add_mutations:
+            tree_seqs = msprime.sim_mutations(
+                tree_seqs,
+                rate=mutation_rate,
+                random_seed=_create_msprime_seed(replicate_seed_seq),
+            )
+        sim_res = SimulationResult(
+            tree_seqs=tree_seqs,
+            sample_sets=sim_ancestry_kwargs["samples"],
+            demography=sim_ancestry_kwargs["demography"],
+            ploidy=ploidy,
+        )
+        yield _calc_replicate_stats(sim_res)
+
+
+def _simulate_replicates_and_calc_stats(
+    sim_ancestry_kwargs,
+    num_replicates,
+    seed_seq,
+    add_mutations,
+    mutation_rate,
+    ploidy,
+    cancel_token=None,
+):
+    stats_per_replicate = []
+    for stats in _iter_replicates_stats(
+        sim_ancestry_kwargs,
+        num_replicates,
+        seed_seq,
+        add_mutations,
+        mutation_rate,
+        ploidy,
+    ):
+        stats_per_replicate.append(stats)
+        if cancel_token is not None:
+            cancel_token.check()
+    return stats_per_replicate
+
+
+def _split_num_replicates(num_replicates, num_jobs):
+    num_jobs = max(min(num_jobs, num_replicates), 1)
+    nums = [num_replicates // num_jobs] * num_jobs
+    for idx in range(num_replicates % num_jobs):
+        nums[idx] += 1
+    return nums
+
+
+def _aggregate_replicate_stats(stats_per_replicate, confidence):
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    aggregated_stats = {}
+    for param in stats_per_replicate[0].keys():
+        values = pandas.concat(
+            [stats[param] for stats in stats_per_replicate],
+            axis=1,
+            ignore_index=True,
+        )
+        mean = values.mean(axis=1)
+        num_values = values.count(axis=1)
+        sem = values.std(axis=1, ddof=1) / numpy.sqrt(num_values)
+        aggregated_stats[param] = pandas.DataFrame(
+            {
+                "mean": mean,
+                "ci_low": mean - z * sem,
+                "ci_high": mean + z * sem,
+                "num_replicates": num_values,
+            }
+        )
+    return aggregated_stats
+
+
+def _create_replicates_jobs_args(
+    sample_sets,
+    demography,
+    model,
+    seq_length_in_bp,
+    num_replicates,
+    recomb_rate,
+    add_mutations,
+    random_seed,
+    mutation_rate,
+    ploidy,
+):
+    sim_ancestry_kwargs = _create_sim_ancestry_kwargs(
+        sample_sets, demography, model, seq_length_in_bp, recomb_rate, None
+    )
+
+    nums_replicates = _split_num_replicates(num_replicates, NUM_REPLICATE_JOBS)
+    seed_seqs = numpy.random.SeedSequence(random_seed).spawn(len(nums_replicates))
+    return [
+        (
+            sim_ancestry_kwargs,
+            job_num_replicates,
+            seed_seq,
+            add_mutations,
+            mutation_rate,
+            ploidy,
+        )
+        for job_num_replicates, seed_seq in zip(nums_replicates, seed_seqs)
+    ]
+
+
+def simulate_replicates(
+    sample_sets: list[msprime.SampleSet],
+    demography: msprime.Demography,
+    model: None,
+    seq_length_in_bp: int,
+    num_replicates: int,
+    recomb_rate=1e-8,
+    add_mutations=True,
+    random_seed=None,
+    mutation_rate=1e-8,
+    ploidy=2,
+    confidence=0.95,
+    use_process_pool=True,
+):
+    jobs_args = _create_replicates_jobs_args(
+        sample_sets,
+        demography,
+        model,
+        seq_length_in_bp,
+        num_replicates,
+        recomb_rate,
+        add_mutations,
+        random_seed,
+        mutation_rate,
+        ploidy,
+    )
+
+    pool = _get_process_pool() if use_process_pool else None
+    if pool is None:
+        results = [_simulate_replicates_and_calc_stats(*args) for args in jobs_args]
+    else:
+        futures = [
+            pool.submit(_simulate_replicates_and_calc_stats, *args)
+            for args in jobs_args
+        ]
+        results = [future.result() for future in futures]
+
+    stats_per_replicate = [stats for result in results for stats in result]
+    return _aggregate_replicate_stats(stats_per_replicate, confidence=confidence)
+
+
+async def simulate_replicates_async(
+    sample_sets: list[msprime.SampleSet],
+    demography: msprime.Demography,
+    model: None,
+    seq_length_in_bp: int,
+    num_replicates: int,
+    recomb_rate=1e-8,
+    add_mutations=True,
+    random_seed=None,
+    mutation_rate=1e-8,
+    ploidy=2,
+    confidence=0.95,
+    progress_callback=None,
+    cancel_token=None,
+):
+    # As simulate_async, the jobs run in the worker processes, if available, if
+    # not, the control is given back to the event loop after every replicate
+    jobs_args = _create_replicates_jobs_args(
+        sample_sets,
+        demography,
+        model,
+        seq_length_in_bp,
+        num_replicates,
+        recomb_rate,
+        add_mutations,
+        random_seed,
+        mutation_rate,
+        ploidy,
+    )
+
+    stats_per_replicate = []
+    pool = _get_process_pool()
+    if pool is None:
+        for args in jobs_args:
+            for stats in _iter_replicates_stats(*args):
+                stats_per_replicate.append(stats)
+                if progress_callback is not None:
+                    progress_callback(
+                        len(stats_per_replicate) / num_replicates,
+                        f"{len(stats_per_replicate)} of {num_replicates} replicates",
+                    )
+                if cancel_token is not None:
+                    cancel_token.check()
+                await asyncio.sleep(0)
+    else:
+        loop = asyncio.get_running_loop()
+        futures = [
+            loop.run_in_executor(
+                pool, _simulate_replicates_and_calc_stats, *args, cancel_token
+            )
+            for args in jobs_args
+        ]
+        # the jobs are collected in order, so the result does not depend on which
+        # worker finished first
+        try:
+            for future in futures:
+                stats_per_replicate.extend(await future)
+                if progress_callback is not None:
+                    progress_callback(
+                        len(stats_per_replicate) / num_replicates,
+                        f"{len(stats_per_replicate)} of {num_replicates} replicates",
+                    )
+        finally:
+            for future in futures:
+                future.cancel()
+
+    return _aggregate_replicate_stats(stats_per_replicate, confidence=confidence)
@@ -1,13 +1,15 @@
+import itertools
 import math
 from urllib.parse import unquote, urlencode
 import json
 
 from shiny import App, reactive, render, ui, module
+import numpy
 import pandas
-import matplotlib.pyplot as plt
-from matplotlib.lines import Line2D
 
-from one_locus_two_alleles_simulator import OneLocusTwoAlleleSimulation, INF
+from one_locus_two_alleles_simulator import INF, simulate_async
+from sim_jobs import SimulationJobs
+from figures import SessionFigures
 import config as config_module
 import style
 
@@ -52,6 +54,16 @@ def create_exp_het_panel():
     return panel
 
 
+def _create_segments(seriess):
+    # one segment per replicate, for a LineCollection
+    return [numpy.column_stack((series.index, series.values)) for series in seriess]
+
+
+def _get_colors(keys):
+    # the same key always gets the same color, so the figure can keep its legend
+    return dict(zip(keys, itertools.cycle(style.COLORS)))
+
+
 def create_geno_freqs_plot_id(pop_name):
     return f"genotypic_freqs_plot_{pop_name}"
 
@@ -62,31 +74,22 @@ def genotypic_plot_ui():
 
 
 @module.server
-def genotypic_plot_server(input, output, session, geno_freqs: dict):
+def genotypic_plot_server(input, output, session, geno_freqs: dict, figure):
+    # The figure is kept by the app, this module is created again every time
+    # the genotypic plots are rendered
     @render.plot
     def genotypic_plot():
-        fig, axes = plt.subplots()
-        axes.set_title("Genotypic freqs.")
-        axes.set_xlabel("generation")
-        axes.set_ylabel("freq")
-
-        colors = {}
-        for geno_freq_label, geno_freqs_seriess in geno_freqs.items():
-            color = colors.setdefault(geno_freq_label, next(style.COLOR_CYCLE))
-            for geno_freqs_series in geno_freqs_seriess:
-                axes.plot(
-                    geno_freqs_series.index,
-                    geno_freqs_series.values,
-                    label=geno_freq_label,
-                    color=color,
-                )
-        legend_lines = [
-            Line2D([0], [0], color=colors[freq_label], lw=2)
-            for freq_label in sorted(colors.keys())
-        ]
-        axes.legend(legend_lines, sorted(colors.keys()))
+        labels = sorted(geno_freqs.keys())
+        colors = _get_colors(labels)
+        line_collections = {}
+        for geno_freq_label in labels:
+            line_collections[geno_freq_label] = {
+                "segments": _create_segments(geno_freqs[geno_freq_label]),
+                "style": {"label": geno_freq_label, "color": colors[geno_freq_label]},
+            }
+        axes = figure.update_lines(line_collections=line_collections, legend=True)
         axes.set_ylim((0, 1))
-        return fig
+        return figure.fig
 
 
 def create_geno_freqs_module_plot_id(pop_name):
@@ -588,43 +591,70 @@ def server(input, output, session):
 
         return {"sim_params": sim_params, "num_simulations": num_simulations}
 
-    @reactive.calc
+    # The simulations do not block the app, they run in worker processes or,
+    # in shinylive, in chunks
+    sim_jobs = SimulationJobs()
+    session.on_ended(sim_jobs.cancel)
+
+    @reactive.extended_task
+    async def simulation_task(sim_params, num_simulations, cancel_token):
+        with ui.Progress(session=session) as progress:
+            progress.set(message="Simulating")
+
+            def report_progress(fraction, message):
+                progress.set(fraction, message="Simulating", detail=message)
+
+            return await simulate_async(
+                sim_params,
+                num_simulations,
+                progress_callback=report_progress,
+                cancel_token=cancel_token,
+            )
+
+    @reactive.effect
     @reactive.event(input.run_button, ignore_none=False)
-    def run_simulations():
+    def start_simulations():
         res = get_sim_params()
-        sims = [
-            OneLocusTwoAlleleSimulation(res["sim_params"])
-            for _ in range(res["num_simulations"])
-        ]
-        return sims
+        # a new run cancels the one that might be still running, also in the
+        # worker processes
+        simulation_task.cancel()
+        cancel_token = sim_jobs.start_run()
+        simulation_task.invoke(res["sim_params"], res["num_simulations"], cancel_token)
+
+    @reactive.calc
+    def run_simulations():
+        return simulation_task.result()
+
+    # The replicates of every pop are plotted as one LineCollection in a figure
+    # kept for the session, so rendering does not get slower with the number of
+    # replicates, nor the memory grows with every simulation
+    figures = SessionFigures(session)
+
+    def get_replicate_line_collections(sims, result):
+        pops = sims[0].results[result].columns
+        colors = _get_colors(pops)
+        line_collections = {}
+        for pop in pops:
+            line_collections[pop] = {
+                "segments": _create_segments(sim.results[result][pop] for sim in sims),
+                "style": {"label": pop, "color": colors[pop]},
+            }
+        return line_collections
 
     @render.plot(alt="Freq. A plot")
     def allelic_freqs_plot():
         sims = run_simulations()
 
-        fig, axes = plt.subplots()
-        axes.set_title("Freq. A")
-        axes.set_xlabel("generation")
-        axes.set_ylabel("freq")
-
-        colors = {}
-        for sim in sims:
-            freqs_dframe = sim.results["allelic_freqs"]
-            for pop, pop_allelic_freqs in freqs_dframe.items():
-                color = colors.setdefault(pop, next(style.COLOR_CYCLE))
-                axes.plot(
-                    pop_allelic_freqs.index,
-                    pop_allelic_freqs.values,
-                    label=pop,
-                    color=color,
-                )
-
-        num_pops = freqs_dframe.shape[1]
-        if num_pops > 1:
-            axes.legend()
-
+        line_collections = get_replicate_line_collections(sims, "allelic_freqs")
+        figure = figures.get(
+            "allelic_freqs_plot", title="Freq. A", xlabel="generation", ylabel="freq"
+        )
+        num_pops = len(line_collections)
+        axes = figure.update_lines(
+            line_collections=line_collections, legend=num_pops > 1
+        )
         axes.set_ylim((0, 1))
-        return fig
+        return figure.fig
 
     @render.data_frame
     def allelic_freqs_df():
@@ -671,7 +701,16 @@ def server(input, output, session):
                     sim.results["genotypic_freqs"][geno_freq_label][pop] for sim in sims
                 ]
             # Dynamically create server-side functions for each plot
-            genotypic_plot_server(module_id, geno_freqs=geno_freqs)
+            genotypic_plot_server(
+                module_id,
+                geno_freqs=geno_freqs,
+                figure=figures.get(
+                    module_id,
+                    title="Genotypic freqs.",
+                    xlabel="generation",
+                    ylabel="freq",
+                ),
+            )
 
         if len(plots) == 1:
             output_content = plot
@@ -686,27 +725,19 @@ def server(input, output, session):
     def exp_het_plot():
         sims = run_simulations()
 
-        fig, axes = plt.subplots()
-        axes.set_title("Expected Het.")
-        axes.set_xlabel("generation")
-        axes.set_ylabel("Exp. Het.")
-
-        colors = {}
-        for sim in sims:
-            exp_hets_dframe = sim.results["expected_hets"]
-
-            for pop, pop_exp_hets in exp_hets_dframe.items():
-                color = colors.setdefault(pop, next(style.COLOR_CYCLE))
-                axes.plot(
-                    pop_exp_hets.index, pop_exp_hets.values, label=pop, color=color
-                )
-
-        num_pops = exp_hets_dframe.shape[1]
-        if num_pops > 1:
-            axes.legend()
-
+        line_collections = get_replicate_line_collections(sims, "expected_hets")
+        figure = figures.get(
+            "exp_het_plot",
+            title="Expected Het.",
+            xlabel="generation",
+            ylabel="Exp. Het.",
+        )
+        num_pops = len(line_collections)
+        axes = figure.update_lines(
+            line_collections=line_collections, legend=num_pops > 1
+        )
         axes.set_ylim((0, 0.6))
-        return fig
+        return figure.fig
 
     @render.data_frame
     def expected_hets_df():
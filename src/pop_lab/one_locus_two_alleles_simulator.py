@@ -1,6 +1,9 @@
 from typing import Callable, Iterable
+import asyncio
 import random
 import math
+import os
+import time
 from array import array
 from collections import defaultdict, namedtuple
 import copy
@@ -8,6 +11,12 @@ import copy
 import numpy
 import pandas
 
+# the apps import the modules by name, not from the pop_lab package
+try:
+    from . import sim_jobs
+except ImportError:
+    import sim_jobs
+
 INF = math.inf
 
 MENDELIAN_SEGREGATIONS = {
@@ -153,7 +162,9 @@ class Population:
         else:
             return "Aa"
 
-    def evolve_to_next_generation(self, migration_origins=None):
+    def evolve_to_next_generation(self, migration_origins=None, phase_timer=None):
+        if phase_timer is not None:
+            phase_start = time.perf_counter()
         genotypic_freqs = self.genotypic_freqs
 
         if migration_origins is None:
@@ -188,6 +199,8 @@ class Population:
             ]
         )
         assert math.isclose(freq_AA + freq_Aa + freq_aa, 1)
+        if phase_timer is not None:
+            phase_start = phase_timer.add("migration", phase_start)
 
         # selection
         fitness = self.fitness
@@ -200,6 +213,8 @@ class Population:
             freq_Aa = freq_Aa / sum_freqs
             freq_aa = freq_aa / sum_freqs
             assert math.isclose(freq_AA + freq_Aa + freq_aa, 1)
+        if phase_timer is not None:
+            phase_start = phase_timer.add("selection", phase_start)
 
         # mutation
         if self.mut_rates:
@@ -224,6 +239,8 @@ class Population:
             assert math.isclose(AA1 + Aa1 + aa1, 1)
             freq_AA = AA1
             freq_Aa = Aa1
+        if phase_timer is not None:
+            phase_start = phase_timer.add("mutation", phase_start)
 
         # drift
         selfing_rate = self.selfing_rate
@@ -272,6 +289,8 @@ class Population:
             freq_Aa = num_Aa / total_indis
 
         self.genotypic_freqs = GenotypicFreqs(freq_AA, freq_Aa)
+        if phase_timer is not None:
+            phase_timer.add("drift", phase_start)
 
 
 def _update_events(demographic_events, num_generation, active_migrations):
@@ -288,13 +307,55 @@ def _update_events(demographic_events, num_generation, active_migrations):
             del active_migrations[event["migration_id"]]
 
 
-def simulate_forward_in_time(
+# Aggregated time spent in every phase of the simulation, pass it to
+# simulate_forward_in_time to find out which evolutionary force dominates
+class PhaseTimer:
+    PHASES = ("events", "migration", "selection", "mutation", "drift", "logging")
+
+    def __init__(self):
+        self.total_times = dict.fromkeys(self.PHASES, 0.0)
+        self.num_calls = dict.fromkeys(self.PHASES, 0)
+
+    def add(self, phase, start):
+        now = time.perf_counter()
+        self.total_times[phase] += now - start
+        self.num_calls[phase] += 1
+        return now
+
+    @property
+    def summary(self):
+        total_time = sum(self.total_times.values())
+        summary = {}
+        for phase in self.PHASES:
+            num_calls = self.num_calls[phase]
+            phase_time = self.total_times[phase]
+            summary[phase] = {
+                "total_time_s": phase_time,
+                "num_calls": num_calls,
+                "mean_time_s": phase_time / num_calls if num_calls else 0.0,
+                "fraction": phase_time / total_time if total_time else 0.0,
+            }
+        return summary
+
+
+def iter_forward_in_time(
     pops: list[Population],
     num_generations: int,
     loggers: list[Callable],
     demographic_events: list[dict] | None = None,
     random_seed: int | None = None,
+    before_generation_callbacks: list[Callable] | None = None,
+    after_generation_callbacks: list[Callable] | None = None,
+    phase_timer: PhaseTimer | None = None,
 ):
+    # It yields the number of every generation once simulated, so the caller can
+    # do something else between generations.
+    # The callbacks are called like the loggers, with the pops and the generation
+    if before_generation_callbacks is None:
+        before_generation_callbacks = []
+    if after_generation_callbacks is None:
+        after_generation_callbacks = []
+
     if random_seed is not None:
         numpy.random.seed(random_seed)
         random.seed(random_seed)
@@ -308,7 +369,14 @@ def simulate_forward_in_time(
     _update_events(demographic_events, 1, active_migrations)
 
     for num_generation in range(2, num_generations + 1):
+        for callback in before_generation_callbacks:
+            callback(pops, num_generation)
+
+        if phase_timer is not None:
+            phase_start = time.perf_counter()
         _update_events(demographic_events, num_generation, active_migrations)
+        if phase_timer is not None:
+            phase_timer.add("events", phase_start)
 
         for pop in pops:
             migration_origin_pops = defaultdict(list)
@@ -320,10 +388,44 @@ def simulate_forward_in_time(
                             "inmigrant_rate": migration["inmigrant_rate"],
                         }
                     )
-            pop.evolve_to_next_generation(migration_origin_pops[pop.id])
+            pop.evolve_to_next_generation(
+                migration_origin_pops[pop.id], phase_timer=phase_timer
+            )
 
+        if phase_timer is not None:
+            phase_start = time.perf_counter()
         for logger in loggers:
             logger(pops, num_generation)
+        if phase_timer is not None:
+            phase_timer.add("logging", phase_start)
+
+        for callback in after_generation_callbacks:
+            callback(pops, num_generation)
+
+        yield num_generation
+
+
+def simulate_forward_in_time(
+    pops: list[Population],
+    num_generations: int,
+    loggers: list[Callable],
+    demographic_events: list[dict] | None = None,
+    random_seed: int | None = None,
+    before_generation_callbacks: list[Callable] | None = None,
+    after_generation_callbacks: list[Callable] | None = None,
+    phase_timer: PhaseTimer | None = None,
+):
+    for _ in iter_forward_in_time(
+        pops,
+        num_generations=num_generations,
+        loggers=loggers,
+        demographic_events=demographic_events,
+        random_seed=random_seed,
+        before_generation_callbacks=before_generation_callbacks,
+        after_generation_callbacks=after_generation_callbacks,
+        phase_timer=phase_timer,
+    ):
+        pass
 
 
 class _PerPopLogger:
@@ -449,21 +551,55 @@ LOGGER_PARAMETERS = {
 
 
 class OneLocusTwoAlleleSimulation:
-    def __init__(self, sim_definition: dict):
-        sim_definition = copy.deepcopy(sim_definition)
+    def __init__(
+        self,
+        sim_definition: dict,
+        phase_timer: PhaseTimer | None = None,
+        random_seed: int | None = None,
+        run: bool = True,
+        cancel_token=None,
+    ):
+        # With run=False the simulation is done afterwards, with run or iter_run.
+        # The check method of the cancel token is called after every generation,
+        # it raises if the run has been cancelled
+        self._sim_definition = copy.deepcopy(sim_definition)
+        self._phase_timer = phase_timer
+        self._random_seed = random_seed
+        self._cancel_token = cancel_token
+        self.num_generations = sim_definition["num_generations"]
+        self.results = None
+        if run:
+            self.run()
+
+    def iter_run(self):
+        # it yields every simulated generation, the results are set at the end
+        sim_definition = self._sim_definition
         pops = self._create_pops(sim_definition["pops"])
         events = self._create_demographic_events(
             sim_definition.get("demographic_events", {}), pops
         )
         loggers = self._create_loggers(sim_definition["loggers"])
-        simulate_forward_in_time(
+        after_generation_callbacks = []
+        if self._cancel_token is not None:
+            cancel_token = self._cancel_token
+            after_generation_callbacks.append(
+                lambda pops, num_generation: cancel_token.check()
+            )
+        yield from iter_forward_in_time(
             list(pops.values()),
             num_generations=sim_definition["num_generations"],
             demographic_events=events,
             loggers=loggers,
+            random_seed=self._random_seed,
+            after_generation_callbacks=after_generation_callbacks,
+            phase_timer=self._phase_timer,
         )
         self.results = self._gather_results(loggers)
 
+    def run(self):
+        for _ in self.iter_run():
+            pass
+
     @staticmethod
     def _create_pops(pop_definitions):
         pops = {}
@@ -610,3 +746,109 @@ def simulate_one_locus_two_alleles_one_pop(
     }
 
     return loggers
+
+
+# In pyodide (shinylive) the simulations run in the thread that serves the app, so
+# they give the control back to the event loop at least every interval, in seconds
+ASYNC_YIELD_INTERVAL = 0.05
+# Every worker process gets a few chunks of replicates, not one task per
+# replicate, so sending the tasks does not take longer than many short
+# simulations, and there is still some progress to report
+NUM_CHUNKS_PER_WORKER = 4
+
+
+def _get_process_pool():
+    return sim_jobs.get_process_pool()
+
+
+def _create_random_seeds(num_seeds):
+    # the worker processes could share the random state of the parent process
+    seed_seqs = numpy.random.SeedSequence().spawn(num_seeds)
+    return [int(seed_seq.generate_state(1)[0]) for seed_seq in seed_seqs]
+
+
+async def _simulate_in_chunks(
+    sim_definition, num_simulations, progress_callback, cancel_token
+):
+    sims = []
+    last_yield_time = time.perf_counter()
+    for sim_idx in range(num_simulations):
+        sim = OneLocusTwoAlleleSimulation(
+            sim_definition, run=False, cancel_token=cancel_token
+        )
+        for num_generation in sim.iter_run():
+            if time.perf_counter() - last_yield_time < ASYNC_YIELD_INTERVAL:
+                continue
+            if progress_callback is not None:
+                num_sims_done = sim_idx + num_generation / sim.num_generations
+                progress_callback(
+                    num_sims_done / num_simulations, f"Simulation {sim_idx + 1}"
+                )
+            # a cancelled task stops here
+            await asyncio.sleep(0)
+            last_yield_time = time.perf_counter()
+        sims.append(sim)
+    return sims
+
+
+def _simulate_replicates(sim_definition, random_seeds, cancel_token):
+    return [
+        OneLocusTwoAlleleSimulation(
+            sim_definition, random_seed=random_seed, cancel_token=cancel_token
+        )
+        for random_seed in random_seeds
+    ]
+
+
+async def _simulate_in_process_pool(
+    sim_definition, num_simulations, progress_callback, cancel_token, pool
+):
+    # the cancel token reaches the running simulations in the worker processes
+    num_chunks = min(num_simulations, (os.cpu_count() or 1) * NUM_CHUNKS_PER_WORKER)
+    seed_chunks = numpy.array_split(
+        _create_random_seeds(num_simulations), max(num_chunks, 1)
+    )
+    loop = asyncio.get_running_loop()
+    futures = [
+        loop.run_in_executor(
+            pool,
+            _simulate_replicates,
+            sim_definition,
+            seed_chunk.tolist(),
+            cancel_token,
+        )
+        for seed_chunk in seed_chunks
+    ]
+    sims = []
+    try:
+        for future in futures:
+            sims.extend(await future)
+            if progress_callback is not None:
+                progress_callback(
+                    len(sims) / num_simulations, f"Simulation {len(sims)}"
+                )
+    except asyncio.CancelledError:
+        # the chunks not yet started are not run
+        for future in futures:
+            future.cancel()
+        raise
+    return sims
+
+
+async def simulate_async(
+    sim_definition: dict,
+    num_simulations: int = 1,
+    progress_callback: Callable | None = None,
+    cancel_token=None,
+):
+    # The simulations run in worker processes, in chunks of replicates, if
+    # available, if not, in chunks that let the app attend the user between them.
+    # The progress callback is called with the fraction done and a message
+    pool = _get_process_pool()
+    if pool is None:
+        return await _simulate_in_chunks(
+            sim_definition, num_simulations, progress_callback, cancel_token
+        )
+    return await _simulate_in_process_pool(
+        sim_definition, num_simulations, progress_callback, cancel_token, pool
+    )
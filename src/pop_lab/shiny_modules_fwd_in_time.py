@@ -1,14 +1,15 @@
 import math
 
 from shiny import module, reactive, render, ui
-import matplotlib.pyplot as plt
 import pandas
 
 from one_locus_two_alleles_simulator import (
-    OneLocusTwoAlleleSimulation,
+    simulate_async,
     INF,
     MutRates,
 )
+from sim_jobs import SimulationJobs
+from figures import SessionFigures
 from fwd_in_time_app_specific_code import (
     SELECT_FITNESS,
     SELECT_MUTATION,
@@ -198,6 +199,8 @@ def fwd_in_time_ui():
 
 @module.server
 def fwd_in_time_server(input, output, session):
+    figures = SessionFigures(session)
+
     def get_pop_size():
         pop_size = int(input.pop_size_slider())
         if input.pop_is_inf_checkbox():
@@ -306,9 +309,7 @@ def fwd_in_time_server(input, output, session):
             selfing_rate = 0.0
         return selfing_rate
 
-    @reactive.calc
-    @reactive.event(input.run_button)
-    def do_simulation():
+    def get_sim_params():
         sim_params = {
             "pops": {
                 "pop1": {
@@ -336,57 +337,104 @@ def fwd_in_time_server(input, output, session):
         A2a, a2A = get_mutation_rates()
         if not math.isclose(A2a, 0) or not math.isclose(a2A, 0):
             sim_params["pops"]["pop1"]["mut_rates"] = MutRates(A2a, a2A)
+        return sim_params
+
+    # The simulation does not block the app, it runs in a worker process or,
+    # in shinylive, in chunks
+    sim_jobs = SimulationJobs()
+    session.on_ended(sim_jobs.cancel)
+
+    @reactive.extended_task
+    async def simulation_task(sim_params, cancel_token):
+        with ui.Progress(session=session) as progress:
+            progress.set(message="Simulating")
 
-        sim = OneLocusTwoAlleleSimulation(sim_params)
-        return sim
+            def report_progress(fraction, message):
+                progress.set(fraction, message="Simulating", detail=message)
+
+            sims = await simulate_async(
+                sim_params,
+                progress_callback=report_progress,
+                cancel_token=cancel_token,
+            )
+        return sims[0]
+
+    @reactive.effect
+    @reactive.event(input.run_button)
+    def start_simulation():
+        sim_params = get_sim_params()
+        # a new run cancels the one that might be still running, also in the
+        # worker process
+        simulation_task.cancel()
+        simulation_task.invoke(sim_params, sim_jobs.start_run())
+
+    @reactive.calc
+    def do_simulation():
+        return simulation_task.result()
 
     @render.plot(alt="Genotypic freqs.")
     def geno_freqs_plot():
         sim = do_simulation()
 
-        fig, axes = plt.subplots()
-        axes.set_title("Genotypic freqs.")
-        axes.set_xlabel("generation")
-        axes.set_ylabel("freq")
-
         genotypic_freqs = sim.results["genotypic_freqs"]
         geno_freqs_labels = sorted(genotypic_freqs.keys())
+        lines = {}
         for geno_freq_label in geno_freqs_labels:
             geno_freqs_series = genotypic_freqs[geno_freq_label]
-            axes.plot(
-                geno_freqs_series.index, geno_freqs_series.values, label=geno_freq_label
-            )
-        axes.legend()
+            lines[geno_freq_label] = {
+                "xs": geno_freqs_series.index,
+                "ys": geno_freqs_series.values,
+                "style": {"label": geno_freq_label},
+            }
+        figure = figures.get(
+            "geno_freqs_plot",
+            title="Genotypic freqs.",
+            xlabel="generation",
+            ylabel="freq",
+        )
+        axes = figure.update_lines(lines=lines, legend=True)
         axes.set_ylim((0, 1))
-        return fig
+        return figure.fig
 
     @render.plot(alt="Freq. A")
     def freq_A_plot():
         sim = do_simulation()
 
-        fig, axes = plt.subplots()
-        axes.set_title("Freq. A")
-        axes.set_xlabel("generation")
-        axes.set_ylabel("freq")
-
         freqs_series = sim.results["allelic_freqs"]
-        axes.plot(freqs_series.index, freqs_series.values, label="Freq. A")
+        line = {
+            "xs": freqs_series.index,
+            "ys": freqs_series.values,
+            "style": {"label": "Freq. A"},
+        }
+        figure = figures.get(
+            "freq_A_plot",
+            title="Freq. A",
+            xlabel="generation",
+            ylabel="freq",
+        )
+        axes = figure.update_lines(lines={"freq_A": line})
         axes.set_ylim((0, 1))
-        return fig
+        return figure.fig
 
     @render.plot(alt="Exp. Het.")
     def exp_het_plot():
         sim = do_simulation()
 
-        fig, axes = plt.subplots()
-        axes.set_title("Expected Het.")
-        axes.set_xlabel("generation")
-        axes.set_ylabel("Exp. Het.")
-
         freqs_series = sim.results["expected_hets"]
-        axes.plot(freqs_series.index, freqs_series.values, label="Exp. Het.")
+        line = {
+            "xs": freqs_series.index,
+            "ys": freqs_series.values,
+            "style": {"label": "Exp. Het."},
+        }
+        figure = figures.get(
+            "exp_het_plot",
+            title="Expected Het.",
+            xlabel="generation",
+            ylabel="Exp. Het.",
+        )
+        axes = figure.update_lines(lines={"exp_het": line})
         axes.set_ylim((0, 1))
-        return fig
+        return figure.fig
 
     @render.data_frame
     def summary_table():
@@ -1,20 +1,21 @@
-from array import array
+import functools
+import itertools
+import logging
+from pathlib import Path
 
 from shiny import ui, module, reactive, render
 
 import numpy
 import pandas
-import demesdraw
-import matplotlib.pyplot as plt
-import statsmodels.api as sm
 
 import shiny_module_sim_demography
 import msprime_sim_utils
+from sim_jobs import SimulationJobs, SimulationCancelled
+from figures import SessionFigures
 from style import COLOR_CYCLE, MARKER_CYCLE, LINESTYLES_CYCLE, COLORS
-import pynei
 
-PCA_MAX_MAF = 0.95
-MIN_LD_R2 = 0.1
+PCA_MAX_MAF = msprime_sim_utils.PCA_MAX_MAF
+MIN_LD_R2 = msprime_sim_utils.MIN_LD_R2
 MIN_NUM_VARS_FOR_PCA = 10
 
 
@@ -53,6 +54,9 @@ MIN_SAMPLE_SIZE = 20
 DEF_SAMPLE_SIZE = 50
 MAX_SAMPLE_SIZE = 100
 
+# Recombination makes the default simulations from 2 to 100 times slower
+DEF_NO_RECOMB = True
+
 THIN_LINE = 1
 BROAD_LINE = 2
 UNUSED_STYLE = {
@@ -97,7 +101,7 @@ def msprime_params_ui():
                 ),
             ),
             ui.input_checkbox(
-                "no_recomb_checkbox", label="No recombination", value=False
+                "no_recomb_checkbox", label="No recombination", value=DEF_NO_RECOMB
             ),
             col_widths=(10, 2),
         ),
@@ -141,23 +145,43 @@ def msprime_params_ui():
     return msprime_accordions
 
 
+def create_msprime_params(
+    sample_size, seq_length_in_bp, log_mut_rate, no_recomb, log_recomb_rate
+):
+    mut_rate = 10**log_mut_rate
+    if no_recomb:
+        recomb_rate = 0
+    else:
+        recomb_rate = 10**log_recomb_rate
+    return {
+        "sample_size": sample_size,
+        "seq_length_in_bp": seq_length_in_bp,
+        "mut_rate": mut_rate,
+        "recomb_rate": recomb_rate,
+    }
+
+
+def get_default_msprime_params():
+    return create_msprime_params(
+        sample_size=DEF_SAMPLE_SIZE,
+        seq_length_in_bp=shiny_module_sim_demography.DEF_SEQ_LENGTH,
+        log_mut_rate=DEF_MUT_RATE,
+        no_recomb=DEF_NO_RECOMB,
+        log_recomb_rate=shiny_module_sim_demography.DEF_RECOMB_RATE,
+    )
+
+
 @module.server
 def msprime_params_server(input, output, session):
     @reactive.calc
     def get_msprime_params():
-        sample_size = input.sample_size_slider()
-        seq_length_in_bp = input.seq_len_slider()
-        mut_rate = 10 ** input.mut_rate_slider()
-        if input.no_recomb_checkbox:
-            recomb_rate = 0
-        else:
-            recomb_rate = 10 ** input.recomb_rate_slider()
-        return {
-            "sample_size": sample_size,
-            "seq_length_in_bp": seq_length_in_bp,
-            "mut_rate": mut_rate,
-            "recomb_rate": recomb_rate,
-        }
+        return create_msprime_params(
+            sample_size=input.sample_size_slider(),
+            seq_length_in_bp=input.seq_len_slider(),
+            log_mut_rate=input.mut_rate_slider(),
+            no_recomb=input.no_recomb_checkbox(),
+            log_recomb_rate=input.recomb_rate_slider(),
+        )
 
     return get_msprime_params
 
@@ -180,15 +204,22 @@ def input_params_tabs():
 
 @module.server
 def input_params_server(input, output, session, get_demography, get_msprime_params):
+    figures = SessionFigures(session)
+
     @render.plot(alt="Demographic plot")
+    @msprime_sim_utils.profile_stage("render.demographic_plot")
     def demographic_plot():
+        import demesdraw
+
         demography = get_demography()["demography"]
-        fig, axes = plt.subplots()
+        figure = figures["demographic_plot"]
+        axes = figure.clear()
         axes.plot([1, 1], [0, 0])
         demesdraw.tubes(demography.to_demes(), ax=axes)
-        return fig
+        return figure.fig
 
     @render.data_frame
+    @msprime_sim_utils.profile_stage("render.input_params_table")
     def input_params_table():
         table = Table(["Parameter", "Value"])
         demographic_params = get_demography()["params_for_table"]
@@ -215,6 +246,7 @@ def input_params_server(input, output, session, get_demography, get_msprime_para
 
 EXP_HET_PLOT_ID = "exp_het_plot"
 EXP_HET_TABLE_ID = "exp_het_table"
+BRANCH_DIVERSITY_PLOT_ID = "branch_diversity_plot"
 POLY_MARKERS_PLOT_ID = "poly_markers_plot"
 POLY_MARKERS_TABLE_ID = "poly_markers_table"
 
@@ -231,16 +263,120 @@ PLOT_DESCRIPTIONS = {
     "dists": "Dest dists. between pops.",
 }
 
+# These are calculated by the simulation worker, they are required by the first tab
+STATS_TO_CALC_WITH_SIMULATION = (
+    "calc_unbiased_exp_het",
+    "calc_branch_diversity",
+    "calc_num_variants",
+)
+# The stats shown in every results tab, the ones in the hidden tabs are calculated
+# in a worker process, all together, once the visible tab has been rendered
+RESULTS_TABS_ID = "results_tabs"
+STATS_PER_TAB = {
+    "exp_het": ("calc_unbiased_exp_het", "calc_branch_diversity"),
+    "poly_ratio_over_variables": ("calc_num_variants",),
+    "num_poly": ("calc_num_variants",),
+    "num_variable": ("calc_num_variants",),
+    AFS_PLOT_ID: ("calc_site_freq_spectrum",),
+    PCA_PLOT_ID: ("calc_pca",),
+    LD_PLOT_ID: ("calc_ld_curves",),
+    DIVERSITY_ALONG_GENOME_PLOT_ID: ("calc_exp_het_along_genome",),
+    "dists": ("calc_jost_dest_dists",),
+}
+PROFILE_TABLE_REFRESH_INTERVAL = 2
+PROFILE_TABLE_COLS = [
+    "stage",
+    "wall_time_s",
+    "cpu_time_s",
+    "peak_alloc_bytes",
+    "pid",
+]
+SIMULATION_STATUS_MSGS = {
+    "running": "Running simulation...",
+    "error": "The simulation failed",
+}
+
+# The replicates show the variation between simulations with the same parameters,
+# they are run on demand, from their own tab
+REPLICATES_TAB_ID = "replicates"
+MIN_NUM_REPLICATES = 2
+DEF_NUM_REPLICATES = 10
+MAX_NUM_REPLICATES = 100
+REPLICATES_CONFIDENCE = 0.95
+REPLICATES_STATUS_MSGS = {
+    "running": "Running replicates...",
+    "error": "The replicates failed",
+}
+REPLICATE_STATS = {
+    "exp_het": "Exp. het.",
+    "num_poly": "Num. polymorphic (95%) variants",
+}
+
 PLOT_STRS = []
 PLOT_IDS = []
 for plot_id in shiny_module_sim_demography.DESIRED_PLOTS:
     PLOT_IDS.append(plot_id)
     PLOT_STRS.append(PLOT_DESCRIPTIONS[plot_id])
+RESULTS_TABS = [
+    "exp_het",
+    "poly_ratio_over_variables",
+    "num_poly",
+    "num_variable",
+] + PLOT_IDS
+
+# The result of the simulation with the default inputs, precomputed when the site
+# is built, it is shown until a simulation with other parameters is run
+DEFAULT_RESULT_BUNDLE_FNAME = "default_result_bundle.pickle"
+DEFAULT_RESULT_RANDOM_SEED = 42
+# the seed of the first run of some parameters, the next ones use the next seeds
+SIMULATION_RANDOM_SEED = 1
+
+
+def _get_default_result_bundle_path():
+    # the demography module is the one that is always in the app dir
+    return (
+        Path(shiny_module_sim_demography.__file__).parent / DEFAULT_RESULT_BUNDLE_FNAME
+    )
+
+
+def _get_stats_shown_in_results_tabs():
+    stats = []
+    for tab in RESULTS_TABS:
+        for stat in STATS_PER_TAB[tab]:
+            if stat not in stats:
+                stats.append(stat)
+    return stats
+
+
+def create_default_result_bundle(random_seed=DEFAULT_RESULT_RANDOM_SEED):
+    msprime_params = get_default_msprime_params()
+    sim_config = shiny_module_sim_demography.get_default_sim_config(msprime_params)
+    return msprime_sim_utils.create_result_bundle(
+        sim_config["sample_sets"],
+        demography=sim_config["demography"],
+        model=sim_config.get("model", None),
+        seq_length_in_bp=msprime_params["seq_length_in_bp"],
+        recomb_rate=msprime_params["recomb_rate"],
+        mutation_rate=msprime_params["mut_rate"],
+        stats_to_calc=_get_stats_shown_in_results_tabs(),
+        random_seed=random_seed,
+    )
+
+
+def save_default_result_bundle():
+    bundle = create_default_result_bundle()
+    msprime_sim_utils.save_result_bundle(bundle, _get_default_result_bundle_path())
+
+
+@functools.cache
+def _load_default_result_bundle():
+    return msprime_sim_utils.load_result_bundle(_get_default_result_bundle_path())
 
 
 @module.ui
 def run_simulation_ui():
     run_button = ui.input_action_button("run_button", "Run simulation")
+    simulation_status = ui.output_text("simulation_status")
 
     exp_het_result = ui.navset_tab(
         ui.nav_panel(
@@ -253,6 +389,11 @@ def run_simulation_ui():
             ui.output_data_frame(EXP_HET_TABLE_ID),
             value="exp_het_table",
         ),
+        ui.nav_panel(
+            "Branch diversity",
+            ui.output_plot(BRANCH_DIVERSITY_PLOT_ID),
+            value="branch_diversity_plot",
+        ),
         selected="exp_het_plot",
     )
 
@@ -300,18 +441,22 @@ def run_simulation_ui():
         ui.nav_panel(
             "Exp. Het.",
             exp_het_result,
+            value="exp_het",
         ),
         ui.nav_panel(
             "Polymorphic (95%) ratio over variable",
             poly_ratio_result,
+            value="poly_ratio_over_variables",
         ),
         ui.nav_panel(
             "Num. polymorphic (95%) variants",
             num_poly_result,
+            value="num_poly",
         ),
         ui.nav_panel(
             "Num. variable variants",
             num_variable_result,
+            value="num_variable",
         ),
     ]
 
@@ -323,7 +468,7 @@ def run_simulation_ui():
 
         accordions = []
         if plot_id == "dists":
-            nav_panels.append(ui.nav_panel(plot_str, plot))
+            nav_panels.append(ui.nav_panel(plot_str, plot, value=plot_id))
         else:
             if len(shiny_module_sim_demography.POP_NAMES) > 1:
                 pop_switches = [
@@ -348,43 +493,340 @@ def run_simulation_ui():
                 sidebar, plot, position="right", bg="#f8f8f8"
             )
             card = ui.card(sidebar_layout)
-            nav_panels.append(ui.nav_panel(plot_str, card))
+            nav_panels.append(ui.nav_panel(plot_str, card, value=plot_id))
+
+    replicates_sidebar = ui.sidebar(
+        ui.input_slider(
+            "num_replicates_slider",
+            label="Num. replicates",
+            min=MIN_NUM_REPLICATES,
+            max=MAX_NUM_REPLICATES,
+            value=DEF_NUM_REPLICATES,
+        ),
+        ui.input_action_button("run_replicates_button", "Run replicates"),
+        ui.output_text("replicates_status"),
+        position="right",
+        bg="#f8f8f8",
+    )
+    replicates_result = ui.navset_tab(
+        *[
+            ui.nav_panel(stat_str, ui.output_plot(f"replicates_{stat}_plot"))
+            for stat, stat_str in REPLICATE_STATS.items()
+        ],
+        ui.nav_panel("Table", ui.output_data_frame("replicates_table")),
+    )
+    nav_panels.append(
+        ui.nav_panel(
+            "Replicates",
+            ui.card(ui.layout_sidebar(replicates_sidebar, replicates_result)),
+            value=REPLICATES_TAB_ID,
+        )
+    )
+
+    # only available when the profiling is enabled, see msprime_sim_utils.PROFILER
+    if msprime_sim_utils.PROFILER.enabled:
+        nav_panels.append(
+            ui.nav_panel(
+                "Diagnostics",
+                ui.output_data_frame("profile_table"),
+                value="diagnostics",
+            )
+        )
 
-    output_card = ui.navset_card_tab(*nav_panels)
+    output_card = ui.navset_card_tab(*nav_panels, id=RESULTS_TABS_ID)
 
-    return (run_button, output_card)
+    return (run_button, simulation_status, output_card)
 
 
 @module.server
 def run_simulation_server(
     input, output, session, get_sample_sets, get_demography, get_msprime_params
 ):
-    @reactive.calc()
-    @reactive.event(input.run_button)
-    def do_simulation():
-        res = get_demography()
-        demography = res["demography"]
-        model = res.get("model", None)
+    # The simulation runs in a worker process, if available, so the server is
+    # free to attend other sessions while simulating, in shinylive, in stages
+    sim_jobs = SimulationJobs()
+    session.on_ended(sim_jobs.cancel)
+    # the stats of the hidden tabs are calculated in the background
+    prefetch_jobs = SimulationJobs()
+    session.on_ended(prefetch_jobs.cancel)
+
+    @reactive.extended_task
+    async def simulation_task(sim_kwargs, cancel_token):
+        with ui.Progress(session=session) as progress:
+            progress.set(message="Simulating")
+
+            def report_progress(fraction, message):
+                progress.set(fraction, message="Simulating", detail=message)
+
+            return await msprime_sim_utils.simulate_async(
+                **sim_kwargs,
+                stats_to_calc=STATS_TO_CALC_WITH_SIMULATION,
+                progress_callback=report_progress,
+                cancel_token=cancel_token,
+            )
 
-        sample_sets = get_sample_sets()
+    last_simulation = {}
 
+    default_bundle = _load_default_result_bundle()
+    if default_bundle is None:
+        default_result = None
+    else:
+        default_result = msprime_sim_utils.SimulationResult.from_bundle(default_bundle)
+    showing_default_result = reactive.value(default_result is not None)
+
+    def create_sim_kwargs():
+        res = get_demography()
         msprime_params = get_msprime_params()
+        return {
+            "sample_sets": get_sample_sets(),
+            "demography": res["demography"],
+            "model": res.get("model", None),
+            "seq_length_in_bp": msprime_params["seq_length_in_bp"],
+            "mutation_rate": msprime_params["mut_rate"],
+            "recomb_rate": msprime_params["recomb_rate"],
+        }
 
-        sim_res = msprime_sim_utils.simulate(
+    @reactive.effect
+    @reactive.event(input.run_button)
+    def start_simulation():
+        sim_kwargs = create_sim_kwargs()
+        sample_sets = sim_kwargs["sample_sets"]
+        demography = sim_kwargs["demography"]
+        model = sim_kwargs["model"]
+        msprime_params = get_msprime_params()
+
+        # the default parameters do not need to be simulated again
+        if default_result is not None:
+            result_key = msprime_sim_utils.create_result_key(
+                sample_sets,
+                demography=demography,
+                model=model,
+                seq_length_in_bp=msprime_params["seq_length_in_bp"],
+                recomb_rate=msprime_params["recomb_rate"],
+                mutation_rate=msprime_params["mut_rate"],
+            )
+            if result_key == default_bundle["key"]:
+                simulation_task.cancel()
+                sim_jobs.cancel()
+                prefetch_task.cancel()
+                prefetch_jobs.cancel()
+                last_simulation.clear()
+                showing_default_result.set(True)
+                return
+        showing_default_result.set(False)
+
+        # If only the mutation rate has changed the ancestry of the previous
+        # simulation is reused, a click with the same parameters simulates it again
+        ancestry_key = msprime_sim_utils.create_ancestry_key(
             sample_sets,
             demography=demography,
             model=model,
             seq_length_in_bp=msprime_params["seq_length_in_bp"],
-            mutation_rate=msprime_params["mut_rate"],
             recomb_rate=msprime_params["recomb_rate"],
+            random_seed=None,
+        )
+        same_ancestry = last_simulation.get("ancestry_key") == ancestry_key
+        same_mut_rate = last_simulation.get("mut_rate") == msprime_params["mut_rate"]
+        if (
+            simulation_task.status() == "success"
+            and same_ancestry
+            and not same_mut_rate
+        ):
+            prev_sim_res = simulation_task.value()
+            sim_kwargs["ancestry_tree_seqs"] = prev_sim_res.ancestry_tree_seqs
+
+        # The n-th consecutive run of some parameters uses the n-th seed, so the
+        # same runs, in any session, get the ancestry from the cache
+        if not same_ancestry:
+            run_idx = 0
+        elif same_mut_rate:
+            run_idx = last_simulation["run_idx"] + 1
+        else:
+            run_idx = last_simulation["run_idx"]
+        sim_kwargs["random_seed"] = SIMULATION_RANDOM_SEED + run_idx
+        sim_kwargs["cache"] = msprime_sim_utils.get_default_tree_seqs_cache()
+
+        last_simulation["ancestry_key"] = ancestry_key
+        last_simulation["mut_rate"] = msprime_params["mut_rate"]
+        last_simulation["run_idx"] = run_idx
+
+        # a new click cancels the simulation that might be still running, also in
+        # the worker process
+        simulation_task.cancel()
+        prefetch_task.cancel()
+        prefetch_jobs.cancel()
+        simulation_task.invoke(sim_kwargs, sim_jobs.start_run())
+
+    @render.text
+    def simulation_status():
+        if showing_default_result():
+            return ""
+        status = simulation_task.status()
+        return SIMULATION_STATUS_MSGS.get(status, "")
+
+    @reactive.calc
+    def do_simulation():
+        if showing_default_result():
+            return default_result
+        return simulation_task.result()
+
+    # The figures are kept for the session and their lines updated in every render
+    figures = SessionFigures(session)
+
+    replicates_jobs = SimulationJobs()
+    session.on_ended(replicates_jobs.cancel)
+
+    @reactive.extended_task
+    async def replicates_task(sim_kwargs, num_replicates, cancel_token):
+        with ui.Progress(session=session) as progress:
+            progress.set(message="Simulating replicates")
+
+            def report_progress(fraction, message):
+                progress.set(fraction, message="Simulating replicates", detail=message)
+
+            return await msprime_sim_utils.simulate_replicates_async(
+                **sim_kwargs,
+                num_replicates=num_replicates,
+                confidence=REPLICATES_CONFIDENCE,
+                progress_callback=report_progress,
+                cancel_token=cancel_token,
+            )
+
+    @reactive.effect
+    @reactive.event(input.run_replicates_button)
+    def start_replicates():
+        replicates_task.cancel()
+        replicates_task.invoke(
+            create_sim_kwargs(),
+            input.num_replicates_slider(),
+            replicates_jobs.start_run(),
+        )
+
+    @render.text
+    def replicates_status():
+        return REPLICATES_STATUS_MSGS.get(replicates_task.status(), "")
+
+    def plot_replicate_stat(stat):
+        stat_res = replicates_task.result()[stat]
+        pops = sorted(stat_res.index.unique(level="pop"))
+        colors = dict(zip(pops, itertools.cycle(COLORS)))
+
+        figure = figures.get(
+            f"replicates_{stat}_plot",
+            title=f"{REPLICATE_STATS[stat]}, mean and {REPLICATES_CONFIDENCE:.0%} CI",
+            xlabel="generation",
+            ylabel=REPLICATE_STATS[stat],
+        )
+        axes = figure.clear()
+        for pop in pops:
+            pop_res = stat_res.xs(pop, level="pop").sort_index()
+            xs = -pop_res.index.to_numpy()
+            axes.plot(xs, pop_res["mean"], label=pop, color=colors[pop])
+            axes.fill_between(
+                xs, pop_res["ci_low"], pop_res["ci_high"], color=colors[pop], alpha=0.2
+            )
+        axes.set_ylim(0)
+        axes.legend()
+        return figure.fig
+
+    @render.plot(alt="Exp. het. of the replicates")
+    @msprime_sim_utils.profile_stage("render.replicates_exp_het_plot")
+    def replicates_exp_het_plot():
+        return plot_replicate_stat("exp_het")
+
+    @render.plot(alt="Num. polymorphic (95%) variants of the replicates")
+    @msprime_sim_utils.profile_stage("render.replicates_num_poly_plot")
+    def replicates_num_poly_plot():
+        return plot_replicate_stat("num_poly")
+
+    @render.data_frame
+    @msprime_sim_utils.profile_stage("render.replicates_table")
+    def replicates_table():
+        res = replicates_task.result()
+        dframes = []
+        for stat, stat_str in REPLICATE_STATS.items():
+            dframe = res[stat].reset_index()
+            dframe.insert(0, "stat", stat_str)
+            dframes.append(dframe)
+        return render.DataGrid(pandas.concat(dframes).round(3))
+
+    if msprime_sim_utils.PROFILER.enabled:
+
+        @reactive.poll(
+            lambda: msprime_sim_utils.PROFILER.num_records,
+            PROFILE_TABLE_REFRESH_INTERVAL,
         )
-        return sim_res
+        def get_profile_records():
+            return list(msprime_sim_utils.PROFILER.records)
+
+        @render.data_frame
+        def profile_table():
+            records = pandas.DataFrame(
+                get_profile_records(), columns=PROFILE_TABLE_COLS
+            )
+            return render.DataGrid(records.iloc[::-1].round(4))
+
+    prefetch_state = {"sim_res": None, "failed": set()}
+
+    @reactive.extended_task
+    async def prefetch_task(sim_res, stats, cancel_token):
+        # The prefetch is opportunistic, a stat that fails is calculated again,
+        # and its error shown, only if its tab is opened
+        try:
+            await msprime_sim_utils.calc_stats_async(
+                sim_res, stats, cancel_token=cancel_token
+            )
+        except SimulationCancelled:
+            pass
+        except Exception:
+            logging.getLogger(__name__).warning(
+                "Could not prefetch the stats %s", stats, exc_info=True
+            )
+            if prefetch_state["sim_res"] is sim_res:
+                prefetch_state["failed"].update(
+                    stat for stat in stats if stat not in sim_res.stats
+                )
+
+    # It runs after the outputs, so the visible tab is rendered first, and only
+    # with worker processes, the prefetch should not block the session
+    @reactive.effect(priority=-1)
+    def prefetch_stats_for_hidden_tabs():
+        if not msprime_sim_utils.worker_processes_available():
+            return
+        if prefetch_task.status() == "running":
+            return
+        if showing_default_result():
+            sim_res = default_result
+        elif simulation_task.status() == "success":
+            sim_res = simulation_task.value()
+        else:
+            return
+        # the default result has no tree sequences and without variants there are
+        # no stats to calculate
+        if sim_res.tree_seqs is None or not sim_res.tree_seqs.num_sites:
+            return
+        if prefetch_state["sim_res"] is not sim_res:
+            prefetch_state["sim_res"] = sim_res
+            prefetch_state["failed"] = set()
+
+        visible_tab = input[RESULTS_TABS_ID]()
+        pending_stats = {
+            stat: None
+            for tab in RESULTS_TABS
+            if tab != visible_tab
+            for stat in STATS_PER_TAB[tab]
+            if stat not in sim_res.stats and stat not in prefetch_state["failed"]
+        }
+        if not pending_stats:
+            return
+
+        # All in one worker call, so the stats share the genotypes and filters
+        prefetch_task.invoke(sim_res, list(pending_stats), prefetch_jobs.start_run())
 
     @reactive.calc
     def get_sampling_times():
         sim_res = do_simulation()
-        res = sim_res.get_vars_and_pop_samples()
-        pop_samples_info = res["pop_samples_info"]
+        pop_samples_info = sim_res.pop_samples_info
         sampling_times = {
             sample_info["sample_time"] for sample_info in pop_samples_info.values()
         }
@@ -392,7 +834,6 @@ def run_simulation_server(
         return sampling_times
 
     @reactive.effect
-    @reactive.event(input.run_button)
     def update_time_swithes():
         sampling_times = get_sampling_times()
         for plot in PLOT_IDS:
@@ -422,58 +863,83 @@ def run_simulation_server(
         num_markers = sim_res.calc_num_variants()
         return num_markers
 
+    def get_lines_by_pop(series_by_pop):
+        lines = {}
+        for pop, series in series_by_pop.items():
+            style = get_style_for_pop_and_time(pop=pop)
+            lines[pop] = {
+                "xs": list(-series.index),
+                "ys": series.values,
+                "style": {
+                    "label": pop,
+                    "color": style["color"],
+                    "linewidth": style["linewidth"],
+                    "linestyle": style["linestyle"],
+                },
+            }
+        return lines
+
     @render.plot(alt="Expected heterozygosities")
+    @msprime_sim_utils.profile_stage("render.exp_het_plot")
     def exp_het_plot():
-        fig, axes = plt.subplots()
         res = get_exp_hets()
-
-        axes.set_title("Exp. het. over time")
-        axes.set_xlabel("generation")
-        axes.set_ylabel("Exp. het.")
-        for pop, exp_het in res["exp_het_by_pop"].items():
-            style = get_style_for_pop_and_time(pop=pop)
-            axes.plot(
-                list(-exp_het.index),
-                exp_het.values,
-                label=pop,
-                color=style["color"],
-                linewidth=style["linewidth"],
-                linestyle=style["linestyle"],
-            )
+        figure = figures.get(
+            "exp_het_plot",
+            title="Exp. het. over time",
+            xlabel="generation",
+            ylabel="Exp. het.",
+        )
+        axes = figure.update_lines(
+            lines=get_lines_by_pop(res["exp_het_by_pop"]), legend=True
+        )
         axes.set_ylim(0)
-        axes.legend()
-        return fig
+        return figure.fig
+
+    # The diversity expected from the genealogies alone, without the noise of
+    # the mutations
+    @render.plot(alt="Branch diversity")
+    @msprime_sim_utils.profile_stage("render.branch_diversity_plot")
+    def branch_diversity_plot():
+        res = do_simulation().calc_branch_diversity()
+        figure = figures.get(
+            "branch_diversity_plot",
+            title="Branch diversity over time",
+            xlabel="generation",
+            ylabel="Mean pairwise branch length (generations)",
+        )
+        axes = figure.update_lines(
+            lines=get_lines_by_pop(res["branch_diversity_by_pop"]), legend=True
+        )
+        axes.set_ylim(0)
+        return figure.fig
 
     @render.data_frame
+    @msprime_sim_utils.profile_stage("render.exp_het_table")
     def exp_het_table():
         res = get_exp_hets()
         return render.DataGrid(res["exp_het_dframe"].round(2))
 
     @render.plot(alt="Polymorphic (95%) ratio over variable")
+    @msprime_sim_utils.profile_stage("render.poly_ratio_over_variables_plot")
     def poly_ratio_over_variables_plot():
         res = get_num_variants()
         param = "poly_ratio_over_variables"
         res = res[param]
 
-        fig, axes = plt.subplots()
-        axes.set_title("Polymorphic (95%) ratio over variable over time")
-        axes.set_xlabel("generation")
-        axes.set_ylabel("Polymorphic (95%) ratio over variable")
-        for pop, series in res[f"{param}_by_pop"].items():
-            style = get_style_for_pop_and_time(pop=pop)
-            axes.plot(
-                list(-series.index),
-                series.values,
-                label=pop,
-                color=style["color"],
-                linewidth=style["linewidth"],
-                linestyle=style["linestyle"],
-            )
+        figure = figures.get(
+            "poly_ratio_over_variables_plot",
+            title="Polymorphic (95%) ratio over variable over time",
+            xlabel="generation",
+            ylabel="Polymorphic (95%) ratio over variable",
+        )
+        axes = figure.update_lines(
+            lines=get_lines_by_pop(res[f"{param}_by_pop"]), legend=True
+        )
         axes.set_ylim(0)
-        axes.legend()
-        return fig
+        return figure.fig
 
     @render.data_frame
+    @msprime_sim_utils.profile_stage("render.poly_ratio_over_variables_table")
     def poly_ratio_over_variables_table():
         res = get_num_variants()
         param = "poly_ratio_over_variables"
@@ -482,30 +948,26 @@ def run_simulation_server(
         return render.DataGrid(res[f"{param}_dframe"])
 
     @render.plot(alt="Num. polymorphic (95%) variants")
+    @msprime_sim_utils.profile_stage("render.num_poly_plot")
     def num_poly_plot():
         res = get_num_variants()
         param = "num_poly"
         res = res[param]
 
-        fig, axes = plt.subplots()
-        axes.set_title("Num. polymorphic (95%) variants over time")
-        axes.set_xlabel("generation")
-        axes.set_ylabel("Num. polymorphic (95%) variants")
-        for pop, series in res[f"{param}_by_pop"].items():
-            style = get_style_for_pop_and_time(pop=pop)
-            axes.plot(
-                list(-series.index),
-                series.values,
-                label=pop,
-                color=style["color"],
-                linewidth=style["linewidth"],
-                linestyle=style["linestyle"],
-            )
+        figure = figures.get(
+            "num_poly_plot",
+            title="Num. polymorphic (95%) variants over time",
+            xlabel="generation",
+            ylabel="Num. polymorphic (95%) variants",
+        )
+        axes = figure.update_lines(
+            lines=get_lines_by_pop(res[f"{param}_by_pop"]), legend=True
+        )
         axes.set_ylim(0)
-        axes.legend()
-        return fig
+        return figure.fig
 
     @render.data_frame
+    @msprime_sim_utils.profile_stage("render.num_poly_table")
     def num_poly_table():
         res = get_num_variants()
         param = "num_poly"
@@ -514,30 +976,26 @@ def run_simulation_server(
         return render.DataGrid(res[f"{param}_dframe"])
 
     @render.plot(alt="Num. variants")
+    @msprime_sim_utils.profile_stage("render.num_variable_plot")
     def num_variable_plot():
         res = get_num_variants()
         param = "num_variable"
         res = res[param]
 
-        fig, axes = plt.subplots()
-        axes.set_title("Num. variable variants over time")
-        axes.set_xlabel("generation")
-        axes.set_ylabel("Num. variants")
-        for pop, series in res[f"{param}_by_pop"].items():
-            style = get_style_for_pop_and_time(pop=pop)
-            axes.plot(
-                list(-series.index),
-                series.values,
-                label=pop,
-                color=style["color"],
-                linewidth=style["linewidth"],
-                linestyle=style["linestyle"],
-            )
+        figure = figures.get(
+            "num_variable_plot",
+            title="Num. variable variants over time",
+            xlabel="generation",
+            ylabel="Num. variants",
+        )
+        axes = figure.update_lines(
+            lines=get_lines_by_pop(res[f"{param}_by_pop"]), legend=True
+        )
         axes.set_ylim(0)
-        axes.legend()
-        return fig
+        return figure.fig
 
     @render.data_frame
+    @msprime_sim_utils.profile_stage("render.num_variable_table")
     def num_variable_table():
         res = get_num_variants()
         param = "num_variable"
@@ -545,33 +1003,54 @@ def run_simulation_server(
 
         return render.DataGrid(res[f"{param}_dframe"])
 
-    @render.plot(alt="Allele frequency spectrum")
-    def afs_plot():
+    # The plots are done in two steps: the data to plot, that only depends on the
+    # simulation, and the drawing, that also depends on the pop and time switches.
+    # Toggling a switch only redraws.
+    @reactive.calc
+    def get_afs_plot_data():
         sim_res = do_simulation()
-        fig, axes = plt.subplots()
-        res = sim_res.get_vars_and_pop_samples()
-        pop_samples_info = res["pop_samples_info"]
-        res = sim_res.calc_allele_freq_spectrum()
-        bin_edges = res["bin_edges"]
-        x_poss = (bin_edges[1:] + bin_edges[:-1]) / 2
-        for pop_sample_name, counts in res["counts"].items():
+        pop_samples_info = sim_res.pop_samples_info
+        res = sim_res.calc_site_freq_spectrum()
+        lines = []
+        for pop_sample_name, sfs in res["sfs"].items():
             pop_sample_info = pop_samples_info[pop_sample_name]
-            generation = pop_sample_info["sample_time"]
-            pop = pop_sample_info["pop_name"]
-            style = get_style(AFS_PLOT_ID, pop=pop, time=generation)
-            axes.plot(
-                x_poss,
-                counts,
-                label=f"{pop}-{generation}",
-                color=style["color"],
-                linewidth=style["linewidth"],
-                linestyle=style["linestyle"],
+            num_samples = res["num_samples"][pop_sample_name]
+            # the monomorphic class is not plotted
+            sfs = sfs.iloc[1:]
+            lines.append(
+                {
+                    "pop": pop_sample_info["pop_name"],
+                    "time": pop_sample_info["sample_time"],
+                    "xs": sfs.index.to_numpy() / num_samples,
+                    "ys": sfs.values,
+                }
             )
-        axes.set_xlim((0.5, 1))
-        axes.set_xlabel("Allele frequency")
-        axes.set_ylabel("Num. variants")
-        axes.legend()
-        return fig
+        return lines
+
+    @render.plot(alt="Allele frequency spectrum")
+    @msprime_sim_utils.profile_stage("render.afs_plot")
+    def afs_plot():
+        lines = {}
+        for line in get_afs_plot_data():
+            generation = line["time"]
+            pop = line["pop"]
+            style = get_style(AFS_PLOT_ID, pop=pop, time=generation)
+            lines[(pop, generation)] = {
+                "xs": line["xs"],
+                "ys": line["ys"],
+                "style": {
+                    "label": f"{pop}-{generation}",
+                    "color": style["color"],
+                    "linewidth": style["linewidth"],
+                    "linestyle": style["linestyle"],
+                },
+            }
+        figure = figures.get(
+            "afs_plot", xlabel="Minor allele frequency", ylabel="Num. variants"
+        )
+        axes = figure.update_lines(lines=lines, legend=True)
+        axes.set_xlim((0, 0.5))
+        return figure.fig
 
     @reactive.calc
     def get_styles():
@@ -580,8 +1059,7 @@ def run_simulation_server(
         linestyle_cycle = LINESTYLES_CYCLE
 
         sim_res = do_simulation()
-        res = sim_res.get_vars_and_pop_samples()
-        pop_samples_info = res["pop_samples_info"]
+        pop_samples_info = sim_res.pop_samples_info
 
         pop_names = set()
         sample_times = set()
@@ -625,8 +1103,9 @@ def run_simulation_server(
 
     def get_style_for_pop_and_time(pop=None, time=None):
         styles = get_styles()
+        style = {}
         if pop is not None:
-            style = styles["pop"][pop]
+            style.update(styles["pop"][pop])
         if time is not None:
             style.update(styles["time"][time])
         complete_style = {}
@@ -642,67 +1121,68 @@ def run_simulation_server(
         return complete_style
 
     @reactive.calc
-    def _do_pca():
+    def get_pca_plot_data():
         sim_res = do_simulation()
-
-        pop_and_samples = sim_res.get_vars_and_pop_samples()
-        vars = pop_and_samples["vars"]
-        vars = pynei.filter_by_ld_and_maf(
-            vars, min_allowed_r2=MIN_LD_R2, max_allowed_maf=PCA_MAX_MAF
-        )
-
-        try:
-            pca_res = pynei.pca.do_pca_with_vars(vars, transform_to_biallelic=True)
-        except Exception as error:
-            if "DLASCL" in str(error):
-                raise RuntimeError(
-                    " PCA calculation failed, please rerun the simulation\n(This is a bug in OpenBLAS: On entry to DLASCL parameter number 4 had an illegal value)"
-                )
-            else:
-                raise error
-        return pop_and_samples, pca_res, vars
-
-    @render.plot(alt="Principal Component Analysis")
-    def pca_plot():
-        pop_and_samples, pca_res, vars = _do_pca()
-        pop_samples_info = pop_and_samples["pop_samples_info"]
-        indis_by_pop_sample = pop_and_samples["indis_by_pop_sample"]
-
-        fig, axes = plt.subplots()
+        pca_res = sim_res.calc_pca()
+        indis = sim_res.indis_per_pop_sample
+        pop_samples_info = indis["pop_samples_info"]
+        indi_idxs_by_pop_sample = indis["indi_idxs_by_pop_sample"]
 
         projections = pca_res["projections"]
         explained_variance = pca_res["explained_variance (%)"]
 
-        filter_stats = pynei.gather_filtering_stats(vars)
+        filter_stats = pca_res["filter_stats"]
 
         pop_sample_names = sorted(
             pop_samples_info.keys(),
             key=lambda pop: pop_samples_info[pop]["sample_time"],
         )
 
-        indi_names = projections.index.to_numpy()
-
         vars_kept = filter_stats["ld_and_maf"]["vars_kept"]
         if vars_kept < MIN_NUM_VARS_FOR_PCA:
             raise RuntimeError(
-                f"After filtering only {vars_kept} SNPs were kept, at leat {MIN_NUM_VARS_FOR_PCA} required to do PCA, you could rerun the simulation"
+                f"After filtering only {vars_kept} SNPs were kept, at least {MIN_NUM_VARS_FOR_PCA} are required to do the PCA, you could increase the mutation rate or the sequence length"
             )
 
         x_values = projections.iloc[:, 0].values
         y_values = projections.iloc[:, 1].values
+        points = []
         for pop_sample_name in pop_sample_names:
-            mask = numpy.isin(indi_names, indis_by_pop_sample[pop_sample_name])
+            indi_idxs = indi_idxs_by_pop_sample[pop_sample_name]
             pop_sample_info = pop_samples_info[pop_sample_name]
+            points.append(
+                {
+                    "pop": pop_sample_info["pop_name"],
+                    "time": pop_sample_info["sample_time"],
+                    "xs": x_values[indi_idxs],
+                    "ys": y_values[indi_idxs],
+                }
+            )
+        return {
+            "points": points,
+            "vars_kept": vars_kept,
+            "explained_variance": explained_variance,
+        }
 
-            time = pop_sample_info["sample_time"]
-            pop = pop_sample_info["pop_name"]
+    @render.plot(alt="Principal Component Analysis")
+    @msprime_sim_utils.profile_stage("render.pca_plot")
+    def pca_plot():
+        res = get_pca_plot_data()
+        explained_variance = res["explained_variance"]
+
+        figure = figures["pca_plot"]
+        axes = figure.clear()
+
+        for points in res["points"]:
+            time = points["time"]
+            pop = points["pop"]
             style = get_style(PCA_PLOT_ID, pop=pop, time=time)
 
             facecolor = style["color"] if style["marker_filled"] else "none"
 
             axes.scatter(
-                x_values[mask],
-                y_values[mask],
+                points["xs"],
+                points["ys"],
                 label=f"{pop}-{time}",
                 color=style["color"],
                 marker=style["marker"],
@@ -710,12 +1190,12 @@ def run_simulation_server(
                 facecolor=facecolor,
             )
         axes.set_title(
-            f"PCA done with {filter_stats['ld_and_maf']['vars_kept']} polymorphic ({int(PCA_MAX_MAF*100)}%) and not in LD (r2={MIN_LD_R2}) variations"
+            f"PCA done with {res['vars_kept']} polymorphic ({int(PCA_MAX_MAF*100)}%) and not in LD (r2={MIN_LD_R2}) variations"
         )
         axes.set_xlabel(f"PC1 ({explained_variance.iloc[0]:.2f}%)")
         axes.set_ylabel(f"PC2 ({explained_variance.iloc[1]:.2f}%)")
         axes.legend()
-        return fig
+        return figure.fig
 
     def get_style(plot_id, time, pop):
         time_switch_id = f"{plot_id}_plot_swicth_time_{time}"
@@ -735,122 +1215,100 @@ def run_simulation_server(
         return style
 
     @reactive.calc
-    def calc_ld_curves():
+    def get_ld_plot_data():
         sim_res = do_simulation()
-        fig, axes = plt.subplots()
-
-        res = sim_res.get_vars_and_pop_samples()
-        vars = res["vars"]
-        indis_by_pop_sample = res["indis_by_pop_sample"]
-        pop_samples_info = res["pop_samples_info"]
-
-        ld_curves = {}
-
-        for pop_sample_name, lds_and_dists in pynei.get_ld_and_dist_for_pops(
-            vars, indis_by_pop_sample, max_allowed_maf=0.90
-        ).items():
-            dists = array("f")
-            r2s = array("f")
-            for r2, dist in lds_and_dists:
-                r2s.append(r2)
-                dists.append(dist)
-            r2s = numpy.array(r2s, dtype=float)
-            dists = numpy.array(dists, dtype=float)
-
-            dist_delta = 0.01 * (dists.max() - dists.min())
-
-            lowess_dists_lds = sm.nonparametric.lowess(r2s, dists, delta=dist_delta)
-            lowess_dists = lowess_dists_lds[:, 0]
-            lowess_lds = lowess_dists_lds[:, 1]
-
-            xs = numpy.linspace(0, dists.max(), 50)
-            interpolated_r2 = numpy.interp(xs, lowess_dists, lowess_lds)
-
-            pop_sample_info = pop_samples_info[pop_sample_name]
-            time = pop_sample_info["sample_time"]
-            pop = pop_sample_info["pop_name"]
-            ld_curves[pop_sample_name] = {
-                "dists": xs,
-                "r2s": interpolated_r2,
-                "time": time,
-                "pop": pop,
-            }
-        return ld_curves
+        return sim_res.calc_ld_curves()
 
     @render.plot(alt="LD vs dist plot")
+    @msprime_sim_utils.profile_stage("render.ld_vs_dist_plot")
     def ld_vs_dist_plot():
-        fig, axes = plt.subplots()
-        for pop_sample_name, lds_and_dists in calc_ld_curves().items():
+        ld_curves = get_ld_plot_data()
+        lines = {}
+        for pop_sample_name, lds_and_dists in ld_curves.items():
             time = lds_and_dists["time"]
             pop = lds_and_dists["pop"]
-            dists = lds_and_dists["dists"]
-            r2s = lds_and_dists["r2s"]
             style = get_style(LD_PLOT_ID, time, pop)
-            axes.plot(
-                dists,
-                r2s,
-                label=f"{pop}-{time}",
-                color=style["color"],
-                alpha=style["alpha"],
-                linewidth=style["linewidth"],
-                linestyle=style["linestyle"],
-            )
-        axes.set_xlabel("Dist. between markers (bp.)")
-        axes.set_ylabel("Rogers & Huff r2")
-        axes.legend()
-        return fig
+            lines[pop_sample_name] = {
+                "xs": lds_and_dists["dists"],
+                "ys": lds_and_dists["r2s"],
+                "style": {
+                    "label": f"{pop}-{time}",
+                    "color": style["color"],
+                    "alpha": style["alpha"],
+                    "linewidth": style["linewidth"],
+                    "linestyle": style["linestyle"],
+                },
+            }
+        figure = figures.get(
+            "ld_vs_dist_plot",
+            xlabel="Dist. between markers (bp.)",
+            ylabel="Rogers & Huff r2",
+        )
+        figure.update_lines(lines=lines, legend=True)
+        return figure.fig
 
-    @render.plot(alt="Diversity along the genome plot")
-    def diversity_along_genome_plot():
+    @reactive.calc
+    def get_diversity_along_genome_plot_data():
         sim_res = do_simulation()
-        res = sim_res.get_vars_and_pop_samples()
-        pop_samples_info = res["pop_samples_info"]
+        pop_samples_info = sim_res.pop_samples_info
         exp_hets = sim_res.calc_exp_het_along_genome()
-
-        fig, axes = plt.subplots()
+        lines = []
         for sampling, sampling_exp_hets in exp_hets.iterrows():
             pop_sample_info = pop_samples_info[sampling]
-            time = pop_sample_info["sample_time"]
-            pop = pop_sample_info["pop_name"]
-            style = get_style(DIVERSITY_ALONG_GENOME_PLOT_ID, time, pop)
-            axes.plot(
-                sampling_exp_hets.index,
-                sampling_exp_hets.values,
-                label=f"{pop}-{time}",
-                color=style["color"],
-                alpha=style["alpha"],
-                linewidth=style["linewidth"],
-                linestyle=style["linestyle"],
+            lines.append(
+                {
+                    "pop": pop_sample_info["pop_name"],
+                    "time": pop_sample_info["sample_time"],
+                    "xs": sampling_exp_hets.index.to_numpy(),
+                    "ys": sampling_exp_hets.values,
+                }
             )
+        return lines
+
+    @render.plot(alt="Diversity along the genome plot")
+    @msprime_sim_utils.profile_stage("render.diversity_along_genome_plot")
+    def diversity_along_genome_plot():
+        lines = {}
+        for line in get_diversity_along_genome_plot_data():
+            time = line["time"]
+            pop = line["pop"]
+            style = get_style(DIVERSITY_ALONG_GENOME_PLOT_ID, time, pop)
+            lines[(pop, time)] = {
+                "xs": line["xs"],
+                "ys": line["ys"],
+                "style": {
+                    "label": f"{pop}-{time}",
+                    "color": style["color"],
+                    "alpha": style["alpha"],
+                    "linewidth": style["linewidth"],
+                    "linestyle": style["linestyle"],
+                },
+            }
+        figure = figures.get(
+            "diversity_along_genome_plot",
+            xlabel="Genomic position (bp)",
+            ylabel="Mean unbiased exp. het.",
+        )
+        axes = figure.update_lines(lines=lines)
         axes.set_ylim((0, axes.get_ylim()[1]))
-        axes.set_xlabel("Genomic position (bp)")
-        axes.set_ylabel("Mean unbiased exp. het.")
-        return fig
+        return figure.fig
 
     @render.plot(alt="Dest dists. between populations")
+    @msprime_sim_utils.profile_stage("render.dists_plot")
     def dists_plot():
         sim_res = do_simulation()
+        dists = sim_res.calc_jost_dest_dists()
 
-        res = sim_res.get_vars_and_pop_samples()
-        vars = res["vars"]
-        indis_by_pop_sample = res["indis_by_pop_sample"]
-
-        vars = pynei.filter_by_maf(vars, max_allowed_maf=0.95)
-
-        dists = pynei.calc_jost_dest_pop_dists(
-            vars,
-            pops=indis_by_pop_sample,
-        )
-
-        fig, axes = plt.subplots()
-        square_dists = dists.square_dists
+        figure = figures["dists_plot"]
+        axes = figure.clear()
+        square_dists = dists["square_dists"]
 
-        pop_names = dists.names
+        pop_names = dists["pop_names"]
 
         im = axes.imshow(square_dists, cmap="coolwarm")
 
         # Add colorbar
-        fig.colorbar(im, ax=axes)
+        figure.fig.colorbar(im, ax=axes)
 
         # pop_names = list(reversed(pop_names))
         tick_positions = numpy.arange(0, len(pop_names))
@@ -861,4 +1319,4 @@ def run_simulation_server(
         axes.set_yticklabels(pop_names)
 
         axes.tick_params(axis="x", rotation=90)
-        return fig
+        return figure.fig
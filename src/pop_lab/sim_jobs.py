@@ -0,0 +1,102 @@
+import itertools
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# The run in progress of every slot is kept in an array shared with the worker
+# processes, a run is cancelled once its slot no longer has its ID.
+# With more runs in progress than slots the oldest ones would be cancelled
+NUM_RUN_SLOTS = 4096
+
+_RUN_IDS = None
+_PROCESS_POOL = None
+_run_id_counter = itertools.count(1)
+
+
+class SimulationCancelled(Exception):
+    pass
+
+
+def _get_run_ids():
+    global _RUN_IDS
+    if _RUN_IDS is None:
+        _RUN_IDS = _create_run_ids()
+    return _RUN_IDS
+
+
+def _create_run_ids():
+    # there are no subprocesses in pyodide (shinylive), the simulations run in
+    # the same thread than the app
+    if sys.platform != "emscripten":
+        try:
+            return multiprocessing.RawArray("q", NUM_RUN_SLOTS)
+        except (ImportError, NotImplementedError, OSError):
+            pass
+    return [0] * NUM_RUN_SLOTS
+
+
+def _init_worker_process(run_ids):
+    global _RUN_IDS
+    _RUN_IDS = run_ids
+
+
+def get_process_pool():
+    # The pool shared by all the simulations, its worker processes get the
+    # shared run IDs when they start, so the cancel tokens work in them
+    global _PROCESS_POOL
+    if _PROCESS_POOL is not None:
+        return _PROCESS_POOL
+
+    run_ids = _get_run_ids()
+    if isinstance(run_ids, list):
+        return None
+    try:
+        _PROCESS_POOL = ProcessPoolExecutor(
+            initializer=_init_worker_process, initargs=(run_ids,)
+        )
+    except (ImportError, NotImplementedError, OSError):
+        return None
+    return _PROCESS_POOL
+
+
+class CancelToken:
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self._slot = run_id % NUM_RUN_SLOTS
+
+    @classmethod
+    def start_run(cls):
+        token = cls(next(_run_id_counter))
+        _get_run_ids()[token._slot] = token.run_id
+        return token
+
+    def cancel(self):
+        run_ids = _get_run_ids()
+        if run_ids[self._slot] == self.run_id:
+            run_ids[self._slot] = 0
+
+    @property
+    def cancelled(self):
+        return _get_run_ids()[self._slot] != self.run_id
+
+    def check(self):
+        # the cooperative cancellation checkpoint of the simulations
+        if self.cancelled:
+            raise SimulationCancelled(f"Simulation run {self.run_id} was superseded")
+
+
+class SimulationJobs:
+    # Every run gets an ID and a cancel token, starting a new run cancels the
+    # previous one, so it stops at its next checkpoint, even if it runs in a
+    # worker process, and only the latest run uses the CPU
+    def __init__(self):
+        self._latest_token = None
+
+    def start_run(self):
+        self.cancel()
+        self._latest_token = CancelToken.start_run()
+        return self._latest_token
+
+    def cancel(self):
+        if self._latest_token is not None:
+            self._latest_token.cancel()
@@ -1,8 +1,9 @@
 import itertools
 
-import matplotlib.pyplot as plt
+import matplotlib
 
-COLORS = list(plt.rcParams["axes.prop_cycle"].by_key()["color"])
+# the rcParams are available without importing pyplot, which is much slower
+COLORS = list(matplotlib.rcParams["axes.prop_cycle"].by_key()["color"])
 COLOR_CYCLE = itertools.cycle(COLORS)
 
 MARKERS = [
@@ -0,0 +1,104 @@
+import numpy
+
+from pop_lab.figures import PersistentFigure, SessionFigures
+
+
+def create_replicate_segments(num_replicates, num_generations=10):
+    xs = numpy.arange(num_generations)
+    return [
+        numpy.column_stack((xs, numpy.full(num_generations, replicate)))
+        for replicate in range(num_replicates)
+    ]
+
+
+def test_update_lines():
+    figure = PersistentFigure()
+    fig = figure.fig
+    lines = {
+        "pop1": {"xs": [0, 1, 2], "ys": [0, 1, 2], "style": {"label": "pop1"}},
+        "pop2": {"xs": [0, 1], "ys": [3, 4], "style": {"label": "pop2"}},
+    }
+    axes = figure.update_lines(lines=lines)
+    axes.legend()
+    line = axes.lines[0]
+    assert len(axes.lines) == 2
+    assert axes.get_ylim()[1] >= 4
+
+    # the same artists are updated and the missing ones removed
+    lines = {"pop1": {"xs": [0, 10], "ys": [0, 1], "style": {"color": "red"}}}
+    axes = figure.update_lines(lines=lines)
+    assert figure.fig is fig
+    assert list(axes.lines) == [line]
+    assert list(line.get_xdata()) == [0, 10]
+    assert line.get_color() == "red"
+    assert axes.get_legend() is None
+    assert axes.get_xlim()[1] >= 10
+
+
+def test_update_to_shorter_lines():
+    figure = PersistentFigure(title="Freq. A", xlabel="generation", ylabel="freq")
+    xs = numpy.arange(100)
+    lines = {
+        "AA": {"xs": xs, "ys": xs * 2, "style": {"label": "AA"}},
+        "aa": {"xs": xs, "ys": xs, "style": {"label": "aa"}},
+    }
+    axes = figure.update_lines(lines=lines, legend=True)
+    legend = axes.get_legend()
+    assert axes.get_xlim()[1] >= 99
+    assert axes.get_ylim()[1] >= 198
+
+    # the axes are rescaled to the new data, the decoration and the legend kept
+    xs = numpy.arange(10)
+    lines = {
+        "AA": {"xs": xs, "ys": xs * 2, "style": {"label": "AA"}},
+        "aa": {"xs": xs, "ys": xs, "style": {"label": "aa"}},
+    }
+    axes = figure.update_lines(lines=lines, legend=True)
+    assert 9 <= axes.get_xlim()[1] < 99
+    assert 18 <= axes.get_ylim()[1] < 198
+    assert axes.get_legend() is legend
+    assert axes.get_title() == "Freq. A"
+    assert axes.get_xlabel() == "generation"
+
+    # the legend is created again with the new styles
+    lines["AA"]["style"] = {"label": "AA", "color": "red"}
+    axes = figure.update_lines(lines=lines, legend=True)
+    assert axes.get_legend() is not legend
+
+    axes = figure.clear()
+    assert axes.get_title() == "Freq. A"
+    assert axes.get_ylabel() == "freq"
+    assert axes.get_legend() is None
+
+
+def test_update_line_collections():
+    figure = PersistentFigure()
+    axes = figure.update_lines(
+        line_collections={
+            "pop1": {"segments": create_replicate_segments(100), "style": {}}
+        }
+    )
+    collection = axes.collections[0]
+    assert len(axes.collections) == 1
+    assert len(collection.get_segments()) == 100
+    assert axes.get_ylim()[1] >= 99
+
+    # the number of artists does not grow with the replicates or the renders
+    for num_replicates in (10, 1000):
+        segments = create_replicate_segments(num_replicates)
+        axes = figure.update_lines(
+            line_collections={"pop1": {"segments": segments, "style": {}}}
+        )
+    assert list(axes.collections) == [collection]
+    assert len(collection.get_segments()) == 1000
+
+
+def test_session_figures():
+    figures = SessionFigures()
+    figure = figures.get("plot", title="Plot")
+    assert figures["plot"] is figure
+    assert figure.axes.get_title() == "Plot"
+    figure.update_lines(lines={"pop1": {"xs": [0, 1], "ys": [0, 1], "style": {}}})
+    figures.close()
+    assert not figure.fig.axes
+    assert figures["plot"] is not figure
@@ -1,10 +1,30 @@
+import asyncio
+
 import numpy
 
 import msprime
 
+import pytest
+
+from pop_lab import msprime_sim_utils
+from pop_lab.sim_jobs import SimulationJobs, SimulationCancelled
 from pop_lab.msprime_sim_utils import (
     create_msprime_sample_set,
     simulate,
+    simulate_async,
+    simulate_replicates,
+    simulate_replicates_async,
+    TreeSeqsCache,
+    StageProfiler,
+    SimulationResult,
+    create_result_bundle,
+    create_result_key,
+    save_result_bundle,
+    load_result_bundle,
+    _calc_binned_ld_decay,
+    _do_pca,
+    _calc_jost_dest_square_dists,
+    _sample_marker_pairs_per_dist_bin,
 )
 
 
@@ -119,3 +139,442 @@ def test_gt_df():
     assert res["gts"].num_indis == 40
     assert sorted(set(res["sampling_names"])) == ["pop_1_10", "pop_1_20"]
     assert res["sampling_names"].shape == (40,)
+
+
+@pytest.fixture
+def sim_kwargs():
+    # one pop sampled at two times
+    demography, pop_names = create_simple_demography(num_pops=1)
+    sample_sets = [
+        create_msprime_sample_set(
+            num_samples=10, ploidy=2, pop_name=pop_names[0], time=time
+        )
+        for time in [0, 10]
+    ]
+    return {
+        "sample_sets": sample_sets,
+        "demography": demography,
+        "model": None,
+        "seq_length_in_bp": 1e4,
+    }
+
+
+@pytest.fixture
+def sim_res(sim_kwargs):
+    return simulate(**sim_kwargs, random_seed=42)
+
+
+def test_indi_idxs_by_pop_sample(sim_res):
+    pytest.importorskip("pynei")
+    res = sim_res.get_vars_and_pop_samples()
+    assert res["pop_sample_names"] == ["pop_1_0", "pop_1_10"]
+    assert numpy.all(res["pop_sample_idx_per_indi"] == [0] * 10 + [1] * 10)
+    indi_names = numpy.array(res["vars"].samples)
+    for pop_sample, idxs in res["indi_idxs_by_pop_sample"].items():
+        assert list(indi_names[idxs]) == res["indis_by_pop_sample"][pop_sample]
+
+
+def test_replicates(sim_kwargs):
+    kwargs = sim_kwargs | {
+        "num_replicates": 10,
+        "random_seed": 42,
+        "use_process_pool": False,
+    }
+    res = simulate_replicates(**kwargs)
+    exp_het = res["exp_het"]
+    assert list(exp_het.index) == [("pop_1", 0), ("pop_1", 10)]
+    assert numpy.all(exp_het["num_replicates"] == 10)
+    assert numpy.all(exp_het["ci_low"] <= exp_het["mean"])
+    assert numpy.all(exp_het["mean"] <= exp_het["ci_high"])
+
+    res2 = simulate_replicates(**kwargs)
+    assert numpy.allclose(res2["exp_het"]["mean"], exp_het["mean"])
+
+
+def test_replicates_async(monkeypatch, sim_kwargs):
+    kwargs = sim_kwargs | {"num_replicates": 10, "random_seed": 42}
+    res = simulate_replicates(**kwargs, use_process_pool=False)
+
+    # in the worker processes, the same seeds give the same replicates
+    async_res = asyncio.run(simulate_replicates_async(**kwargs))
+    assert numpy.allclose(async_res["exp_het"]["mean"], res["exp_het"]["mean"])
+
+    # as in pyodide, without worker processes
+    monkeypatch.setattr(msprime_sim_utils, "_get_process_pool", lambda: None)
+    progress = []
+    async_res = asyncio.run(
+        simulate_replicates_async(
+            **kwargs,
+            progress_callback=lambda fraction, message: progress.append(fraction),
+        )
+    )
+    assert numpy.allclose(async_res["num_poly"]["mean"], res["num_poly"]["mean"])
+    assert progress == [num / 10 for num in range(1, 11)]
+
+    sim_jobs = SimulationJobs()
+    cancel_token = sim_jobs.start_run()
+    sim_jobs.cancel()
+    with pytest.raises(SimulationCancelled):
+        asyncio.run(simulate_replicates_async(**kwargs, cancel_token=cancel_token))
+
+
+def test_tree_seqs_cache(tmp_path, sim_kwargs):
+    cache = TreeSeqsCache(tmp_path)
+    kwargs = sim_kwargs | {"random_seed": 42, "cache": cache}
+    sim_res = simulate(**kwargs)
+    cached_files = list(tmp_path.glob("*.trees"))
+    assert len(cached_files) == 1
+
+    sim_res2 = simulate(**kwargs)
+    assert sim_res2.tree_seqs.equals(sim_res.tree_seqs, ignore_provenance=True)
+    assert list(tmp_path.glob("*.trees")) == cached_files
+
+    # only the ancestry is cached, so the mutation rate is not part of the key
+    simulate(**(kwargs | {"mutation_rate": 2e-8}))
+    assert list(tmp_path.glob("*.trees")) == cached_files
+
+    simulate(**(kwargs | {"recomb_rate": 2e-8}))
+    assert len(list(tmp_path.glob("*.trees"))) == 2
+
+    # without a seed every simulation should be different, so no cache
+    simulate(**(kwargs | {"random_seed": None}))
+    assert len(list(tmp_path.glob("*.trees"))) == 2
+
+    # the least recently used are removed, but not the last one
+    cache.max_size_in_bytes = 1
+    sim_res3 = simulate(**(kwargs | {"random_seed": 1}))
+    assert len(list(tmp_path.glob("*.trees"))) == 1
+    cached = cache.get(list(tmp_path.glob("*.trees"))[0].stem)
+    assert cached.equals(sim_res3.ancestry_tree_seqs, ignore_provenance=True)
+
+
+def test_default_tree_seqs_cache(monkeypatch, tmp_path):
+    get_cache = msprime_sim_utils.get_default_tree_seqs_cache
+    monkeypatch.setenv(msprime_sim_utils.TREE_SEQS_CACHE_DIR_ENV_VAR, str(tmp_path))
+    get_cache.cache_clear()
+    try:
+        cache = get_cache()
+        assert cache.cache_dir == tmp_path
+        assert get_cache() is cache
+
+        # as in pyodide
+        get_cache.cache_clear()
+        monkeypatch.setattr(msprime_sim_utils.sys, "platform", "emscripten")
+        assert get_cache() is None
+    finally:
+        get_cache.cache_clear()
+
+
+def test_reuse_ancestry(sim_kwargs, sim_res):
+    ancestry = sim_res.ancestry_tree_seqs
+    assert ancestry.num_sites == 0
+    assert ancestry.num_trees == sim_res.tree_seqs.num_trees
+
+    sim_res2 = simulate(
+        **sim_kwargs,
+        random_seed=42,
+        mutation_rate=5e-8,
+        ancestry_tree_seqs=ancestry,
+    )
+    assert sim_res2.tree_seqs.num_sites > sim_res.tree_seqs.num_sites
+    assert sim_res2.ancestry_tree_seqs.equals(ancestry, ignore_provenance=True)
+
+    res = sim_res.calc_branch_diversity()
+    assert list(res["branch_diversity_dframe"]["generation"]) == [0, 10]
+    assert numpy.all(res["branch_diversity_dframe"]["branch_diversity"] > 0)
+
+
+def test_simulate_async_in_stages(monkeypatch, sim_kwargs, sim_res):
+    # as in pyodide, without worker processes
+    monkeypatch.setattr(msprime_sim_utils, "_get_process_pool", lambda: None)
+    progress = []
+    async_sim_res = asyncio.run(
+        simulate_async(
+            **sim_kwargs,
+            random_seed=42,
+            stats_to_calc=["calc_num_variants"],
+            progress_callback=lambda fraction, message: progress.append(fraction),
+        )
+    )
+    assert progress == [0, 1 / 3, 2 / 3, 1]
+    assert async_sim_res.tree_seqs.equals(sim_res.tree_seqs, ignore_provenance=True)
+
+
+def test_cancel_superseded_simulation(monkeypatch, sim_kwargs):
+    sim_jobs = SimulationJobs()
+    superseded_run = sim_jobs.start_run()
+    sim_jobs.start_run()
+
+    # in the worker process and in stages, as in pyodide
+    with pytest.raises(SimulationCancelled):
+        asyncio.run(simulate_async(**sim_kwargs, cancel_token=superseded_run))
+    monkeypatch.setattr(msprime_sim_utils, "_get_process_pool", lambda: None)
+    with pytest.raises(SimulationCancelled):
+        asyncio.run(simulate_async(**sim_kwargs, cancel_token=superseded_run))
+
+
+def test_calc_stats_async(monkeypatch, sim_kwargs, sim_res):
+    expected = sim_res.calc_site_freq_spectrum()
+
+    # in the worker process and in stages, as in pyodide
+    for pool in (msprime_sim_utils._get_process_pool(), None):
+        monkeypatch.setattr(
+            msprime_sim_utils, "_get_process_pool", lambda pool=pool: pool
+        )
+        async_sim_res = simulate(**sim_kwargs, random_seed=42)
+        stats = asyncio.run(
+            msprime_sim_utils.calc_stats_async(
+                async_sim_res, ["calc_site_freq_spectrum"]
+            )
+        )
+        assert stats is async_sim_res.stats
+        sfs = async_sim_res.calc_site_freq_spectrum()["sfs"]["pop_1_0"]
+        assert sfs.equals(expected["sfs"]["pop_1_0"])
+
+        # a stat that fails does not prevent the others from being calculated
+        no_sites_sim_res = simulate(**sim_kwargs, random_seed=42, mutation_rate=0)
+        with pytest.raises(ValueError):
+            asyncio.run(
+                msprime_sim_utils.calc_stats_async(
+                    no_sites_sim_res,
+                    ["calc_exp_het_along_genome", "calc_site_freq_spectrum"],
+                )
+            )
+        assert list(no_sites_sim_res.stats) == ["calc_site_freq_spectrum"]
+
+    sim_jobs = SimulationJobs()
+    superseded_run = sim_jobs.start_run()
+    sim_jobs.start_run()
+    with pytest.raises(SimulationCancelled):
+        asyncio.run(
+            msprime_sim_utils.calc_stats_async(
+                async_sim_res, ["calc_pca"], cancel_token=superseded_run
+            )
+        )
+
+
+def test_result_bundle(tmp_path, sim_kwargs):
+    kwargs = sim_kwargs | {
+        "seq_length_in_bp": 1e5,
+        "recomb_rate": 1e-8,
+        "mutation_rate": 1e-7,
+    }
+    bundle = create_result_bundle(
+        **kwargs,
+        stats_to_calc=["calc_unbiased_exp_het", "calc_num_variants"],
+        random_seed=42,
+    )
+    assert bundle["key"] == create_result_key(**kwargs)
+    kwargs["mutation_rate"] = 1e-8
+    assert bundle["key"] != create_result_key(**kwargs)
+
+    path = tmp_path / "bundle.pickle"
+    save_result_bundle(bundle, path)
+    sim_res = SimulationResult.from_bundle(load_result_bundle(path))
+    assert sim_res.tree_seqs is None
+    assert sim_res.ancestry_tree_seqs is None
+    res = sim_res.calc_unbiased_exp_het()
+    expected = bundle["stats"]["calc_unbiased_exp_het"]
+    assert res["exp_het_dframe"].equals(expected["exp_het_dframe"])
+    assert list(sim_res.pop_samples_info) == ["pop_1_0", "pop_1_10"]
+    assert len(sim_res.indis_per_pop_sample["indi_names"]) == 20
+
+    assert load_result_bundle(tmp_path / "missing.pickle") is None
+    (tmp_path / "corrupted.pickle").write_bytes(b"not a pickle")
+    assert load_result_bundle(tmp_path / "corrupted.pickle") is None
+
+
+def test_stats_calculated_once(sim_res):
+    pytest.importorskip("pynei")
+    assert sim_res.get_vars_and_pop_samples() is sim_res.get_vars_and_pop_samples()
+    assert sim_res.calc_unbiased_exp_het() is sim_res.calc_unbiased_exp_het()
+    assert list(sim_res.stats.keys()) == ["calc_unbiased_exp_het"]
+    assert list(sim_res.pop_samples_info.keys()) == ["pop_1_0", "pop_1_10"]
+
+    filtered = sim_res.get_filtered_vars(0.95, 0.1)
+    assert sim_res.get_filtered_vars(0.95, 0.1) is filtered
+    assert sim_res.get_filtered_vars(0.95, min_allowed_r2=0.1) is filtered
+    assert (
+        sim_res.get_filtered_vars(min_allowed_r2=0.1, max_allowed_maf=0.95) is filtered
+    )
+    assert sim_res.get_filtered_vars(0.95) is not filtered
+    assert sim_res.get_filtered_vars(0.95) is sim_res.get_filtered_vars(0.95, None)
+
+    # the LD pruning is done with the variants kept by the MAF filter
+    maf_filtered = sim_res.get_filtered_vars(0.95)
+    assert numpy.all(numpy.isin(filtered["var_idxs"], maf_filtered["var_idxs"]))
+    assert set(maf_filtered["filter_stats"]).issubset(filtered["filter_stats"])
+
+    # the stats calculated with the default arguments are kept by method name
+    sfs = sim_res.calc_site_freq_spectrum()
+    assert sim_res.calc_site_freq_spectrum(polarised=False) is sfs
+    assert "calc_site_freq_spectrum" in sim_res.stats
+    assert sim_res.calc_site_freq_spectrum(True) is not sfs
+
+
+def test_pca_and_dists_share_maf_filter(sim_res):
+    pytest.importorskip("pynei")
+
+    def get_filtered_vars_keys():
+        return [key for key in sim_res._intermediates if key[0] == "get_filtered_vars"]
+
+    sim_res.calc_pca()
+    keys = get_filtered_vars_keys()
+    assert len(keys) == 2
+    # the distances use the MAF filtered variants of the PCA
+    sim_res.calc_jost_dest_dists()
+    assert get_filtered_vars_keys() == keys
+
+
+def test_binned_ld_decay():
+    dists = numpy.repeat([5.0, 15.0, 25.0], [10, 100, 3])
+    r2s = numpy.repeat([0.9, 0.5, 0.1], [10, 100, 3])
+    res = _calc_binned_ld_decay(r2s, dists, bin_edges=numpy.linspace(0, 40, 5))
+    assert numpy.allclose(res["dists"], [5, 15, 25])
+    assert numpy.allclose(res["r2s"], [0.9, 0.5, 0.1])
+    assert list(res["num_pairs"]) == [10, 100, 3]
+
+
+def test_sample_marker_pairs():
+    poss = numpy.array([0, 1, 3, 4, 8, 9, 10])
+    bin_edges = numpy.linspace(0, 10, 3)
+    rng = numpy.random.default_rng(1)
+
+    idxs1, idxs2 = _sample_marker_pairs_per_dist_bin(poss, bin_edges, 100, rng)
+    pairs = sorted(zip(idxs1, idxs2))
+    expected = [(i, j) for i in range(poss.size) for j in range(i + 1, poss.size)]
+    assert pairs == expected
+
+    idxs1, idxs2 = _sample_marker_pairs_per_dist_bin(poss, bin_edges, 3, rng)
+    dists = poss[idxs2] - poss[idxs1]
+    assert numpy.all(idxs1 < idxs2)
+    assert numpy.sum(dists < 5) == 3
+    assert numpy.sum(dists >= 5) == 3
+    assert len(set(zip(idxs1, idxs2))) == idxs1.size
+
+
+def test_ld_curves():
+    demography, pop_names = create_simple_demography(num_pops=1, pop_size=1000)
+    samplings = [
+        create_msprime_sample_set(
+            num_samples=20, ploidy=2, pop_name=pop_names[0], time=0
+        )
+    ]
+    sim_res = simulate(
+        samplings,
+        demography=demography,
+        model=None,
+        seq_length_in_bp=1e6,
+        random_seed=42,
+        mutation_rate=1e-7,
+    )
+    curve = sim_res.calc_ld_curves()["pop_1_0"]
+    assert numpy.all((curve["r2s"] >= 0) & (curve["r2s"] <= 1))
+    assert curve["r2s"][0] > curve["r2s"][-1]
+
+    # both smoothers estimate the mean r2 along the distances
+    lowess_curve = sim_res.calc_ld_curves(smoothing="lowess")["pop_1_0"]
+    lowess_r2s = numpy.interp(
+        curve["dists"], lowess_curve["dists"], lowess_curve["r2s"]
+    )
+    assert numpy.allclose(lowess_r2s, curve["r2s"], atol=0.05)
+
+
+def test_pca():
+    rng = numpy.random.default_rng(0)
+    matrix = rng.integers(0, 3, size=(40, 200)).astype(float)
+    matrix[:20, :50] += 2
+    matrix[20:30, 50:100] += 2
+    res = _do_pca(matrix, num_components=2)
+
+    std_matrix = (matrix - matrix.mean(axis=0)) / matrix.std(axis=0)
+    u, singular_values, _ = numpy.linalg.svd(std_matrix, full_matrices=False)
+    expected = u[:, :2] * singular_values[:2]
+    # the randomized SVD is an approximation
+    assert numpy.allclose(numpy.abs(res["projections"]), numpy.abs(expected), atol=0.1)
+    expected_variance = singular_values[:2] ** 2 / numpy.sum(singular_values**2) * 100
+    assert numpy.allclose(res["explained_variance (%)"], expected_variance, rtol=1e-3)
+
+    res2 = _do_pca(matrix, num_components=2)
+    assert numpy.array_equal(res["projections"], res2["projections"])
+
+
+def test_jost_dest():
+    # 3 pop samples, the first two fixed for different alleles, the third equal
+    # to the first one
+    counts = numpy.array([[[100, 0], [0, 100], [100, 0]]] * 5)
+    dists = _calc_jost_dest_square_dists(counts)
+    assert numpy.allclose(dists, [[0, 1, 0], [1, 0, 1], [0, 1, 0]])
+
+
+def test_allele_counts():
+    demography, pop_names = create_simple_demography(num_pops=1)
+    samplings = [
+        create_msprime_sample_set(
+            num_samples=num_samples, ploidy=2, pop_name=pop_names[0], time=time
+        )
+        for num_samples, time in [(10, 0), (5, 10)]
+    ]
+    sim_res = simulate(
+        samplings,
+        demography=demography,
+        model=None,
+        seq_length_in_bp=1e4,
+        random_seed=42,
+    )
+    counts = sim_res.get_allele_counts()
+    assert counts.shape[:2] == (sim_res.tree_seqs.num_sites, 2)
+    assert numpy.all(counts.sum(axis=2) == [20, 10])
+
+    haplotypes = sim_res.tree_seqs.genotype_matrix()
+    node_ids = sim_res.pop_samples_info["pop_1_10"]["sample_node_ids"]
+    assert numpy.array_equal(
+        counts[:, 1, 1], (haplotypes[:, node_ids] == 1).sum(axis=1)
+    )
+
+
+def test_site_freq_spectrum():
+    demography, pop_names = create_simple_demography(num_pops=1)
+    samplings = [
+        create_msprime_sample_set(
+            num_samples=10, ploidy=2, pop_name=pop_names[0], time=0
+        )
+    ]
+    sim_res = simulate(
+        samplings,
+        demography=demography,
+        model=None,
+        seq_length_in_bp=1e5,
+        random_seed=42,
+    )
+    res = sim_res.calc_site_freq_spectrum()
+    assert res["num_samples"] == {"pop_1_0": 20}
+    folded_sfs = res["sfs"]["pop_1_0"]
+    assert list(folded_sfs.index) == list(range(11))
+    assert folded_sfs.sum() == sim_res.tree_seqs.num_sites
+
+    unfolded_sfs = sim_res.calc_site_freq_spectrum(polarised=True)["sfs"]["pop_1_0"]
+    assert unfolded_sfs.size == 21
+    assert unfolded_sfs.sum() == folded_sfs.sum()
+
+    branch_sfs = sim_res.calc_site_freq_spectrum(mode="branch")["sfs"]["pop_1_0"]
+    assert numpy.all(branch_sfs.iloc[1:] > 0)
+
+
+def test_stage_profiler():
+    profiler = StageProfiler()
+    with profiler.stage("disabled"):
+        pass
+    assert not profiler.records
+
+    profiler = StageProfiler(enabled=True)
+    with profiler.stage("outer"):
+        with profiler.stage("inner"):
+            array = numpy.ones(1_000_000)
+        del array
+    inner, outer = profiler.records
+    assert inner["stage"] == "inner"
+    assert outer["stage"] == "outer"
+    assert inner["peak_alloc_bytes"] >= 8_000_000
+    assert outer["peak_alloc_bytes"] >= inner["peak_alloc_bytes"]
+    assert outer["wall_time_s"] >= inner["wall_time_s"]
@@ -1,15 +1,20 @@
+import asyncio
 import math
 
 import pytest
 import numpy
 
+from pop_lab import one_locus_two_alleles_simulator
 from pop_lab.one_locus_two_alleles_simulator import (
     simulate_forward_in_time,
+    simulate_async,
     Population,
     GenotypicFreqs,
     GenotypicFreqsLogger,
+    PhaseTimer,
 )
 from pop_lab import OneLocusTwoAlleleSimulation, Fitness
+from pop_lab.sim_jobs import SimulationJobs, SimulationCancelled
 
 
 def test_genotypic_freqs():
@@ -108,3 +113,109 @@ def test_selection():
     )
     pop.evolve_to_next_generation()
     assert math.isclose(pop.allelic_freqs.A, 0.9899000100999898)
+
+
+def test_simulation_hooks():
+    pop = Population(
+        "pop1",
+        GenotypicFreqs(0.5, 0, 0.5),
+        size=100,
+        fitness=Fitness(1, 1, 0.9),
+    )
+    generations_before = []
+    generations_after = []
+    phase_timer = PhaseTimer()
+    simulate_forward_in_time(
+        [pop],
+        num_generations=5,
+        loggers=[],
+        before_generation_callbacks=[
+            lambda pops, num_generation: generations_before.append(num_generation)
+        ],
+        after_generation_callbacks=[
+            lambda pops, num_generation: generations_after.append(num_generation)
+        ],
+        phase_timer=phase_timer,
+    )
+    assert generations_before == [2, 3, 4, 5]
+    assert generations_after == [2, 3, 4, 5]
+    summary = phase_timer.summary
+    assert summary["drift"]["num_calls"] == 4
+    assert summary["drift"]["total_time_s"] > 0
+    assert math.isclose(sum(phase["fraction"] for phase in summary.values()), 1)
+
+
+def test_simulate_async_in_chunks(monkeypatch):
+    # as in pyodide, without worker processes
+    monkeypatch.setattr(
+        one_locus_two_alleles_simulator, "_get_process_pool", lambda: None
+    )
+    monkeypatch.setattr(one_locus_two_alleles_simulator, "ASYNC_YIELD_INTERVAL", 0)
+    sim_definition = {
+        "pops": {
+            "pop1": {"genotypic_freqs": (0.25, 0.5, 0.25), "size": 100},
+        },
+        "num_generations": 10,
+        "loggers": ["allelic_freqs_logger"],
+    }
+    progress = []
+    sims = asyncio.run(
+        simulate_async(
+            sim_definition,
+            num_simulations=2,
+            progress_callback=lambda fraction, message: progress.append(fraction),
+        )
+    )
+    assert len(sims) == 2
+    assert sims[0].results["allelic_freqs"]["pop1"].shape == (10,)
+    assert progress == sorted(progress)
+    assert progress[-1] == 1
+
+
+def test_simulate_async_in_process_pool(monkeypatch):
+    monkeypatch.setattr(one_locus_two_alleles_simulator, "NUM_CHUNKS_PER_WORKER", 1)
+    monkeypatch.setattr(one_locus_two_alleles_simulator.os, "cpu_count", lambda: 3)
+    sim_definition = {
+        "pops": {
+            "pop1": {"genotypic_freqs": (0.25, 0.5, 0.25), "size": 100},
+        },
+        "num_generations": 10,
+        "loggers": ["allelic_freqs_logger"],
+    }
+    progress = []
+    sims = asyncio.run(
+        simulate_async(
+            sim_definition,
+            num_simulations=10,
+            progress_callback=lambda fraction, message: progress.append(fraction),
+        )
+    )
+    # one progress report per chunk of replicates
+    assert len(sims) == 10
+    assert progress == [0.4, 0.7, 1]
+    freqs = {tuple(sim.results["allelic_freqs"]["pop1"]) for sim in sims}
+    assert len(freqs) > 1
+
+
+def test_cancel_superseded_simulation():
+    sim_definition = {
+        "pops": {
+            "pop1": {"genotypic_freqs": (0.25, 0.5, 0.25), "size": 100},
+        },
+        "num_generations": 10,
+        "loggers": ["allelic_freqs_logger"],
+    }
+    sim_jobs = SimulationJobs()
+    first_run = sim_jobs.start_run()
+    second_run = sim_jobs.start_run()
+    assert first_run.cancelled
+    assert second_run.run_id == first_run.run_id + 1
+
+    with pytest.raises(SimulationCancelled):
+        OneLocusTwoAlleleSimulation(sim_definition, cancel_token=first_run)
+    # also in the worker processes
+    with pytest.raises(SimulationCancelled):
+        asyncio.run(simulate_async(sim_definition, cancel_token=first_run))
+
+    sims = asyncio.run(simulate_async(sim_definition, cancel_token=second_run))
+    assert sims[0].results["allelic_freqs"]["pop1"].shape == (10,)
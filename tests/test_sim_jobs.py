@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+import pytest
+
+from pop_lab import sim_jobs
+from pop_lab.one_locus_two_alleles_simulator import simulate_async
+from pop_lab.sim_jobs import SimulationCancelled, SimulationJobs
+
+
+def test_cancel_running_simulation_in_worker():
+    assert sim_jobs.get_process_pool() is not None
+    sim_definition = {
+        "pops": {
+            "pop1": {"genotypic_freqs": (0.25, 0.5, 0.25), "size": 100},
+        },
+        "num_generations": 100000,
+        "loggers": ["allelic_freqs_logger"],
+    }
+    jobs = SimulationJobs()
+    cancel_token = jobs.start_run()
+
+    async def run_and_supersede():
+        task = asyncio.ensure_future(
+            simulate_async(sim_definition, cancel_token=cancel_token)
+        )
+        # the simulation has already started in the worker process
+        await asyncio.sleep(1)
+        jobs.start_run()
+        return await task
+
+    start = time.perf_counter()
+    with pytest.raises(SimulationCancelled):
+        asyncio.run(run_and_supersede())
+    assert time.perf_counter() - start < 10
+
+
+def test_without_shared_memory(monkeypatch):
+    # as in pyodide, the runs are only checked in the app process
+    monkeypatch.setattr(sim_jobs, "_RUN_IDS", [0] * sim_jobs.NUM_RUN_SLOTS)
+    monkeypatch.setattr(sim_jobs, "_PROCESS_POOL", None)
+    assert sim_jobs.get_process_pool() is None
+
+    jobs = SimulationJobs()
+    first_run = jobs.start_run()
+    first_run.check()
+    second_run = jobs.start_run()
+    assert first_run.cancelled
+    assert not second_run.cancelled
+    with pytest.raises(SimulationCancelled):
+        first_run.check()
+    jobs.cancel()
+    assert second_run.cancelled